@@ -0,0 +1,920 @@
+#!/usr/bin/env python3
+"""
+bench-md-to-word.py - Performance benchmarks for md-to-word.py
+
+Usage:
+    python bench-md-to-word.py [BENCHMARK...] [--scale N] [--repeat N]
+                               [--json OUT.json] [--compare BASELINE.json]
+    python bench-md-to-word.py --generate OUT.md [--scale N] [--diagrams N ...]
+
+Examples:
+    python bench-md-to-word.py
+    python bench-md-to-word.py format --scale 200
+    python bench-md-to-word.py stages --tables 50 --table-size 40x6 --json after.json --compare before.json
+
+Benchmarks:
+    - stages: every pipeline stage on its own - preprocess_markdown,
+              find_mermaid_blocks, asset substitution, pandoc, docx load,
+              apply_all_formatting (both engines) and each formatter, save,
+              plus convert_file end to end - on a synthetic document sized by
+              --scale and the element options below. Fixtures are built by
+              pandoc (python-docx fallback); mmdc and svgexport are stubbed
+              in-process, so it runs offline
+    - format: single-pass vs legacy post-formatting on a large generated document
+              (also verifies both engines produce identical XML), and the
+              per-instance fixups left when styling through --reference-doc
+    - fragments: cached OOXML fragments vs parse_xml() per element, formatting
+                 a 10k-cell table
+    - tables: streaming w:tr/w:tc table formatter vs the python-docx row/cell
+              formatter at growing row counts (checks scaling and identical XML)
+    - preprocess: streaming Markdown preprocessor vs the original two-pass
+                  version on multi-MB input (MB/s; identical output outside fences)
+    - assets: one-scan Mermaid/SVG reference rewrite vs per-diagram re.sub and
+              per-SVG str.replace on documents with hundreds of diagrams
+    - dedupe: renders, media parts and size of a document repeating 5 diagrams
+              8 times vs the same document with every copy distinct (each
+              repeated diagram must render once and embed as one part)
+    - postprocess: Phase 5 of an image-heavy docx through python-docx (load,
+                   format, save) vs the streaming ZIP rewrite - time, peak
+                   memory (tracemalloc) and identical document.xml - plus the
+                   streaming engine at --compression 0, 1, 6 and 9
+    - shards: a large synthetic document converted in one pass vs split into
+              2, 4 and CPU-count shards converted by worker processes and
+              merged; speedup per shard count, and fails
+              unless every merge matches the one-pass document.xml (ids
+              aside)
+    - mermaid: diagrams/second rendered by one mmdc process per diagram vs the
+               batch renderer (one Node worker and browser, launch included)
+               at 1 and CPU-count pages; needs mermaid-cli installed
+    - pandoc: files/second through a cold pandoc process per file vs a warm
+              pandoc server (launched locally, or --pandoc-server URL)
+    - startup: fixed cost per invocation, in fresh interpreters - importing
+               the module, --help, and a no-op --incremental run - against a
+               bare interpreter; fails if importing loads python-docx,
+               asyncio, Pillow or urllib.request
+
+Synthetic documents:
+    --headings, --paragraphs, --lists, --code-blocks, --tables, --table-size RxC,
+    --diagrams and --svgs override the element counts derived from --scale
+    (per scale unit: 4 headings, 8 paragraphs, 2 lists, 1 code block, 1/2 table,
+    1/5 diagram, 1/10 SVG reference).
+
+Results:
+    --json writes every measurement (seconds) with the tool/Python versions;
+    --compare prints the change against such a file and exits 1 when a
+    benchmark is slower than --threshold percent (default: 10) and by more
+    than 1ms.
+
+Requirements:
+    - python-docx (pip install python-docx)
+    - pandoc [pandoc benchmark; stage fixtures and end-to-end stage]
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+from lxml import etree
+
+
+def load_md_to_word():
+    """Import md-to-word.py (its hyphenated name rules out a plain import)."""
+    path = Path(__file__).with_name('md-to-word.py')
+    spec = importlib.util.spec_from_file_location('md_to_word', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # sharded conversions pickle its functions by module name
+    spec.loader.exec_module(module)
+    module.ensure_docx()  # the benchmarks use its python-docx names directly
+    return module
+
+
+m = load_md_to_word()
+
+
+def rgb_png(width: int, height: int, raw: bytes) -> bytes:
+    """An 8-bit RGB PNG from ``raw`` scanlines (each a filter byte and its pixels)."""
+    return (m.PNG_SIGNATURE +
+            m.png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            m.png_chunk(b'IDAT', zlib.compress(raw)) +
+            m.png_chunk(b'IEND', b''))
+
+
+def make_png(width: int, height: int) -> bytes:
+    """A plain white RGB PNG of the given size."""
+    return rgb_png(width, height, b''.join(b'\x00' + b'\xff' * (width * 3) for _ in range(height)))
+
+
+def make_noise_png(width: int, height: int, seed: int) -> bytes:
+    """An RGB PNG of pseudo-random pixels (incompressible, like a photo or screenshot)."""
+    rng = random.Random(seed)
+    return rgb_png(width, height, b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height)))
+
+
+def generate_docx(sections: int, table_rows: int = 12, table_cols: int = 4) -> bytes:
+    """Build a pandoc-shaped document: headings, prose, lists, code, tables, images."""
+    doc = m.Document()
+    code_style = doc.styles.add_style('Source Code', m.WD_STYLE_TYPE.PARAGRAPH)
+    code_style.base_style = doc.styles['Normal']
+    image = io.BytesIO(make_png(64, 32))
+    
+    for i in range(sections):
+        doc.add_heading(f'Section {i + 1}', level=1)
+        for level in (2, 3, 4):
+            doc.add_heading(f'Subsection {i + 1}.{level}', level=level)
+            doc.add_paragraph('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 4)
+        for item in range(5):
+            doc.add_paragraph(f'List item {item + 1}', style='List Bullet')
+        for line in range(4):
+            doc.add_paragraph(f'print("line {line}")', style='Source Code')
+        table = doc.add_table(rows=table_rows, cols=table_cols)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = 'cell'
+        doc.add_picture(image)
+        doc.add_paragraph('')
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def best_of(repeat: int, setup, run) -> tuple[float, object]:
+    """Best wall time of ``run(setup())`` over ``repeat`` runs (setup not timed)."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+        result = state
+    return best, result
+
+
+def body_xml(doc) -> bytes:
+    return etree.tostring(doc.element.body)
+
+
+def bench_format(args) -> list[tuple[str, float, str]]:
+    """Post-formatting engines on the same generated document."""
+    blob = generate_docx(args.scale)
+    rows = []
+    outputs = {}
+    for engine in ('legacy', 'single-pass'):  # legacy first = baseline (streaming: see postprocess)
+        elapsed, doc = best_of(
+            args.repeat,
+            lambda: m.Document(io.BytesIO(blob)),
+            lambda doc: m.apply_all_formatting(doc, engine=engine),
+        )
+        outputs[engine] = body_xml(doc)
+        rows.append((f'format[{engine}]', elapsed, ''))
+    
+    # Per-instance fixups only (styles come from the generated reference.docx)
+    elapsed, doc = best_of(
+        args.repeat,
+        lambda: m.Document(io.BytesIO(blob)),
+        lambda doc: m.apply_all_formatting(doc, reference_styles=True),
+    )
+    rows.append(('format[reference-styles]', elapsed, ''))
+    
+    baseline = rows[0][1]
+    rows = [(name, elapsed, f'{baseline / elapsed:.1f}x') for name, elapsed, _ in rows]
+    if len(set(outputs.values())) != 1:
+        rows.append(('format[identical-xml]', 0.0, 'MISMATCH'))
+    return rows
+
+
+def generate_table_docx(rows: int, cols: int) -> bytes:
+    """A document holding one ``rows`` x ``cols`` table."""
+    doc = m.Document()
+    table = doc.add_table(rows=rows, cols=cols)
+    for cell in table._tbl.iter(m.qn('w:tc')):
+        cell.clear_content()
+        cell.add_p().add_r().text = 'cell'
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def bench_fragments(args) -> list[tuple[str, float, str]]:
+    """Fragments parsed per element vs copied from cache, on a 10k-cell table.
+    
+    ``build`` isolates the per-cell shading / per-row cantSplit element work;
+    ``table`` is the full table formatting pass.
+    """
+    blob = generate_table_docx(2500, 4)  # 10k cells
+    shading = f'<w:shd {m.nsdecls("w")} w:fill="F0F0F0"/>'
+    cant_split = f'<w:cantSplit {m.nsdecls("w")}/>'
+    
+    def build(doc):
+        tbl = doc.tables[0]._tbl
+        for tr in tbl.tr_lst:
+            tr.get_or_add_trPr().append(m.fragment(cant_split))
+            for tc in tr.tc_lst:
+                tc.get_or_add_tcPr().append(m.fragment(shading))
+    
+    cached = m.fragment
+    rows = []
+    outputs = []
+    for stage, run in (('build', build), ('table', m.apply_all_formatting)):
+        stage_rows = []
+        for label, factory in (('parse_xml', m.parse_xml), ('cached', cached)):
+            m.fragment = factory
+            try:
+                elapsed, doc = best_of(args.repeat, lambda: m.Document(io.BytesIO(blob)), run)
+            finally:
+                m.fragment = cached
+            outputs.append(body_xml(doc))
+            stage_rows.append((f'fragments[{stage}:{label}]', elapsed))
+        baseline = stage_rows[0][1]
+        rows += [(name, elapsed, f'{baseline / elapsed:.1f}x') for name, elapsed in stage_rows]
+    
+    if outputs[0] != outputs[1] or outputs[2] != outputs[3]:
+        rows.append(('fragments[identical-xml]', 0.0, 'MISMATCH'))
+    return rows
+
+
+def bench_tables(args) -> list[tuple[str, float, str]]:
+    """Legacy format_tables() vs streaming format_table() as tables grow."""
+    rows = []
+    for num_rows in (1250, 2500, 5000):
+        blob = generate_table_docx(num_rows, 4)
+        legacy, legacy_doc = best_of(args.repeat, lambda: m.Document(io.BytesIO(blob)),
+                                     m.format_tables)
+        streaming, streaming_doc = best_of(args.repeat, lambda: m.Document(io.BytesIO(blob)),
+                                           lambda doc: m.format_table(doc.tables[0]))
+        per_row = f'{streaming / num_rows * 1e6:.0f}us/row'
+        rows.append((f'tables[legacy:{num_rows}]', legacy, ''))
+        rows.append((f'tables[streaming:{num_rows}]', streaming,
+                     f'{legacy / streaming:.1f}x, {per_row}'))
+        if body_xml(legacy_doc) != body_xml(streaming_doc):
+            rows.append((f'tables[identical-xml:{num_rows}]', 0.0, 'MISMATCH'))
+    return rows
+
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua. ')
+
+
+def document_spec(scale: int, **overrides) -> dict:
+    """Element counts for a synthetic document of ``scale`` units (None overrides ignored)."""
+    spec = {
+        'headings': scale * 4, 'paragraphs': scale * 8, 'lists': scale * 2,
+        'code_blocks': scale, 'tables': max(1, scale // 2), 'table_rows': 12, 'table_cols': 4,
+        'diagrams': max(1, scale // 5), 'svgs': max(1, scale // 10),
+    }
+    spec.update({key: value for key, value in overrides.items() if value is not None})
+    return spec
+
+
+def generate_markdown(headings: int = 4, paragraphs: int = 8, lists: int = 2,
+                      code_blocks: int = 1, tables: int = 1, table_rows: int = 12,
+                      table_cols: int = 4, diagrams: int = 0, svgs: int = 0) -> str:
+    """Synthetic Markdown with the given element counts, spread evenly through the document.
+    
+    Exercises every preprocessing rule (text right under headings, lists
+    glued to prose, checkboxes), code fences holding heading/list lookalikes,
+    pipe tables of ``table_rows`` x ``table_cols``, Mermaid blocks and SVG
+    references (about a quarter of them repeat an earlier SVG).
+    """
+    blocks = []
+    
+    def place(count: int, make, offset: float = 0.5):
+        for j in range(count):
+            blocks.append(((j + offset) / count, len(blocks), make(j)))
+    
+    place(headings, lambda j: f'{"#" * (j % 4 + 1)} Heading {j + 1}\nIntroduction to part {j + 1}.',
+          offset=0.0)
+    place(paragraphs, lambda j: f'Paragraph {j + 1}: ' + LOREM * 2 + '`inline code` and **bold**.')
+    place(lists, lambda j: f'Tasks {j + 1}:\n- [ ] open task\n- [x] done task\n* bullet\n'
+                           f'1. numbered\n2. numbered\nAfter the list.')
+    place(code_blocks, lambda j: f'```python\n# not a heading\n- not a list\nprint({j})\n```')
+    
+    def table(j: int) -> str:
+        header = '| ' + ' | '.join(f'Column {c + 1}' for c in range(table_cols)) + ' |'
+        rule = '|' + '---|' * table_cols
+        body = ['| ' + ' | '.join(f'r{r + 1}c{c + 1}' for c in range(table_cols)) + ' |'
+                for r in range(table_rows)]
+        return '\n'.join([f'Table {j + 1}:', '', header, rule] + body)
+    place(tables, table)
+    place(diagrams, lambda j: f'```mermaid\nflowchart LR\n    A{j} --> B{j}\n    B{j} --> C{j}\n```')
+    distinct_svgs = max(1, svgs * 3 // 4)
+    place(svgs, lambda j: f'![Figure {j + 1}](assets/figure-{j % distinct_svgs}.svg)')
+    
+    blocks.sort()
+    return '\n\n'.join(block for _, _, block in blocks) + '\n'
+
+
+def legacy_preprocess_markdown(content: str) -> str:
+    """The original two-pass preprocessor (reference for speed and output)."""
+    lines = content.split('\n')
+    result = []
+    prev_was_list = False
+    prev_was_blank = False
+    
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*\[[ xX]\]', stripped))
+        is_blank = not stripped
+        
+        if is_list and not prev_was_list and not prev_was_blank and result:
+            result.append('')
+        
+        if i > 0 and result:
+            prev_line = lines[i-1].strip()
+            if prev_line.startswith('#') and not is_blank:
+                if result[-1] != '':
+                    result.append('')
+        
+        if re.match(r'^[-*+]\s*\[[ ]\]', stripped):
+            line = re.sub(r'^([-*+])\s*\[ \]', r'\1 ☐', line)
+        elif re.match(r'^[-*+]\s*\[[xX]\]', stripped):
+            line = re.sub(r'^([-*+])\s*\[[xX]\]', r'\1 ☑', line)
+        
+        result.append(line)
+        prev_was_list = is_list
+        prev_was_blank = is_blank
+    
+    final = []
+    for i, line in enumerate(result):
+        final.append(line)
+        stripped = line.strip()
+        is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*[☐☑]', stripped))
+        
+        if is_list and i + 1 < len(result):
+            next_stripped = result[i + 1].strip()
+            next_is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*[☐☑]', next_stripped))
+            next_is_blank = not next_stripped
+            
+            if not next_is_list and not next_is_blank:
+                final.append('')
+    
+    return '\n'.join(final)
+
+
+def bench_preprocess(args) -> list[tuple[str, float, str]]:
+    """Two-pass vs streaming Markdown preprocessing, reported in MB/s.
+    
+    Output is compared on fence-free input (the only place the two may
+    legitimately differ is inside code fences, which the streaming version
+    leaves alone).
+    """
+    content = generate_markdown(**document_spec(args.scale * 10))
+    megabytes = len(content.encode('utf-8')) / 1e6
+    rows = []
+    for label, func in (('two-pass', legacy_preprocess_markdown),
+                        ('streaming', m.preprocess_markdown)):
+        elapsed, _ = best_of(args.repeat, lambda: content, func)
+        rows.append((f'preprocess[{label}]', elapsed, f'{megabytes / elapsed:.1f} MB/s'))
+    rows[1] = rows[1][:2] + (f'{rows[0][1] / rows[1][1]:.1f}x, {rows[1][2]}',)
+    
+    plain = generate_markdown(**document_spec(args.scale, code_blocks=0, diagrams=0))
+    if legacy_preprocess_markdown(plain) != m.preprocess_markdown(plain):
+        rows.append(('preprocess[identical-output]', 0.0, 'MISMATCH'))
+    if '# not a heading\n- not a list' not in m.preprocess_markdown(content):
+        rows.append(('preprocess[fences-untouched]', 0.0, 'MISMATCH'))
+    return rows
+
+
+def diagram_ref(idx: int) -> str:
+    return f'![Diagram {idx + 1}](images/diagram-{idx + 1}.png){{width=5.8in}}'
+
+
+def svg_ref(alt: str, path: str) -> str:
+    return f'![{alt}](images/{Path(path).stem}.png){{width=5.8in}}'
+
+
+def legacy_rewrite_assets(content: str) -> str:
+    """The original rewrite: str.replace per SVG match, then re.sub per diagram."""
+    count = len(m.find_mermaid_blocks(content))
+    for match in re.finditer(r'!\[([^\]]*)\]\(([^)]+\.svg)\)', content):
+        content = content.replace(match.group(0), svg_ref(*match.groups()))
+    for idx in range(count):
+        content = re.sub(r'```mermaid\r?\n.*?```', diagram_ref(idx), content, count=1, flags=re.DOTALL)
+    return content
+
+
+def rewrite_assets(content: str) -> str:
+    """The single-scan rewrite used by convert_file()."""
+    parts, diagrams, svgs = m.scan_assets(content)
+    for idx, (slot, _) in enumerate(diagrams):
+        parts[slot] = diagram_ref(idx)
+    for slot, alt, path in svgs:
+        parts[slot] = svg_ref(alt, path)
+    return ''.join(parts)
+
+
+def bench_assets(args) -> list[tuple[str, float, str]]:
+    """Mermaid/SVG reference rewriting as the diagram count grows."""
+    rows = []
+    for diagrams in (200, 400, 800):
+        content = generate_markdown(headings=diagrams, paragraphs=diagrams, lists=0, code_blocks=0,
+                                    tables=0, diagrams=diagrams, svgs=diagrams)
+        legacy, _ = best_of(args.repeat, lambda: content, legacy_rewrite_assets)
+        scan, _ = best_of(args.repeat, lambda: content, rewrite_assets)
+        rows.append((f'assets[legacy:{diagrams}]', legacy, ''))
+        rows.append((f'assets[one-scan:{diagrams}]', scan, f'{legacy / scan:.1f}x'))
+        if legacy_rewrite_assets(content) != rewrite_assets(content):
+            rows.append((f'assets[identical-output:{diagrams}]', 0.0, 'MISMATCH'))
+    return rows
+
+
+def bench_mermaid(args) -> list[tuple[str, float, str]]:
+    """Diagrams/second: one mmdc process per diagram vs the long-lived batch renderer."""
+    if shutil.which('mmdc') is None and m.find_mermaid_cli_package() is None:
+        return [('mermaid', 0.0, 'unavailable (no mermaid-cli)')]  # npx would download it per diagram
+    count = args.diagrams or max(4, args.scale // 5)
+    diagrams = [f'flowchart LR\n    A{i} --> B{i}\n    B{i} --> C{i}\n' for i in range(count)]
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        def render_all(render) -> int:
+            return sum(bool(render(mmd_content, Path(tmp) / f'diagram-{i + 1}.png'))
+                       for i, mmd_content in enumerate(diagrams))
+        
+        def batch(concurrency: int) -> int:
+            with m.MermaidBatchRenderer(concurrency) as renderer:
+                return render_all(renderer.render) if renderer.start() else -1
+        
+        rendered = []
+        cold, _ = best_of(args.repeat, lambda: None,
+                          lambda _: rendered.append(render_all(m.convert_mermaid_to_png)))
+        if rendered[-1] != count:
+            return [('mermaid[per-diagram-mmdc]', 0.0, 'unavailable (mmdc failed)')]
+        rows = [('mermaid[per-diagram-mmdc]', cold, f'{count / cold:.1f} diagrams/s')]
+        for concurrency in sorted({1, os.cpu_count() or 1}):
+            rendered.clear()
+            warm, _ = best_of(args.repeat, lambda: None, lambda _: rendered.append(batch(concurrency)))
+            if rendered[-1] < 0:
+                return rows + [(f'mermaid[batch:{concurrency}]', 0.0, 'unavailable (no mermaid-cli Node API)')]
+            rows.append((f'mermaid[batch:{concurrency}]', warm,
+                         f'{cold / warm:.1f}x, {count / warm:.1f} diagrams/s'
+                         if rendered[-1] == count else 'MISMATCH'))
+    return rows
+
+
+def bench_pandoc(args) -> list[tuple[str, float, str]]:
+    """Files/second converting small documents: cold pandoc CLI vs warm pandoc server."""
+    files = [generate_markdown(**document_spec(5, diagrams=0, svgs=0)) + f'\nDocument {i + 1}.\n'
+             for i in range(20)]
+    resource_path = Path.cwd()
+    
+    def convert_all(convert):
+        return [convert(markdown, resource_path) for markdown in files]
+    
+    cold, _ = best_of(args.repeat, lambda: None, lambda _: convert_all(m.run_pandoc))
+    rows = [('pandoc[cold-cli]', cold, f'{len(files) / cold:.1f} files/s')]
+    
+    with m.PandocServer(args.pandoc_server) as server:
+        if not server.start():
+            return rows + [('pandoc[warm-server]', 0.0, 'unavailable')]
+        warm, _ = best_of(args.repeat, lambda: None, lambda _: convert_all(server.convert))
+        rows.append(('pandoc[warm-server]', warm,
+                     f'{cold / warm:.1f}x, {len(files) / warm:.1f} files/s'))
+        
+        cold_doc = m.Document(io.BytesIO(m.run_pandoc(files[0], resource_path)))
+        warm_bytes = server.convert(files[0], resource_path)
+        if warm_bytes is None or body_xml(m.Document(io.BytesIO(warm_bytes))) != body_xml(cold_doc):
+            rows.append(('pandoc[identical-xml]', 0.0, 'MISMATCH'))
+    return rows
+
+
+LAZY_MODULES = ('docx', 'asyncio', 'PIL', 'urllib.request')  # must not load on import
+# Child process for bench_startup: imports md-to-word.py (argv[1]) and reports
+# which of argv[2:] actually executed (LazyLoader placeholders don't count)
+IMPORT_PROBE = r"""
+import importlib.util, json, sys
+spec = importlib.util.spec_from_file_location('md_to_word', sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(json.dumps([name for name in sys.argv[2:]
+                  if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule']))
+"""
+
+
+def bench_startup(args) -> list[tuple[str, float, str]]:
+    """Wall time of fresh md-to-word processes that do (almost) no work."""
+    script = str(Path(__file__).with_name('md-to-word.py'))
+    
+    def run(argv: list[str], cwd: Path | None = None) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, *argv], cwd=cwd, capture_output=True, text=True)
+    
+    def timed(argv: list[str], cwd: Path | None = None) -> float:
+        elapsed, _ = best_of(args.repeat, lambda: None, lambda _: run(argv, cwd))
+        return elapsed
+    
+    bare = timed(['-c', 'pass'])
+    rows = [('startup[python]', bare, 'bare interpreter')]
+    for label, argv in (('import', ['-c', IMPORT_PROBE, script]), ('help', [script, '--help'])):
+        elapsed = timed(argv)
+        rows.append((f'startup[{label}]', elapsed, f'+{(elapsed - bare) * 1000:.0f}ms over bare'))
+    
+    loaded = json.loads(run(['-c', IMPORT_PROBE, script, *LAZY_MODULES]).stdout)
+    if loaded:
+        rows.append((f'startup[eager:{",".join(loaded)}]', 0.0, 'MISMATCH'))
+    
+    if shutil.which('pandoc') is None:
+        return rows + [('startup[noop-incremental]', 0.0, 'unavailable (no pandoc)')]
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'doc.md'
+        source.write_text(generate_markdown(**document_spec(5, diagrams=0, svgs=0)), encoding='utf-8')
+        argv = [script, str(source), '--incremental', '--manifest', str(Path(tmp) / 'manifest.json')]
+        if run(argv).returncode != 0:
+            return rows + [('startup[noop-incremental]', 0.0, 'unavailable (conversion failed)')]
+        elapsed = timed(argv)
+        up_to_date = 'Up to date' in run(argv).stdout
+        rows.append(('startup[noop-incremental]', elapsed,
+                     f'+{(elapsed - bare) * 1000:.0f}ms over bare' if up_to_date else 'MISMATCH'))
+    return rows
+
+
+@contextmanager
+def stub_tools(calls: list | None = None):
+    """Replace mmdc and svgexport with in-process stubs that write a fixed PNG.
+    
+    With ``calls``, each source is appended to it and gets a PNG of its own
+    (sized from its hash), so distinct sources never share image bytes.
+    """
+    png = make_png(800, 600)
+    
+    def write_png(source, output_path, *_options) -> bool:
+        if calls is None:
+            Path(output_path).write_bytes(png)
+        else:
+            calls.append(source)
+            crc = zlib.crc32(str(source).encode('utf-8'))
+            Path(output_path).write_bytes(make_png(64 + crc % 251, 48 + (crc >> 8) % 241))
+        return True
+    
+    saved = m.convert_mermaid_to_png, m.convert_svg_to_png
+    m.convert_mermaid_to_png = m.convert_svg_to_png = write_png
+    try:
+        yield
+    finally:
+        m.convert_mermaid_to_png, m.convert_svg_to_png = saved
+
+
+def bench_stages(args) -> list[tuple[str, float, str]]:
+    """Each pipeline stage separately, plus convert_file() end to end (tools stubbed)."""
+    spec = document_spec(args.scale, headings=args.headings, paragraphs=args.paragraphs,
+                         lists=args.lists, code_blocks=args.code_blocks, tables=args.tables,
+                         diagrams=args.diagrams, svgs=args.svgs)
+    if args.table_size:
+        spec['table_rows'], spec['table_cols'] = args.table_size
+    markdown = generate_markdown(**spec)
+    have_pandoc = shutil.which('pandoc') is not None
+    rows = []
+    
+    def stage(name: str, setup, run, note: str = ''):
+        elapsed, _ = best_of(args.repeat, setup, run)
+        rows.append((f'stage[{name}]', elapsed, note))
+    
+    size = f'{len(markdown.encode("utf-8")) / 1e3:.0f} KB markdown'
+    stage('preprocess_markdown', lambda: markdown, m.preprocess_markdown, size)
+    preprocessed = m.preprocess_markdown(markdown)
+    stage('find_mermaid_blocks', lambda: preprocessed, m.find_mermaid_blocks,
+          f'{spec["diagrams"]} diagrams')
+    stage('substitution', lambda: preprocessed, rewrite_assets, f'{spec["svgs"]} SVG refs')
+    rewritten = rewrite_assets(preprocessed)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        images = workdir / 'images'
+        images.mkdir()
+        png = make_png(800, 600)
+        for ref in m.find_image_references(rewritten):
+            (workdir / ref).write_bytes(png)
+        
+        if have_pandoc:
+            stage('pandoc', lambda: rewritten, lambda text: m.run_pandoc(text, workdir))
+            fixture = m.run_pandoc(rewritten, workdir)
+        else:
+            fixture = generate_docx(args.scale)
+            rows.append(('stage[pandoc]', 0.0, 'skipped (pandoc not found): python-docx fixture'))
+        
+        def load():
+            return m.Document(io.BytesIO(fixture))
+        
+        stage('docx_load', lambda: fixture, lambda blob: m.Document(io.BytesIO(blob)),
+              f'{len(fixture) / 1e3:.0f} KB docx')
+        stage('apply_all_formatting', load, m.apply_all_formatting)
+        stage('apply_all_formatting:legacy', load,
+              lambda doc: m.apply_all_formatting(doc, engine='legacy'))
+        for formatter in (m.format_tables, m.center_images, m.format_headings,
+                          m.format_code_blocks, m.fix_paragraph_spacing):
+            stage(formatter.__name__, load, formatter)
+        
+        def formatted():
+            doc = load()
+            m.apply_all_formatting(doc)
+            return doc
+        stage('docx_save', formatted, lambda doc: doc.save(io.BytesIO()))
+        
+        if not have_pandoc:
+            rows.append(('stage[convert_file]', 0.0, 'skipped (pandoc not found)'))
+            return rows
+        
+        source = workdir / 'bench.md'
+        source.write_text(markdown, encoding='utf-8')
+        (workdir / 'assets').mkdir()
+        for ref in m.find_image_references(markdown):
+            (workdir / ref).write_text('<svg xmlns="http://www.w3.org/2000/svg"/>', encoding='utf-8')
+        
+        def fresh_pipeline():
+            shutil.rmtree(images, ignore_errors=True)
+            return m.RenderPipeline(use_cache=False, batch_render=False)
+        
+        def convert(pipeline):
+            with pipeline:
+                m.convert_file(source, workdir / 'bench.docx', pipeline, log=m.quiet)
+        
+        with stub_tools():
+            stage('convert_file', fresh_pipeline, convert, 'end to end, mmdc/svgexport stubbed')
+    return rows
+
+
+def bench_dedupe(args) -> list[tuple[str, float, str]]:
+    """A document repeating the same diagrams vs the same document with every copy made distinct."""
+    if shutil.which('pandoc') is None:
+        return [('dedupe', 0.0, 'unavailable (no pandoc)')]
+    figures, copies = 5, 8
+    
+    def document(distinct: bool) -> str:
+        sections = []
+        for copy in range(copies):
+            for figure in range(figures):
+                comment = f'    %% copy {copy}\n' if distinct else ''
+                sections.append(f'## Section {copy + 1}.{figure + 1}\n\nText.\n\n'
+                                f'```mermaid\nflowchart LR\n    A{figure} --> B{figure}\n{comment}```\n')
+        return '\n'.join(sections)
+    
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, content in (('distinct', document(True)), ('repeated', document(False))):
+            calls = []
+            
+            def convert(_):
+                shutil.rmtree(Path(tmp) / 'images', ignore_errors=True)
+                calls.clear()
+                with m.RenderPipeline(use_cache=False, batch_render=False) as pipeline:
+                    return m.render_docx(content, Path(tmp), pipeline, log=m.quiet)
+            
+            with stub_tools(calls):
+                elapsed, _ = best_of(args.repeat, lambda: None, convert)
+                docx_bytes, _ = convert(None)
+            with zipfile.ZipFile(io.BytesIO(docx_bytes)) as package:
+                media = sum(name.startswith('word/media/') for name in package.namelist())
+            rows.append((f'dedupe[{label}]', elapsed,
+                         f'{len(calls)} renders, {media} media parts, {len(docx_bytes) / 1024:.0f} KB'))
+            if label == 'repeated' and (len(calls), media) != (figures, figures):
+                rows.append(('dedupe[one-part-per-figure]', 0.0, 'MISMATCH'))
+    return rows
+
+
+def generate_image_docx(images: int) -> bytes:
+    """A short document carrying ``images`` distinct 400×300 screenshots-worth of media."""
+    doc = m.Document()
+    for i in range(images):
+        doc.add_heading(f'Figure {i + 1}', level=2)
+        doc.add_paragraph('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 2)
+        doc.add_picture(io.BytesIO(make_noise_png(400, 300, seed=i)))
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def peak_memory(run) -> int:
+    """Peak bytes allocated by Python while ``run()`` runs (tracemalloc, untimed)."""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_postprocess(args) -> list[tuple[str, float, str]]:
+    """python-docx load/format/save vs the streaming ZIP rewrite on an image-heavy docx."""
+    blob = generate_image_docx(max(args.scale, 8))
+    rows = []
+    outputs = {}
+    for engine in ('single-pass', 'streaming'):
+        elapsed, _ = best_of(args.repeat, lambda: None,
+                             lambda _: m.format_docx(blob, format_engine=engine))
+        peak = peak_memory(lambda: m.format_docx(blob, format_engine=engine))
+        output = m.format_docx(blob, format_engine=engine)
+        with zipfile.ZipFile(io.BytesIO(output)) as package:
+            outputs[engine] = package.read('word/document.xml')
+        rows.append((f'postprocess[{engine}]', elapsed,
+                     f'peak {peak / 2**20:.1f} MB, {len(output) / 2**20:.1f} MB out'))
+    baseline = rows[0][1]
+    rows = [(name, elapsed, f'{baseline / elapsed:.1f}x, {note}') for name, elapsed, note in rows]
+    if len(set(outputs.values())) != 1:
+        rows.append(('postprocess[identical-xml]', 0.0, 'MISMATCH'))
+    
+    for level in (0, 1, 6, 9):
+        elapsed, _ = best_of(args.repeat, lambda: None,
+                             lambda _: m.format_docx(blob, format_engine='streaming', compression=level))
+        size = len(m.format_docx(blob, format_engine='streaming', compression=level))
+        rows.append((f'postprocess[compression={level}]', elapsed, f'{size / 1024:.0f} KB'))
+    return rows
+
+
+def normalized_document(docx_bytes: bytes) -> bytes:
+    """document.xml with generated ids made comparable across conversions.
+    
+    Relationship ids become their target (media: a hash of the bytes) and
+    numeric ids (bookmarks, notes, drawings) their order of appearance, so
+    two conversions of the same Markdown compare equal however pandoc and
+    the shard merge numbered them.
+    """
+    package = zipfile.ZipFile(io.BytesIO(docx_bytes))
+    names = set(package.namelist())
+    targets = {}
+    for rel in etree.fromstring(package.read('word/_rels/document.xml.rels')):
+        target = rel.get('Target')
+        media = 'word/' + target
+        if rel.get('TargetMode') != 'External' and media in names:
+            target = m.hashlib.sha256(package.read(media)).hexdigest()
+        targets[rel.get('Id')] = target
+    root = etree.fromstring(package.read('word/document.xml'))
+    rel_attrs = [m.qn(attr) for attr in m.RELATIONSHIP_ATTRS]
+    id_attrs = (m.qn('w:id'), 'id')
+    order = {}
+    for element in root.iter():
+        for attr in rel_attrs:
+            if element.get(attr) in targets:
+                element.set(attr, targets[element.get(attr)])
+        for attr in id_attrs:
+            value = element.get(attr)
+            if value and value.isdigit() and int(value) > 0:
+                numbers = order.setdefault(element.tag, {})
+                element.set(attr, str(numbers.setdefault(value, len(numbers))))
+    return etree.tostring(root)
+
+
+def bench_shards(args) -> list[tuple[str, float, str]]:
+    """One-pass conversion vs sharded conversion at growing shard counts (tools stubbed)."""
+    if shutil.which('pandoc') is None:
+        return [('shards', 0.0, 'unavailable (no pandoc)')]
+    spec = document_spec(args.scale * 4, headings=args.headings, paragraphs=args.paragraphs,
+                         lists=args.lists, code_blocks=args.code_blocks, tables=args.tables,
+                         diagrams=args.diagrams, svgs=args.svgs)
+    markdown = generate_markdown(**spec)
+    cpus = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, cpus})  # 2 and 4 even on fewer cores, to check the merge
+    rows = []
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmp, stub_tools():
+        workdir = Path(tmp)
+        (workdir / 'assets').mkdir()
+        for ref in m.find_image_references(markdown):
+            (workdir / ref).write_text('<svg xmlns="http://www.w3.org/2000/svg"/>', encoding='utf-8')
+        for count in counts:
+            def convert(_):
+                with m.RenderPipeline(use_cache=False, batch_render=False, shards=count) as pipeline:
+                    return m.render_docx(markdown, workdir, pipeline, log=m.quiet)[0]
+            
+            elapsed, _ = best_of(args.repeat, lambda: None, convert)
+            outputs[count] = normalized_document(convert(None))
+            rows.append((f'shards[{count}]', elapsed, f'{len(markdown) / 1e6:.1f} MB markdown'))
+    baseline = rows[0][1]
+    rows = [(name, elapsed, f'{baseline / elapsed:.1f}x, {note}') for name, elapsed, note in rows]
+    for count, output in outputs.items():
+        if output != outputs[1]:
+            rows.append((f'shards[identical-xml:{count}]', 0.0, 'MISMATCH'))
+    return rows
+
+
+BENCHMARKS = {
+    'stages': bench_stages,
+    'format': bench_format,
+    'fragments': bench_fragments,
+    'tables': bench_tables,
+    'preprocess': bench_preprocess,
+    'assets': bench_assets,
+    'dedupe': bench_dedupe,
+    'shards': bench_shards,
+    'mermaid': bench_mermaid,
+    'postprocess': bench_postprocess,
+    'pandoc': bench_pandoc,
+    'startup': bench_startup,
+}
+
+
+def table_size(value: str) -> tuple[int, int]:
+    rows, _, cols = value.lower().partition('x')
+    try:
+        return int(rows), int(cols)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected ROWSxCOLS, got '{value}'")
+
+
+def write_results(path: Path, args, results: list[tuple[str, float, str]]):
+    """Save measurements in the format --compare reads."""
+    data = {
+        'tool': m.VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'results': {label: {'seconds': elapsed, 'note': note} for label, elapsed, note in results},
+    }
+    Path(path).write_text(json.dumps(data, indent=2), encoding='utf-8')
+
+
+NOISE_FLOOR = 0.001  # seconds; slowdowns smaller than this are timer noise, never regressions
+
+
+def compare_results(path: Path, results: list[tuple[str, float, str]], threshold: float) -> bool:
+    """Print the change against a saved run; True if anything regressed past ``threshold``."""
+    baseline = json.loads(Path(path).read_text(encoding='utf-8'))
+    before = baseline.get('results', {})
+    print(f"\nCompared with {path} (md-to-word {baseline.get('tool', '?')}, scale {baseline.get('scale', '?')})")
+    print(f"{'Benchmark':<36} {'Before':>10} {'After':>10}  Change")
+    regressed = False
+    for label, elapsed, _ in results:
+        old = before.get(label, {}).get('seconds', 0.0)
+        if not old or not elapsed:
+            continue
+        change = elapsed / old - 1
+        flag = ''
+        if change > threshold and elapsed - old > NOISE_FLOOR:
+            flag = '  REGRESSION'
+            regressed = True
+        print(f"{label:<36} {old * 1000:>8.1f}ms {elapsed * 1000:>8.1f}ms  {change:+.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark md-to-word.py stages')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f'Benchmarks to run (default: all of {", ".join(BENCHMARKS)})')
+    parser.add_argument('--scale', type=int, default=100,
+                        help='Document size in sections (default: 100)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is kept)')
+    parser.add_argument('--pandoc-server', default=None, metavar='URL',
+                        help='pandoc benchmark: use this server (default: launch one locally)')
+    
+    document = parser.add_argument_group('synthetic document (stages benchmark, --generate)')
+    for name in ('headings', 'paragraphs', 'lists', 'code-blocks', 'tables', 'diagrams', 'svgs'):
+        document.add_argument(f'--{name}', type=int, default=None, metavar='N',
+                              help=f'Number of {name.replace("-", " ")} (default: from --scale)')
+    document.add_argument('--table-size', type=table_size, default=None, metavar='RxC',
+                          help='Rows x columns per table (default: 12x4)')
+    document.add_argument('--generate', default=None, metavar='OUT.md',
+                          help='Write the synthetic Markdown to OUT.md and exit')
+    
+    results_group = parser.add_argument_group('results')
+    results_group.add_argument('--json', default=None, metavar='OUT.json', help='Save results as JSON')
+    results_group.add_argument('--compare', default=None, metavar='BASELINE.json',
+                               help='Compare with a saved run; exit 1 on regressions')
+    results_group.add_argument('--threshold', type=float, default=10,
+                               help='Regression threshold in percent (default: 10)')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    
+    if args.generate:
+        spec = document_spec(args.scale, headings=args.headings, paragraphs=args.paragraphs,
+                             lists=args.lists, code_blocks=args.code_blocks, tables=args.tables,
+                             diagrams=args.diagrams, svgs=args.svgs)
+        if args.table_size:
+            spec['table_rows'], spec['table_cols'] = args.table_size
+        Path(args.generate).write_text(generate_markdown(**spec), encoding='utf-8')
+        print(f"Wrote {args.generate}: " + ', '.join(f'{key}={value}' for key, value in spec.items()))
+        return
+    
+    failed = False
+    results = []
+    print(f"{'Benchmark':<36} {'Time':>10}  Note")
+    for name in args.benchmarks or BENCHMARKS:
+        for label, elapsed, note in BENCHMARKS[name](args):
+            failed |= note == 'MISMATCH'
+            results.append((label, elapsed, note))
+            print(f"{label:<36} {elapsed * 1000:>8.1f}ms  {note}")
+    
+    if args.json:
+        write_results(args.json, args, results)
+    if args.compare:
+        failed |= compare_results(args.compare, results, args.threshold / 100)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
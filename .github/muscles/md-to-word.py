@@ -1,47 +1,133 @@
 #!/usr/bin/env python3
 """
-md-to-word.py v2.1.0 - Convert Markdown with Mermaid diagrams to professional Word documents
+md-to-word.py v3.0.0 - Convert Markdown with Mermaid diagrams to professional Word documents
 
 Usage:
     python md-to-word.py SOURCE.md [OUTPUT.docx]
-    
+    python md-to-word.py SOURCE... [--output-dir DIR] [--jobs N]
+    python md-to-word.py --toolchain
+
 Examples:
     python md-to-word.py README.md
     python md-to-word.py docs/spec.md spec.docx
+    python md-to-word.py docs/ "specs/**/*.md" --output-dir out --jobs 8
+
+Library use (keeps caches, renderer and pandoc server warm between calls):
+    md_to_word = importlib.import_module('md-to-word')
+    with md_to_word.Converter(reference_doc='auto') as converter:
+        docx_bytes = converter.convert(Path('README.md'))
 
 Features:
     - Mermaid diagrams → PNG (90% page fit, preserves aspect ratio)
     - Table formatting: Microsoft blue headers, borders, alternating rows
     - Table pagination: prevents orphan headers, keeps rows together
-    - SVG banners → PNG for Word compatibility
+    - SVG banners → PNG for Word compatibility (or native SVG with --vector)
     - Markdown preprocessing: fixes bullet lists, checkboxes
 
 Requirements:
-    - pandoc (winget install pandoc)
+    - pandoc (winget install pandoc) [--pandoc-server needs the server build: pandoc-server, or pandoc 3 with `pandoc server`]
     - mermaid-cli (npm install -g @mermaid-js/mermaid-cli)
     - python-docx (pip install python-docx)
-    - svgexport (npm install -g svgexport) [optional, for SVG banners]
+    - svgexport (npm install -g svgexport) [optional, for SVG banners; with --vector only for their fallback PNG]
+    - Pillow (pip install Pillow) [optional, lets --image-dpi downsample images]
 """
 
+from __future__ import annotations
+
 import argparse
+import base64
+import copy
+import glob
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
 import os
+import posixpath
 import re
+import shutil
+import signal
+import socket
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import urllib.error
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager, redirect_stdout
+from functools import lru_cache, partial
 from pathlib import Path
 
-# Check for python-docx
-try:
-    from docx import Document
-    from docx.shared import Pt, RGBColor, Inches
-    from docx.oxml.ns import nsdecls, qn
-    from docx.oxml import parse_xml
-    from docx.enum.text import WD_ALIGN_PARAGRAPH
-except ImportError:
-    print("ERROR: python-docx not installed. Run: pip install python-docx")
-    sys.exit(1)
+
+def lazy_import(name: str):
+    """Module ``name``, executed on first attribute access instead of now."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# Only --serve (asyncio) and --pandoc-server (urllib.request) use these, and
+# together they take longer to import than everything else here
+asyncio = lazy_import('asyncio')
+lazy_import('urllib.request')
+
+# python-docx is imported by ensure_docx() when the first stage that edits a
+# docx runs, so --help, --toolchain and up-to-date --incremental runs skip it
+Document = Pt = RGBColor = Inches = nsdecls = qn = parse_xml = RT = etree = None
+WD_STYLE_TYPE = WD_ALIGN_PARAGRAPH = Table = Font = Paragraph = ParagraphFormat = Styles = None
+element_class_lookup = None
+
+
+def ensure_docx():
+    """Import python-docx into this module (once); ImportError with install hint if missing."""
+    global Document, Pt, RGBColor, Inches, nsdecls, qn, parse_xml, RT, etree
+    global WD_STYLE_TYPE, WD_ALIGN_PARAGRAPH, Table, Font, Paragraph, ParagraphFormat, Styles
+    global element_class_lookup
+    if element_class_lookup is not None:
+        return
+    try:
+        from lxml import etree
+        from docx import Document
+        from docx.shared import Pt, RGBColor, Inches
+        from docx.oxml.ns import nsdecls, qn
+        from docx.oxml import parse_xml
+        from docx.oxml.parser import element_class_lookup
+        from docx.styles.styles import Styles
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from docx.enum.style import WD_STYLE_TYPE
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+        from docx.table import Table
+        from docx.text.font import Font
+        from docx.text.paragraph import Paragraph
+        from docx.text.parfmt import ParagraphFormat
+    except ImportError as e:
+        raise ImportError("python-docx not installed. Run: pip install python-docx") from e
+
+
+@lru_cache(maxsize=None)
+def load_pillow():
+    """PIL.Image, imported on first use, or None without Pillow (optional: --image-dpi downsampling)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+VERSION = '3.0.0'  # Keep in sync with the module docstring; part of build manifests
 
 # Page Layout Constants (Letter: 8.5" x 11", 1" margins)
 PAGE_WIDTH_INCHES = 6.5   # Usable width (8.5" - 1" margins each side)
@@ -50,6 +136,13 @@ MAX_IMAGE_RATIO = 0.90    # 90% of page max
 MAX_IMAGE_WIDTH = PAGE_WIDTH_INCHES * MAX_IMAGE_RATIO   # ~5.85"
 MAX_IMAGE_HEIGHT = PAGE_HEIGHT_INCHES * MAX_IMAGE_RATIO # ~8.1"
 PNG_DPI = 96  # Standard screen DPI for mermaid-cli output
+SVG_DISPLAY_WIDTH = 5.8   # SVG banners are shown at 5.8" (90% max width)
+SVG_EXPORT_WIDTH = 800    # svgexport output width in pixels unless --image-dpi sets it
+
+# Mermaid rendering
+MMDC_OPTIONS = '-b white'  # Part of the render cache key - change both together
+CACHE_MAX_MB = 200         # Default render cache size cap (LRU eviction beyond this)
+MANIFEST_NAME = '.md-to-word-manifest.json'  # Default incremental build manifest
 
 
 def get_png_dimensions(png_path: Path) -> tuple[int, int]:
@@ -71,21 +164,45 @@ def get_png_dimensions(png_path: Path) -> tuple[int, int]:
     return 0, 0
 
 
-def calculate_optimal_size(png_path: Path, mmd_content: str) -> str:
-    """Calculate optimal image size to fit 90% of page both horizontally and vertically.
-    
-    Reads actual PNG dimensions and scales to fit within:
-    - Max width: 5.85" (90% of 6.5" usable width)
-    - Max height: 8.1" (90% of 9" usable height)
+SVG_ROOT_RE = re.compile(r'<svg\b[^>]*>', re.IGNORECASE)
+SVG_VIEWBOX_RE = re.compile(r'\sviewBox\s*=\s*["\'][^"\']*?([\d.]+)[\s,]+([\d.]+)\s*["\']')
+SVG_LENGTH_RE = re.compile(r'\s(width|height)\s*=\s*["\']\s*([\d.]+)\s*(?:px)?\s*["\']')
+
+
+def get_svg_dimensions(svg_path: Path) -> tuple[int, int]:
+    """Read SVG dimensions from the root element's viewBox (else its px width/height).
     
-    Only specifies ONE dimension (width OR height) - pandoc preserves aspect ratio.
+    SVG user units are CSS pixels, so the result is on the same 96 DPI scale
+    as mermaid-cli's PNGs. Returns (width, height), or (0, 0) if failed.
     """
-    width_px, height_px = get_png_dimensions(png_path)
-    
-    if width_px == 0 or height_px == 0:
-        # Fallback to heuristic-based sizing if PNG read fails
-        return determine_image_size_heuristic(mmd_content)
-    
+    try:
+        text = Path(svg_path).read_text(encoding='utf-8', errors='replace')
+    except OSError:
+        return 0, 0
+    root = SVG_ROOT_RE.search(text)
+    if root is None:
+        return 0, 0
+    viewbox = SVG_VIEWBOX_RE.search(root.group(0))
+    if viewbox:
+        width, height = viewbox.groups()
+    else:
+        lengths = dict(SVG_LENGTH_RE.findall(root.group(0)))  # percentages etc. don't match
+        width, height = lengths.get('width', '0'), lengths.get('height', '0')
+    try:
+        return round(float(width)), round(float(height))
+    except ValueError:
+        return 0, 0
+
+
+def get_image_dimensions(image_path: Path) -> tuple[int, int]:
+    """Pixel dimensions of a PNG or SVG image, or (0, 0) if failed."""
+    if Path(image_path).suffix.lower() == '.svg':
+        return get_svg_dimensions(image_path)
+    return get_png_dimensions(image_path)
+
+
+def fit_to_page(width_px: int, height_px: int) -> tuple[float, float]:
+    """Display size in inches of a ``PNG_DPI`` image scaled to fit 90% of the page (never upscaled)."""
     # Convert pixels to inches (mermaid-cli uses 96 DPI)
     width_in = width_px / PNG_DPI
     height_in = height_px / PNG_DPI
@@ -96,21 +213,46 @@ def calculate_optimal_size(png_path: Path, mmd_content: str) -> str:
     
     # Use the smaller scale factor (most constraining)
     scale = min(width_scale, height_scale, 1.0)  # Never upscale
+    return width_in * scale, height_in * scale
+
+
+def calculate_optimal_size(png_path: Path, mmd_content: str,
+                           dimensions: tuple[int, int] | None = None,
+                           both_dimensions: bool = False) -> str:
+    """Calculate optimal image size to fit 90% of page both horizontally and vertically.
+    
+    Reads actual PNG dimensions and scales to fit within:
+    - Max width: 5.85" (90% of 6.5" usable width)
+    - Max height: 8.1" (90% of 9" usable height)
+    
+    Only specifies ONE dimension (width OR height) - pandoc preserves aspect ratio.
+    Pass known ``dimensions`` (e.g. from the render cache) to skip the header read.
+    With ``both_dimensions`` the other side is given too, for SVGs whose own
+    size pandoc can't use (mermaid-cli writes width="100%").
+    """
+    width_px, height_px = dimensions or get_image_dimensions(png_path)
+    
+    if width_px == 0 or height_px == 0:
+        # Fallback to heuristic-based sizing if PNG read fails
+        return determine_image_size_heuristic(mmd_content)
     
-    # Calculate target dimensions
-    target_width = width_in * scale
-    target_height = height_in * scale
+    target_width, target_height = fit_to_page(width_px, height_px)
     
     # Determine which dimension to specify based on aspect ratio
     # For wide images, specify width; for tall images, specify height
-    aspect_ratio = width_in / height_in if height_in > 0 else 1
+    aspect_ratio = width_px / height_px
     
     if aspect_ratio >= 1.0:
         # Wide or square: constrain by width
-        return f'{{width={target_width:.1f}in}}'
+        size = f'width={target_width:.1f}in'
+        if both_dimensions:
+            size += f' height={round(target_width, 1) / aspect_ratio:.2f}in'
     else:
         # Tall: constrain by height (ensures it fits on page)
-        return f'{{height={target_height:.1f}in}}'
+        size = f'height={target_height:.1f}in'
+        if both_dimensions:
+            size = f'width={round(target_height, 1) * aspect_ratio:.2f}in {size}'
+    return f'{{{size}}}'
 
 
 def determine_image_size_heuristic(mmd_content: str) -> str:
@@ -131,49 +273,817 @@ def determine_image_size_heuristic(mmd_content: str) -> str:
     return '{width=5in}'
 
 
+MERMAID_BLOCK_RE = re.compile(r'```mermaid\r?\n(.*?)```', re.DOTALL)
+# Mermaid fences and SVG image references, found together in one scan
+ASSET_RE = re.compile(
+    r'```mermaid\r?\n(?P<mermaid>.*?)```'
+    r'|!\[(?P<alt>[^\]]*)\]\((?P<svg>[^)]+\.svg)\)',
+    re.DOTALL,
+)
+
+
 def find_mermaid_blocks(content: str) -> list[tuple[int, str]]:
     """Find all mermaid code blocks and return (index, content) tuples."""
-    pattern = r'```mermaid\r?\n(.*?)```'
-    matches = list(re.finditer(pattern, content, re.DOTALL))
-    return [(i, m.group(1)) for i, m in enumerate(matches)]
+    return [(i, m.group(1)) for i, m in enumerate(MERMAID_BLOCK_RE.finditer(content))]
+
+
+def scan_assets(content: str) -> tuple[list[str], list[tuple[int, str]], list[tuple[int, str, str]]]:
+    """Split ``content`` at mermaid blocks and SVG references in a single scan.
+    
+    Returns (parts, diagrams, svgs): ``parts`` alternates literal text with
+    the matched asset text, ``diagrams`` holds (part index, mermaid source)
+    and ``svgs`` (part index, alt text, SVG path). Assigning replacements to
+    those part slots and joining ``parts`` rewrites the document in one go.
+    """
+    parts = []
+    diagrams = []
+    svgs = []
+    pos = 0
+    for match in ASSET_RE.finditer(content):
+        parts.append(content[pos:match.start()])
+        if match.group('svg') is None:
+            diagrams.append((len(parts), match.group('mermaid')))
+        else:
+            svgs.append((len(parts), match.group('alt'), match.group('svg')))
+        parts.append(match.group(0))
+        pos = match.end()
+    parts.append(content[pos:])
+    return parts, diagrams, svgs
+
+
+def diagram_names(diagram_slots: list[tuple[int, str]], suffix: str = '.png') -> list[str]:
+    """Image file name for each diagram of :func:`scan_assets`: ``diagram-N`` by position,
+    except that a repeated diagram gets the name of its first occurrence, so it
+    is rendered once and pandoc embeds one media part for all of them.
+    """
+    first = {}
+    return [first.setdefault(mmd_content, f'diagram-{idx + 1}{suffix}')
+            for idx, (_, mmd_content) in enumerate(diagram_slots)]
+
+
+TOOL_TIMEOUTS = {      # seconds before a tool (and everything it started) is killed
+    'mermaid': 120,    # mmdc, incl. its Chromium
+    'svgexport': 60,
+    'pandoc': 300,
+    'probe': 30,       # --version / npm root queries
+}
+TOOL_OUTPUT_LIMIT = 1024 * 1024  # bytes of stderr (and non-payload stdout) kept per call
+TOOL_TIMED_OUT = 124             # returncode reported for a killed tool (as coreutils timeout does)
+NPM_TOOLS = ('mmdc', 'svgexport')
+NPM_PACKAGE_TOOLS = {'@mermaid-js/mermaid-cli': 'mmdc', 'svgexport': 'svgexport'}  # package → its binary
+# New session/process group per tool, so a timeout kills its children too
+TOOL_PROCESS_GROUP = ({'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt'
+                      else {'start_new_session': True})
+
+
+@lru_cache(maxsize=None)
+def resolve_tool(program: str) -> tuple[str, ...]:
+    """Command prefix that runs ``program``, resolved once per process.
+    
+    npm tools are taken from ./node_modules/.bin, then PATH, then the copy
+    an earlier ``npx`` run left in npm's cache, and only then run through
+    ``npx`` (which resolves the package again on every call).
+    """
+    if program in NPM_TOOLS:
+        local = shutil.which(program, path=str(Path.cwd() / 'node_modules' / '.bin'))
+        if local:
+            return (local,)
+    found = shutil.which(program)
+    if found:
+        return (found,)
+    if program in NPM_TOOLS:
+        cached = find_npx_cached(program)
+        if cached:
+            return (cached,)
+        return (shutil.which('npx') or 'npx', program)
+    return (program,)
+
+
+def npm_cache_dir() -> Path:
+    """npm's cache folder ($npm_config_cache, else npm's per-platform default)."""
+    if os.environ.get('npm_config_cache'):
+        return Path(os.environ['npm_config_cache'])
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        return Path(os.environ['LOCALAPPDATA']) / 'npm-cache'
+    return Path.home() / '.npm'
+
+
+def find_npx_cached(program: str) -> str | None:
+    """``program`` as installed by a previous ``npx`` run (newest if several), or None."""
+    bins = glob.glob(str(npm_cache_dir() / '_npx' / '*' / 'node_modules' / '.bin'))
+    found = [path for path in (shutil.which(program, path=directory) for directory in bins) if path]
+    return max(found, key=os.path.getmtime) if found else None
+
+
+def kill_process_group(pid: int):
+    """Kill a tool started with ``TOOL_PROCESS_GROUP`` and everything it started."""
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+
+
+def read_capped(stream, limit: int | None, chunks: list):
+    """Drain ``stream`` to EOF, keeping at most ``limit`` bytes (all with None) in ``chunks``."""
+    kept = 0
+    while data := stream.read1(65536):
+        if limit is None:
+            chunks.append(data)
+        elif kept < limit:
+            chunks.append(data[:limit - kept])
+            kept += len(chunks[-1])
+    stream.close()
+
+
+def write_input(stream, data: bytes):
+    try:
+        stream.write(data)
+        stream.close()
+    except OSError:
+        pass  # tool exited without reading everything; its returncode tells
+
+
+def run_tool(program: str, args: list, input: bytes | None = None, timeout: float | None = None,
+             stdout_limit: int | None = TOOL_OUTPUT_LIMIT) -> subprocess.CompletedProcess:
+    """Run ``program`` (see :func:`resolve_tool`) with ``args`` - no shell, no quoting.
+    
+    The tool is killed with its whole process group after ``timeout``
+    seconds (returncode ``TOOL_TIMED_OUT``); a missing binary gives
+    returncode 127. stderr is capped at ``TOOL_OUTPUT_LIMIT`` bytes and
+    stdout at ``stdout_limit`` (None for payloads like pandoc's docx).
+    Returns a CompletedProcess with bytes output.
+    """
+    argv = [*resolve_tool(program), *map(str, args)]
+    try:
+        proc = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **TOOL_PROCESS_GROUP
+        )
+    except OSError as e:
+        return subprocess.CompletedProcess(argv, 127, b'', str(e).encode('utf-8'))
+    stdout, stderr = [], []
+    threads = [threading.Thread(target=read_capped, args=(proc.stdout, stdout_limit, stdout), daemon=True),
+               threading.Thread(target=read_capped, args=(proc.stderr, TOOL_OUTPUT_LIMIT, stderr), daemon=True)]
+    if input is not None:
+        threads.append(threading.Thread(target=write_input, args=(proc.stdin, input), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(proc.pid)
+        proc.wait()
+        returncode = TOOL_TIMED_OUT
+    for thread in threads:
+        thread.join(timeout=5)  # an orphaned grandchild may still hold a pipe
+    if returncode == TOOL_TIMED_OUT:
+        stderr.append(f'{program} timed out after {timeout}s'.encode('utf-8'))
+    return subprocess.CompletedProcess(argv, returncode, b''.join(stdout), b''.join(stderr))
+
+
+def mmdc_args(input_path: Path, output_path: Path) -> list[str]:
+    """mmdc arguments for one render (format follows ``output_path``'s suffix)."""
+    return ['-i', str(input_path), '-o', str(output_path), *MMDC_OPTIONS.split()]
+
+
+def svgexport_args(svg_path: Path, png_path: Path, width: int = SVG_EXPORT_WIDTH) -> list[str]:
+    """svgexport arguments for one conversion ``width`` pixels wide."""
+    return [str(svg_path), str(png_path), f'{width}:']
+
+
+def pandoc_args(resource_path: Path, reference_doc: Path | None = None) -> list[str]:
+    """pandoc arguments for markdown (stdin) → docx (stdout)."""
+    args = ['--from', 'markdown', '--to', 'docx', f'--resource-path={resource_path}']
+    if reference_doc:
+        args += [f'--reference-doc={reference_doc}', '--no-highlight']
+    return args + ['-o', '-']
 
 
 def convert_mermaid_to_png(mmd_content: str, output_path: Path) -> bool:
-    """Convert mermaid content to PNG using mmdc."""
+    """Convert mermaid content to PNG using mmdc (SVG if ``output_path`` ends in .svg)."""
     with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False, encoding='utf-8') as f:
         f.write(mmd_content)
         temp_mmd = f.name
     
     try:
-        result = subprocess.run(
-            f'npx mmdc -i "{temp_mmd}" -o "{output_path}" -b white',
-            capture_output=True,
-            text=True,
-            shell=True
-        )
+        result = run_tool('mmdc', mmdc_args(temp_mmd, output_path), timeout=TOOL_TIMEOUTS['mermaid'])
         return result.returncode == 0
     finally:
         os.unlink(temp_mmd)
 
 
-def convert_svg_to_png(svg_path: Path, png_path: Path) -> bool:
-    """Convert SVG to PNG using svgexport."""
+def probe_output(program: str, args: list) -> str | None:
+    """Stripped stdout of a quick query like ``--version``, or None if it failed."""
+    result = run_tool(program, args, timeout=TOOL_TIMEOUTS['probe'])
+    output = result.stdout.decode('utf-8', 'replace').strip()
+    return output if result.returncode == 0 and output else None
+
+
+@lru_cache(maxsize=None)
+def find_npm_package(name: str) -> Path | None:
+    """Locate an npm package (project-local first, then global; the global root is probed once)."""
+    candidates = [Path.cwd() / 'node_modules']
+    npm = resolve_tool('npm')
+    global_root = toolchain.probe('npm root -g', npm, lambda: probe_output('npm', ['root', '-g']))
+    if global_root:
+        candidates.append(Path(global_root))
+    # A package run through npx sits in its npx cache entry's node_modules
+    cached = find_npx_cached(NPM_PACKAGE_TOOLS.get(name, ''))
+    if cached:
+        candidates.append(Path(cached).parent.parent)
+    for node_modules in candidates:
+        package_dir = node_modules / name
+        if (package_dir / 'package.json').exists():
+            return package_dir
+    return None
+
+
+def find_mermaid_cli_package() -> Path | None:
+    """Locate the @mermaid-js/mermaid-cli package (project-local first, then global)."""
+    return find_npm_package('@mermaid-js/mermaid-cli')
+
+
+def npm_package_version(name: str) -> str | None:
+    """``version`` from an installed npm package's package.json, or None."""
+    package_dir = find_npm_package(name)
+    if package_dir:
+        try:
+            package = json.loads((package_dir / 'package.json').read_text(encoding='utf-8'))
+            return package['version']
+        except (OSError, ValueError, KeyError):
+            pass
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_mermaid_cli_version() -> str:
+    """Return the mermaid-cli version (probed once per mmdc install), or 'unknown'."""
+    version = npm_package_version('@mermaid-js/mermaid-cli')
+    if version is None:
+        version = toolchain.probe('mmdc --version', resolve_tool('mmdc'),
+                                  lambda: probe_output('mmdc', ['--version']))
+    return version or 'unknown'
+
+
+# Node worker for MermaidBatchRenderer: launches one browser, then renders each
+# JSON-lines request {id, definition, output} through mermaid-cli's renderMermaid()
+# and answers {id, ok, error}, possibly out of order when argv[3] (concurrency) > 1.
+# Options mirror the mmdc CLI defaults + MMDC_OPTIONS.
+MERMAID_WORKER_JS = r"""
+const path = require('path');
+const fs = require('fs');
+const readline = require('readline');
+const { createRequire } = require('module');
+const { pathToFileURL } = require('url');
+
+const send = (msg) => process.stdout.write(JSON.stringify(msg) + '\n');
+
+function entryPoint(pkg) {
+  let entry = pkg.exports ?? pkg.main ?? 'src/index.js';
+  if (typeof entry === 'object') entry = entry['.'] ?? entry;
+  if (typeof entry === 'object') entry = entry.import ?? entry.default;
+  return entry;
+}
+
+(async () => {
+  const cliDir = process.argv[2];
+  let browser;
+  let renderMermaid;
+  try {
+    const pkg = JSON.parse(fs.readFileSync(path.join(cliDir, 'package.json'), 'utf8'));
+    ({ renderMermaid } = await import(pathToFileURL(path.join(cliDir, entryPoint(pkg))).href));
+    if (typeof renderMermaid !== 'function') throw new Error('renderMermaid() not exported');
+    const requireFromCli = createRequire(path.join(cliDir, 'package.json'));
+    const puppeteer = (await import(pathToFileURL(requireFromCli.resolve('puppeteer')).href)).default;
+    browser = await puppeteer.launch({ headless: true });
+  } catch (err) {
+    send({ ready: false, error: String(err && err.message || err) });
+    process.exit(1);
+  }
+  send({ ready: true });
+  
+  // Render up to `limit` diagrams at once, each in its own page
+  const limit = Math.max(1, parseInt(process.argv[3] || '1', 10));
+  const queue = [];
+  let active = 0;
+  let drained = () => {};
+  const render = async (req) => {
+    try {
+      const { data } = await renderMermaid(browser, req.definition, req.format || 'png', {
+        viewport: { width: 800, height: 600, deviceScaleFactor: 1 },
+        backgroundColor: 'white',
+        mermaidConfig: { theme: 'default' },
+      });
+      fs.writeFileSync(req.output, data);
+      send({ id: req.id, ok: true });
+    } catch (err) {
+      send({ id: req.id, ok: false, error: String(err && err.message || err) });
+    }
+  };
+  const pump = () => {
+    while (active < limit && queue.length) {
+      active++;
+      render(queue.shift()).finally(() => { active--; pump(); });
+    }
+    if (!active && !queue.length) drained();
+  };
+  
+  const lines = readline.createInterface({ input: process.stdin });
+  for await (const line of lines) {
+    if (!line.trim()) continue;
+    queue.push(JSON.parse(line));
+    pump();
+  }
+  if (active || queue.length) await new Promise((resolve) => { drained = resolve; });
+  await browser.close();
+})();
+"""
+
+
+class MermaidBatchRenderer:
+    """Render many diagrams through one long-lived Node/Puppeteer worker.
+    
+    ``npx mmdc`` pays npx resolution, Node startup and a Chromium launch for
+    every diagram. The worker pays them once and renders each diagram in a new
+    page of the same browser (up to ``concurrency`` pages at a time), talking
+    JSON lines over stdin/stdout. The worker is started lazily on the first
+    ``render()``; if mermaid-cli's Node API is unavailable (or the worker dies)
+    ``render()`` falls back to the per-diagram :func:`convert_mermaid_to_png`.
+    If the worker isn't ready within ``TOOL_TIMEOUTS['mermaid']``, or a render
+    takes longer than that, the worker (and its browser) is killed and
+    ``render()`` falls back the same way.
+    ``render()`` may be called from several threads at once.
+    """
+    
+    def __init__(self, concurrency: int = 1):
+        self.concurrency = max(1, concurrency)
+        self._proc = None
+        self._script = None
+        self._reader = None
+        self._next_id = 0
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self.available = None  # None = not started yet
+    
+    def start(self) -> bool:
+        """Launch the worker; return True once its browser is ready."""
+        with self._lock:
+            if self.available is None:
+                self.available = self._launch()
+            return self.available
+    
+    def _launch(self) -> bool:
+        package_dir = find_mermaid_cli_package()
+        if package_dir is None or shutil.which('node') is None:
+            return False
+        
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.cjs', delete=False, encoding='utf-8') as f:
+            f.write(MERMAID_WORKER_JS)
+            self._script = f.name
+        try:
+            self._proc = subprocess.Popen(
+                ['node', self._script, str(package_dir), str(self.concurrency)],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                encoding='utf-8',
+                **TOOL_PROCESS_GROUP
+            )
+            status = json.loads(self._ready_line(self._proc) or '{}')
+        except FutureTimeoutError:  # before OSError: TimeoutError subclasses it on 3.11+
+            # Browser never came up: kill the worker so _shutdown doesn't wait on it
+            kill_process_group(self._proc.pid)
+            status = {}
+        except (OSError, ValueError):
+            status = {}
+        if not status.get('ready'):
+            self._shutdown()
+            return False
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+        return True
+    
+    @staticmethod
+    def _ready_line(proc) -> str:
+        """The worker's first line, waiting at most ``TOOL_TIMEOUTS['mermaid']`` (FutureTimeoutError after)."""
+        line = Future()
+        
+        def read():
+            try:
+                line.set_result(proc.stdout.readline())
+            except (OSError, ValueError) as e:
+                line.set_exception(e)
+        
+        threading.Thread(target=read, daemon=True).start()
+        return line.result(timeout=TOOL_TIMEOUTS['mermaid'])
+    
+    def _read_replies(self):
+        """Resolve pending requests as replies arrive; fail the rest on worker exit."""
+        for line in self._proc.stdout:
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                continue
+            with self._lock:
+                future = self._pending.pop(reply.get('id'), None)
+            if future is not None:
+                future.set_result(bool(reply.get('ok')))
+        with self._lock:
+            self.available = False
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_result(None)  # None = worker lost, use fallback
+    
+    def render(self, mmd_content: str, output_path: Path) -> bool:
+        """Render one diagram to ``output_path`` (worker first, mmdc fallback)."""
+        if self.start():
+            future = Future()
+            with self._lock:
+                self._next_id += 1
+                request_id = self._next_id
+                request = {'id': request_id, 'definition': mmd_content,
+                           'output': str(Path(output_path).resolve()),
+                           'format': 'svg' if Path(output_path).suffix == '.svg' else 'png'}
+                try:
+                    if not self.available:
+                        raise OSError('renderer worker exited')
+                    self._pending[request_id] = future
+                    self._proc.stdin.write(json.dumps(request) + '\n')
+                    self._proc.stdin.flush()
+                except (OSError, ValueError):
+                    self._pending.pop(request_id, None)
+                    future.set_result(None)
+            try:
+                ok = future.result(timeout=TOOL_TIMEOUTS['mermaid'])
+            except FutureTimeoutError:
+                # Hung browser: kill the worker (its reader fails the other
+                # pending renders over to mmdc) and retry this one with mmdc
+                self._kill()
+                ok = None
+            if ok is not None:
+                return ok
+        return convert_mermaid_to_png(mmd_content, output_path)
+    
+    def close(self):
+        """Shut the worker (and its browser) down."""
+        self._shutdown()
+        if self._reader is not None:
+            self._reader.join(timeout=10)
+            self._reader = None
+    
+    def _kill(self):
+        with self._lock:
+            self.available = False
+            if self._proc is not None:
+                kill_process_group(self._proc.pid)
+    
+    def _shutdown(self):
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+                self._proc.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                kill_process_group(self._proc.pid)
+                self._proc.wait()
+            self._proc = None
+        if self._script:
+            Path(self._script).unlink(missing_ok=True)
+            self._script = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def default_cache_dir() -> Path:
+    """Per-user cache location (LOCALAPPDATA on Windows, XDG cache elsewhere)."""
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME')
+    return (Path(base) if base else Path.home() / '.cache') / 'md-to-word'
+
+
+TOOLCHAIN_NAME = 'toolchain.json'
+TOOLCHAIN_NPX_TTL = 24 * 3600  # seconds an answer from a tool run through npx is reused
+
+
+def file_stamp(path: str) -> list[int] | None:
+    """[size, mtime_ns] of ``path``, or None if it can't be stat'ed."""
     try:
-        result = subprocess.run(
-            f'npx svgexport "{svg_path}" "{png_path}" 800:',
-            capture_output=True,
-            text=True,
-            shell=True
-        )
-        return result.returncode == 0
-    except FileNotFoundError:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Toolchain:
+    """Tool probe results (versions, npm's global root) kept across runs in ``toolchain.json``.
+    
+    Finding a tool is a few PATH lookups, but asking it anything starts a
+    process - ``mmdc --version`` boots Node, ``npm root -g`` boots npm -
+    which used to happen on every run before any work. Each answer is stored
+    with the path, size and mtime of the binary that gave it and probed
+    again only when that binary changes. Which package ``npx`` runs can
+    change without npx changing, so answers from tools run through npx
+    also expire after ``TOOLCHAIN_NPX_TTL``.
+    """
+    
+    def __init__(self, cache_dir: Path | None = None):
+        self.path = Path(cache_dir or default_cache_dir()) / TOOLCHAIN_NAME
+        self._lock = threading.Lock()
+        self._entries = None
+    
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                data = json.loads(self.path.read_text(encoding='utf-8'))
+                self._entries = data['entries'] if data.get('version') == 1 else {}
+            except (OSError, ValueError, KeyError, AttributeError):
+                self._entries = {}
+        return self._entries
+    
+    def probe(self, name: str, command: tuple[str, ...], run) -> str | None:
+        """``run()`` for the tool ``command`` runs, reusing the stored answer while its binary is unchanged.
+        
+        ``run`` returns None on failure; failures are never stored.
+        """
+        binary, args = command[0], list(command[1:])
+        npx = len(command) == 2 and Path(binary).stem == 'npx'
+        stamp = file_stamp(binary) if (len(command) == 1 or npx) and os.path.isabs(binary) else None
+        if stamp is not None:
+            with self._lock:
+                entry = self._load().get(name)
+            if (entry and entry.get('binary') == binary and entry.get('args', []) == args
+                    and entry.get('stamp') == stamp and time.time() < entry.get('expires', float('inf'))):
+                return entry['value']
+        value = run()
+        if stamp is not None and value is not None:
+            entry = {'binary': binary, 'stamp': stamp, 'value': value}
+            if npx:
+                entry.update(args=args, expires=time.time() + TOOLCHAIN_NPX_TTL)
+            with self._lock:
+                self._load()[name] = entry
+                try:
+                    write_atomic(self.path, json.dumps({'version': 1, 'entries': self._entries},
+                                                       indent=1).encode('utf-8'))
+                except OSError:
+                    pass  # read-only cache: probe again next run
+        return value
+    
+    def summary(self) -> list[tuple[str, str, str]]:
+        """(tool, version, command) for each external tool, as conversions will run it."""
+        rows = []
+        for tool, version in (('pandoc', get_pandoc_version),
+                              ('mmdc', get_mermaid_cli_version),
+                              ('svgexport', lambda: npm_package_version('svgexport') or 'unknown')):
+            command = resolve_tool(tool)
+            found = shutil.which(command[0]) is not None
+            rows.append((tool, version() if found else 'not found', ' '.join(command)))
+        return rows
+
+
+toolchain = Toolchain()
+
+
+def diagram_cache_key(mmd_content: str, options: str = MMDC_OPTIONS,
+                      version: str | None = None) -> str:
+    """Content address of a rendered diagram: source + mmdc options + mmdc version."""
+    if version is None:
+        version = get_mermaid_cli_version()
+    digest = hashlib.sha256()
+    for part in (mmd_content, options, version):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Persistent content-addressed cache of rendered Mermaid PNGs (and SVGs).
+    
+    Each entry stores the image plus its pixel dimensions, so a hit needs neither
+    mmdc nor a header read. ``index.json`` tracks entry sizes and last access;
+    the least recently used entries are evicted once ``max_bytes`` is exceeded.
+    """
+    
+    INDEX_NAME = 'index.json'
+    
+    def __init__(self, cache_dir: Path, max_bytes: int = CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.cache_dir / self.INDEX_NAME
+        self._entries = self._load_index()
+        self._dirty = False
+        self._lock = threading.Lock()
+    
+    def _load_index(self) -> dict:
+        try:
+            data = json.loads(self._index_path.read_text(encoding='utf-8'))
+            return data.get('entries', {})
+        except (OSError, ValueError, AttributeError):
+            return {}  # Missing or corrupt index - start fresh
+    
+    def _entry_path(self, key: str, suffix: str = '.png') -> Path:
+        return self.cache_dir / f'{key}{suffix}'
+    
+    def get(self, key: str, dest: Path) -> tuple[int, int] | None:
+        """Copy a cached render to ``dest``; return its (width, height) or None on miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            try:
+                shutil.copyfile(self._entry_path(key, entry.get('suffix', '.png')), dest)
+            except OSError:
+                # Index points at a file that is gone - forget it
+                del self._entries[key]
+                self._dirty = True
+                return None
+            entry['atime'] = time.time()
+            self._dirty = True
+            return entry['width'], entry['height']
+    
+    def put(self, key: str, png_path: Path, dimensions: tuple[int, int]):
+        """Store a freshly rendered image and its dimensions under ``key``."""
+        with self._lock:
+            try:
+                shutil.copyfile(png_path, self._entry_path(key, png_path.suffix))
+            except OSError:
+                return
+            width, height = dimensions
+            self._entries[key] = {
+                'size': png_path.stat().st_size,
+                'width': width,
+                'height': height,
+                'suffix': png_path.suffix,
+                'atime': time.time(),
+            }
+            self._dirty = True
+            self._evict()
+    
+    def _evict(self):
+        """Drop least recently used entries until the cache fits ``max_bytes``."""
+        total = sum(entry['size'] for entry in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k]['atime']):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries.pop(key)
+            total -= entry['size']
+            self._entry_path(key, entry.get('suffix', '.png')).unlink(missing_ok=True)
+    
+    def save(self):
+        """Persist the index (atomically) if anything changed; a failed write only warns."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                write_atomic(self._index_path, json.dumps({'version': 1, 'entries': self._entries}).encode('utf-8'))
+            except OSError as e:
+                print(f"⚠️  Could not save the render cache index: {e}")
+                return
+            self._dirty = False
+
+
+def render_cache_key(mmd_content: str, output_path: Path) -> str:
+    """:func:`diagram_cache_key` for rendering to ``output_path`` (SVG renders get their own key)."""
+    suffix = Path(output_path).suffix
+    return diagram_cache_key(mmd_content, MMDC_OPTIONS if suffix == '.png' else f'{MMDC_OPTIONS} {suffix}')
+
+
+def render_mermaid_diagram(mmd_content: str, png_path: Path, render=convert_mermaid_to_png,
+                           cache: RenderCache | None = None) -> tuple[bool, tuple[int, int], bool]:
+    """Produce ``png_path`` for one diagram, from the cache when possible.
+    
+    A ``.svg`` path renders (and caches) a vector diagram instead.
+    Returns (ok, (width, height), cached). Safe to call from worker threads.
+    """
+    key = render_cache_key(mmd_content, png_path) if cache else None
+    dimensions = cache.get(key, png_path) if cache else None
+    if dimensions:
+        return True, dimensions, True
+    if not render(mmd_content, png_path):
+        return False, (0, 0), False
+    dimensions = get_image_dimensions(png_path)
+    if cache and dimensions != (0, 0):
+        cache.put(key, png_path, dimensions)
+    return True, dimensions, False
+
+
+def convert_svg_to_png(svg_path: Path, png_path: Path, width: int = SVG_EXPORT_WIDTH) -> bool:
+    """Convert SVG to PNG ``width`` pixels wide using svgexport."""
+    result = run_tool('svgexport', svgexport_args(svg_path, png_path, width), timeout=TOOL_TIMEOUTS['svgexport'])
+    if result.returncode == 127:
         print(f"WARNING: svgexport not available, skipping {svg_path}")
-        return False
+    return result.returncode == 0
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_DROP_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME', b'pHYs'}  # metadata Word never shows
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def recompress_png(data: bytes, dpi: int) -> bytes | None:
+    """Losslessly repack a PNG: one IDAT at zlib level 9, metadata dropped, pHYs set to ``dpi``.
+    
+    Pixels, palette and colour chunks are untouched. Returns None if ``data``
+    isn't a well-formed PNG.
+    """
+    if data[:8] != PNG_SIGNATURE:
+        return None
+    chunks, idat = [], []
+    pos = 8
+    try:
+        while pos < len(data):
+            length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+            body = data[pos + 8:pos + 8 + length]
+            pos += 12 + length
+            if chunk_type == b'IDAT':
+                if not idat:
+                    chunks.append(None)  # placeholder: pHYs + IDAT go here
+                idat.append(body)
+            elif chunk_type not in PNG_DROP_CHUNKS:
+                chunks.append(png_chunk(chunk_type, body))
+            if chunk_type == b'IEND':
+                break
+        pixels = zlib.compress(zlib.decompress(b''.join(idat)), 9)
+    except (struct.error, zlib.error):
+        return None
+    if not idat:
+        return None
+    ppm = round(dpi / 0.0254)  # pHYs is in pixels per metre
+    image = png_chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1)) + png_chunk(b'IDAT', pixels)
+    return PNG_SIGNATURE + b''.join(image if chunk is None else chunk for chunk in chunks)
+
+
+def optimize_png(png_path: Path, display_size: tuple[float, float], dpi: int) -> tuple[int, int]:
+    """Shrink ``png_path`` for a ``display_size`` (inches) placement at ``dpi``.
+    
+    Images with more pixels than the page can show at ``dpi`` are downsampled
+    (needs Pillow); everything is then recompressed losslessly and tagged with
+    the DPI. The file is only replaced when that makes it smaller (or it was
+    resampled). Returns (bytes before, bytes after).
+    """
+    data = png_path.read_bytes()
+    width, height = get_png_dimensions(png_path)
+    target = (max(1, round(display_size[0] * dpi)), max(1, round(display_size[1] * dpi)))
+    optimized = None
+    Image = load_pillow() if width > target[0] and height > target[1] else None
+    if Image is not None:
+        with Image.open(io.BytesIO(data)) as image:
+            buffer = io.BytesIO()
+            image.resize(target, Image.LANCZOS).save(buffer, 'PNG', optimize=True, dpi=(dpi, dpi))
+        optimized = buffer.getvalue()
+        resampled = True
+    else:
+        optimized = recompress_png(data, dpi)
+        resampled = False
+    if optimized is None or (not resampled and len(optimized) >= len(data)):
+        return len(data), len(data)
+    write_atomic(png_path, optimized)
+    return len(data), len(optimized)
+
+
+@lru_cache(maxsize=None)
+def _parsed_fragment(xml: str):
+    return parse_xml(xml)
+
+
+def fragment(xml: str):
+    """Return a fresh OOXML element for ``xml``.
+    
+    Each distinct template string is parsed once; later calls copy the cached
+    element, which is far cheaper than re-parsing for every cell, row and code
+    paragraph of a large document.
+    """
+    return copy.copy(_parsed_fragment(xml))  # lxml element copies are always deep
+
+
+TABLE_BORDERS = (
+    '<w:tblBorders xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:top w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
+    '<w:left w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
+    '<w:bottom w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
+    '<w:right w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
+    '<w:insideH w:val="single" w:sz="4" w:space="0" w:color="AAAAAA"/>'
+    '<w:insideV w:val="single" w:sz="4" w:space="0" w:color="AAAAAA"/>'
+    '</w:tblBorders>'
+)
 
 
 def set_cell_shading(cell, color: str):
     """Set cell background color."""
-    shading = parse_xml(f'<w:shd {nsdecls("w")} w:fill="{color}"/>')
+    shading = fragment(f'<w:shd {nsdecls("w")} w:fill="{color}"/>')
     cell._tc.get_or_add_tcPr().append(shading)
 
 
@@ -182,7 +1092,7 @@ def autofit_table(table):
     tbl = table._tbl
     tblPr = tbl.tblPr
     if tblPr is None:
-        tblPr = parse_xml(
+        tblPr = fragment(
             '<w:tblPr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>'
         )
         tbl.insert(0, tblPr)
@@ -192,7 +1102,7 @@ def autofit_table(table):
         tblPr.remove(existing)
     
     # Set auto width (fit to content)
-    tbl_width = parse_xml(
+    tbl_width = fragment(
         '<w:tblW xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
         'w:type="auto" w:w="0"/>'
     )
@@ -201,7 +1111,7 @@ def autofit_table(table):
     # Set table layout to auto (allows columns to resize)
     for existing in tblPr.findall(qn('w:tblLayout')):
         tblPr.remove(existing)
-    layout = parse_xml(
+    layout = fragment(
         '<w:tblLayout xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
         'w:type="autofit"/>'
     )
@@ -213,21 +1123,12 @@ def set_table_borders(table):
     tbl = table._tbl
     tblPr = tbl.tblPr
     if tblPr is None:
-        tblPr = parse_xml(
+        tblPr = fragment(
             '<w:tblPr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>'
         )
         tbl.insert(0, tblPr)
     
-    borders = parse_xml(
-        '<w:tblBorders xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
-        '<w:top w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
-        '<w:left w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
-        '<w:bottom w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
-        '<w:right w:val="single" w:sz="6" w:space="0" w:color="666666"/>'
-        '<w:insideH w:val="single" w:sz="4" w:space="0" w:color="AAAAAA"/>'
-        '<w:insideV w:val="single" w:sz="4" w:space="0" w:color="AAAAAA"/>'
-        '</w:tblBorders>'
-    )
+    borders = fragment(TABLE_BORDERS)
     
     for existing in tblPr.findall(qn('w:tblBorders')):
         tblPr.remove(existing)
@@ -240,7 +1141,7 @@ def set_row_cant_split(row):
     # Remove existing cantSplit if present
     for existing in trPr.findall(qn('w:cantSplit')):
         trPr.remove(existing)
-    cant_split = parse_xml(
+    cant_split = fragment(
         '<w:cantSplit xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>'
     )
     trPr.append(cant_split)
@@ -275,6 +1176,33 @@ def set_table_keep_together(table, max_rows_to_keep=12):
                     pf.keep_together = True
 
 
+# Paragraph formatting tables (shared by both formatting engines)
+HEADING_COLORS = {  # RGB
+    'Heading 1': (0x00, 0x52, 0x8B),  # Dark blue
+    'Heading 2': (0x00, 0x78, 0xD4),  # Microsoft blue
+    'Heading 3': (0x10, 0x5E, 0x7E),  # Teal
+    'Heading 4': (0x10, 0x5E, 0x7E),  # Teal
+}
+HEADING_SPACING = {  # (space before, space after) in points
+    'Heading 1': (18, 6),
+    'Heading 2': (14, 4),
+    'Heading 3': (12, 4),
+    'Heading 4': (10, 3),
+}
+# Code-related style names that pandoc may generate
+CODE_STYLES = {'Source Code', 'Verbatim Char', 'Code', 'SourceCode'}
+CODE_BLOCK_SHADING = '<w:shd xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" w:fill="F5F5F5" w:val="clear"/>'  # light gray
+CODE_BLOCK_BORDERS = (
+    '<w:pBdr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:left w:val="single" w:sz="24" w:space="4" w:color="CCCCCC"/>'
+    '<w:top w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
+    '<w:bottom w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
+    '<w:right w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
+    '</w:pBdr>'
+)
+FORMAT_ENGINES = ('single-pass', 'legacy', 'streaming')
+
+
 def format_tables(doc: Document):
     """Apply professional formatting to all tables."""
     for table in doc.tables:
@@ -303,324 +1231,3190 @@ def format_tables(doc: Document):
                         run.font.color.rgb = RGBColor(0, 0, 0)
 
 
+# Run properties format_table() gives plain header / data cell runs
+TABLE_HEADER_RPR = ('<w:rPr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:b/><w:color w:val="FFFFFF"/>'
+                    '<w:sz w:val="20"/></w:rPr>')  # bold, white, 10pt
+TABLE_DATA_RPR = '<w:rPr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:color w:val="000000"/><w:sz w:val="18"/></w:rPr>'  # black, 9pt
+
+
+def format_table(table, max_rows_to_keep=12, reference_styles=False):
+    """Format one table in a single linear pass over its ``w:tr``/``w:tc`` elements.
+    
+    Applies what :func:`format_tables` does (borders, autofit, cantSplit,
+    keepNext pagination, header/alternating shading and fonts) without
+    python-docx's ``table.rows``/``row.cells`` grid, whose per-access cost
+    makes large tables quadratic, and without walking the rows three times.
+    Output matches :func:`format_tables` except for merged cells, which are
+    formatted once per ``w:tc`` rather than once per spanned grid position.
+    
+    With ``reference_styles`` the borders, cantSplit, shading and fonts come
+    from the reference doc's table style (see :func:`build_reference_docx`),
+    leaving only autofit and keepNext pagination.
+    """
+    autofit_table(table)
+    
+    trs = table._tbl.tr_lst
+    num_rows = len(trs)
+    # Same keep-together rule as set_table_keep_together()
+    rows_to_link = num_rows - 1 if num_rows <= max_rows_to_keep else min(3, num_rows - 1)
+    if reference_styles:
+        for tr in trs[:rows_to_link]:
+            for tc in tr.tc_lst:
+                for p in tc.p_lst:
+                    pf = ParagraphFormat(p)
+                    pf.keep_with_next = True
+                    pf.keep_together = True
+        return
+    
+    set_table_borders(table)
+    header_color, black = RGBColor(255, 255, 255), RGBColor(0, 0, 0)
+    size_header, size_data = Pt(10), Pt(9)
+    
+    for i, tr in enumerate(trs):
+        # Prevent individual rows from splitting across pages
+        trPr = tr.get_or_add_trPr()
+        for existing in trPr.findall(qn('w:cantSplit')):
+            trPr.remove(existing)
+        trPr.append(fragment(
+            '<w:cantSplit xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>'
+        ))
+        
+        keep = i < rows_to_link
+        if i == 0:
+            shading = f'<w:shd {nsdecls("w")} w:fill="0078D4"/>'  # Microsoft blue
+        else:
+            shading = f'<w:shd {nsdecls("w")} w:fill="{"F0F0F0" if i % 2 == 0 else "FFFFFF"}"/>'
+        
+        for tc in tr.tc_lst:
+            tc.get_or_add_tcPr().append(fragment(shading))
+            for p in tc.p_lst:
+                if keep:
+                    pf = ParagraphFormat(p)
+                    pf.keep_with_next = True
+                    pf.keep_together = True
+                for r in p.r_lst:
+                    if r.rPr is None:
+                        # Plain run (pandoc's usual output): insert the finished
+                        # run properties in one step - same XML as the setters
+                        r.insert(0, fragment(TABLE_HEADER_RPR if i == 0 else TABLE_DATA_RPR))
+                        continue
+                    font = Font(r)
+                    if i == 0:
+                        font.bold = True
+                        font.color.rgb = header_color
+                        font.size = size_header
+                    else:
+                        font.size = size_data
+                        font.color.rgb = black
+
+
+def center_image(paragraph):
+    """Center a paragraph if it contains an image (inline shape)."""
+    for _ in paragraph._element.iter(qn('wp:inline')):
+        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        break
+
+
 def center_images(doc: Document):
     """Center all images (inline shapes) in their paragraphs."""
     for paragraph in doc.paragraphs:
-        # Check if paragraph contains an image
-        inline_shapes = paragraph._element.findall('.//wp:inline', 
-            {'wp': 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing'})
-        if inline_shapes:
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        center_image(paragraph)
+
+
+SVG_BLIP = '{http://schemas.microsoft.com/office/drawing/2016/SVG/main}svgBlip'
+
+
+def add_svg_fallbacks(doc: Document, pngs: dict[str, bytes] | None = None) -> int:
+    """Give every SVG picture without one a raster fallback; returns how many were fixed.
+    
+    pandoc embeds SVG as an ``asvg:svgBlip`` extension and only adds the
+    ``a:blip`` fallback Word 2013 and older (and most other readers) need if
+    rsvg-convert is installed. ``pngs`` maps the SHA-256 of an SVG's bytes
+    to its rendered PNG. Pictures without one point at a shared 1×1 white
+    PNG, which keeps the document valid everywhere while Word 2016+ draws
+    the vector image.
+    """
+    ensure_docx()
+    blips = [blip for blip in doc.element.body.iter(qn('a:blip')) if needs_svg_fallback(blip)]
+    for blip in blips:
+        svg = doc.part.related_parts[svg_blip_rId(blip)].blob
+        rId, _ = doc.part.get_or_add_image(io.BytesIO(svg_fallback_for(svg, pngs)))
+        blip.set(qn('r:embed'), rId)
+    return len(blips)
+
+
+def needs_svg_fallback(blip) -> bool:
+    """True for an ``a:blip`` that only carries an SVG (no raster ``r:embed``)."""
+    return blip.get(qn('r:embed')) is None and next(blip.iter(SVG_BLIP), None) is not None
+
+
+def svg_blip_rId(blip) -> str:
+    """The relationship id of the SVG an ``a:blip`` carries."""
+    return next(blip.iter(SVG_BLIP)).get(qn('r:embed'))
+
+
+def svg_fallback_for(svg: bytes, pngs: dict[str, bytes] | None) -> bytes:
+    """The rendered PNG for ``svg`` from ``pngs`` (keyed by SHA-256), else :func:`svg_fallback_png`."""
+    return (pngs or {}).get(hashlib.sha256(svg).hexdigest()) or svg_fallback_png()
+
+
+@lru_cache(maxsize=None)
+def svg_fallback_png() -> bytes:
+    """The 1×1 white PNG used as raster fallback for SVG pictures that have no rendered PNG."""
+    image = png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0))
+    image += png_chunk(b'IDAT', zlib.compress(b'\x00\xff\xff\xff'))
+    return PNG_SIGNATURE + image + png_chunk(b'IEND', b'')
+
+
+RELATIONSHIP_ATTRS = ('r:embed', 'r:link', 'r:id')
+
+
+def dedupe_media(doc: Document) -> int:
+    """Make every reference to identical image bytes use one media part; returns parts dropped.
+    
+    pandoc adds a media part per distinct image *path*, so the same picture
+    under two names (an SVG banner copied next to each chapter, a diagram
+    pasted into several documents of a batch) is stored once per name.
+    Relationships are repointed at the first part with the same content
+    type and bytes, references within a part share one relationship ID,
+    and parts nothing points to any more are left out on save.
+    """
+    ensure_docx()
+    canonical = {}  # (content type, size) → distinct media parts
+    dropped = set()
+    attrs = [qn(attr) for attr in RELATIONSHIP_ATTRS]
+    for part in list(doc.part.package.iter_parts()):
+        if getattr(part, 'element', None) is None:
+            continue  # binary part: no references to rewrite
+        remap = {}
+        for rId, rel in list(part.rels.items()):
+            if rel.reltype != RT.IMAGE or rel.is_external:
+                continue
+            target = rel.target_part
+            candidates = canonical.setdefault((target.content_type, len(target.blob)), [])
+            first = next((media for media in candidates if media is target or media.blob == target.blob), None)
+            if first is None:
+                candidates.append(target)
+                first = target
+            keep = part.relate_to(first, RT.IMAGE)  # the first relationship to ``first`` in this part
+            if keep != rId:
+                remap[rId] = keep
+            if first is not target:
+                dropped.add(target.partname)
+        if not remap:
+            continue
+        for element in part.element.iter():
+            for attr in attrs:
+                if element.get(attr) in remap:
+                    element.set(attr, remap[element.get(attr)])
+        for rId in remap:
+            del part.rels[rId]
+    return len(dropped)
+
+
+def fix_spacing(paragraph, style_name: str | None):
+    """Spacing and widow/orphan control for one paragraph of style ``style_name``."""
+    # Skip empty paragraphs
+    if not paragraph.text.strip():
+        return
+    
+    pf = paragraph.paragraph_format
+    
+    # Enable widow/orphan control (prevents single lines at page top/bottom)
+    pf.widow_control = True
+    
+    # List items should have less spacing
+    if style_name and 'List' in style_name:
+        pf.space_before = Pt(2)
+        pf.space_after = Pt(2)
+    # Regular paragraphs
+    elif style_name == 'Normal':
+        pf.space_before = Pt(6)
+        pf.space_after = Pt(6)
 
 
 def fix_paragraph_spacing(doc: Document):
     """Ensure proper spacing and widow/orphan control for all paragraphs."""
     for paragraph in doc.paragraphs:
-        # Skip empty paragraphs
-        if not paragraph.text.strip():
-            continue
+        style = paragraph.style
+        fix_spacing(paragraph, style.name if style else None)
+
+
+def format_heading(paragraph, style_name: str | None):
+    """Heading colors, spacing and orphan prevention for one paragraph."""
+    if style_name and style_name.startswith('Heading'):
+        # Apply colors
+        if style_name in HEADING_COLORS:
+            for run in paragraph.runs:
+                run.font.color.rgb = RGBColor(*HEADING_COLORS[style_name])
         
+        # Paragraph formatting
         pf = paragraph.paragraph_format
         
-        # Enable widow/orphan control (prevents single lines at page top/bottom)
-        pf.widow_control = True
+        # CRITICAL: Keep heading with next paragraph (prevents orphan titles)
+        pf.keep_with_next = True
         
-        # List items should have less spacing
-        if paragraph.style.name and 'List' in paragraph.style.name:
-            pf.space_before = Pt(2)
-            pf.space_after = Pt(2)
-        # Regular paragraphs
-        elif paragraph.style.name == 'Normal':
-            pf.space_before = Pt(6)
-            pf.space_after = Pt(6)
+        # Also prevent page breaks within the heading itself
+        pf.keep_together = True
+        
+        # Spacing based on heading level
+        if style_name in HEADING_SPACING:
+            before, after = HEADING_SPACING[style_name]
+            pf.space_before = Pt(before)
+            pf.space_after = Pt(after)
 
 
 def format_headings(doc: Document):
     """Apply consistent heading styles with orphan prevention."""
-    heading_colors = {
-        'Heading 1': RGBColor(0x00, 0x52, 0x8B),  # Dark blue
-        'Heading 2': RGBColor(0x00, 0x78, 0xD4),  # Microsoft blue
-        'Heading 3': RGBColor(0x10, 0x5E, 0x7E),  # Teal
-        'Heading 4': RGBColor(0x10, 0x5E, 0x7E),  # Teal
-    }
-    
     for paragraph in doc.paragraphs:
         style_name = paragraph.style.name if paragraph.style else None
-        
-        if style_name and style_name.startswith('Heading'):
-            # Apply colors
-            if style_name in heading_colors:
-                for run in paragraph.runs:
-                    run.font.color.rgb = heading_colors[style_name]
-            
-            # Paragraph formatting
-            pf = paragraph.paragraph_format
-            
-            # CRITICAL: Keep heading with next paragraph (prevents orphan titles)
-            pf.keep_with_next = True
-            
-            # Also prevent page breaks within the heading itself
-            pf.keep_together = True
-            
-            # Spacing based on heading level
-            if style_name == 'Heading 1':
-                pf.space_before = Pt(18)
-                pf.space_after = Pt(6)
-            elif style_name == 'Heading 2':
-                pf.space_before = Pt(14)
-                pf.space_after = Pt(4)
-            elif style_name == 'Heading 3':
-                pf.space_before = Pt(12)
-                pf.space_after = Pt(4)
-            elif style_name == 'Heading 4':
-                pf.space_before = Pt(10)
-                pf.space_after = Pt(3)
+        format_heading(paragraph, style_name)
 
 
-def format_code_blocks(doc: Document):
-    """Apply professional formatting to code blocks.
+def format_code_block(paragraph, style_name: str | None):
+    """Monospace font, shading and border for a code paragraph (others untouched)."""
+    style_name = style_name or ''
     
-    Pandoc generates code blocks with styles like 'Source Code', 'Verbatim Char',
-    or paragraphs containing code runs. This function:
+    # Check if this is a code block paragraph
+    is_code = (
+        style_name in CODE_STYLES or
+        'code' in style_name.lower() or
+        'verbatim' in style_name.lower()
+    )
+    
+    if is_code:
+        # Format the paragraph
+        pf = paragraph.paragraph_format
+        pf.space_before = Pt(3)
+        pf.space_after = Pt(3)
+        pf.keep_together = True  # Don't split code blocks
+        
+        # Format each run with monospace font
+        for run in paragraph.runs:
+            run.font.name = 'Consolas'
+            run.font.size = Pt(9)
+            run.font.color.rgb = RGBColor(0x1E, 0x1E, 0x1E)  # Dark gray text
+        
+        # Apply shading to the paragraph (light gray background)
+        shading_elm = fragment(CODE_BLOCK_SHADING)
+        paragraph._element.get_or_add_pPr().append(shading_elm)
+        
+        # Add left border for code block visual distinction
+        pBdr = fragment(CODE_BLOCK_BORDERS)
+        pPr = paragraph._element.get_or_add_pPr()
+        # Remove existing borders
+        for existing in pPr.findall(qn('w:pBdr')):
+            pPr.remove(existing)
+        pPr.append(pBdr)
+
+
+def format_code_blocks(doc: Document):
+    """Apply professional formatting to code blocks.
+    
+    Pandoc generates code blocks with styles like 'Source Code', 'Verbatim Char',
+    or paragraphs containing code runs. This function:
     - Applies Consolas monospace font
     - Sets light gray background
     - Adds subtle border
     - Uses smaller font size
     """
-    # Code-related style names that pandoc may generate
-    code_styles = {'Source Code', 'Verbatim Char', 'Code', 'SourceCode'}
-    
     for paragraph in doc.paragraphs:
         style_name = paragraph.style.name if paragraph.style else ''
-        
-        # Check if this is a code block paragraph
-        is_code = (
-            style_name in code_styles or
-            'code' in style_name.lower() or
-            'verbatim' in style_name.lower()
-        )
-        
-        if is_code:
-            # Format the paragraph
-            pf = paragraph.paragraph_format
-            pf.space_before = Pt(3)
-            pf.space_after = Pt(3)
-            pf.keep_together = True  # Don't split code blocks
-            
-            # Format each run with monospace font
-            for run in paragraph.runs:
-                run.font.name = 'Consolas'
-                run.font.size = Pt(9)
-                run.font.color.rgb = RGBColor(0x1E, 0x1E, 0x1E)  # Dark gray text
-            
-            # Apply shading to the paragraph (light gray background)
-            shading_elm = parse_xml(
-                f'<w:shd {nsdecls("w")} w:fill="F5F5F5" w:val="clear"/>'
-            )
-            paragraph._element.get_or_add_pPr().append(shading_elm)
-            
-            # Add left border for code block visual distinction
-            pBdr = parse_xml(
-                '<w:pBdr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
-                '<w:left w:val="single" w:sz="24" w:space="4" w:color="CCCCCC"/>'
-                '<w:top w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
-                '<w:bottom w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
-                '<w:right w:val="single" w:sz="4" w:space="1" w:color="E0E0E0"/>'
-                '</w:pBdr>'
-            )
-            pPr = paragraph._element.get_or_add_pPr()
-            # Remove existing borders
-            for existing in pPr.findall(qn('w:pBdr')):
-                pPr.remove(existing)
-            pPr.append(pBdr)
+        format_code_block(paragraph, style_name)
 
 
-def apply_all_formatting(doc: Document, format_tables_flag: bool = True):
-    """Apply all formatting improvements to the document."""
-    if format_tables_flag:
-        format_tables(doc)
-    center_images(doc)
-    format_headings(doc)
-    format_code_blocks(doc)
-    fix_paragraph_spacing(doc)
+def paragraph_style_names(styles: Styles) -> tuple[dict[str, str | None], str | None]:
+    """Map paragraph styleId → UI name once, plus the default paragraph style name.
+    
+    Mirrors ``Paragraph.style`` (unknown ids resolve to the default style)
+    without its per-call XPath lookups.
+    """
+    names = {}
+    for style in styles:
+        if style.type == WD_STYLE_TYPE.PARAGRAPH:
+            names.setdefault(style.style_id, style.name)
+    default = styles.default(WD_STYLE_TYPE.PARAGRAPH)
+    return names, default.name if default is not None else None
 
 
-def preprocess_markdown(content: str) -> str:
+def body_child_formatter(styles: Styles, format_tables_flag: bool = True,
+                         reference_styles: bool = False, timings=None):
+    """The single-pass formatting of one top-level ``w:body`` child, as ``format_child(child, parent)``.
+    
+    Tables go to the streaming :func:`format_table`, paragraphs to the
+    per-paragraph formatters in the legacy order (center, heading, code,
+    spacing). Used by :func:`apply_single_pass_formatting` on a loaded
+    document and by :func:`stream_format_docx` on one element at a time.
     """
-    Fix common markdown issues before pandoc conversion.
+    style_names, default_style = paragraph_style_names(styles)
+    tag_p, tag_tbl = qn('w:p'), qn('w:tbl')
+    timings = timings or Timings(enabled=False)
+    center = timings.accumulate('center_images', center_image)
+    heading = timings.accumulate('format_headings', format_heading)
+    code = timings.accumulate('format_code_blocks', format_code_block)
+    spacing = timings.accumulate('fix_paragraph_spacing', fix_spacing)
+    table = timings.accumulate('format_tables', format_table)
     
-    Issues addressed:
-    - Bullet lists running together (need blank lines)
-    - Inconsistent list markers
-    - Missing blank lines after headings
-    - Checkbox lists
-    - Blockquote formatting
+    def format_child(child, parent):
+        if child.tag == tag_p:
+            paragraph = Paragraph(child, parent)
+            center(paragraph)
+            if reference_styles:
+                return
+            style_id = child.style
+            style_name = style_names.get(style_id, default_style) if style_id else default_style
+            heading(paragraph, style_name)
+            code(paragraph, style_name)
+            spacing(paragraph, style_name)
+        elif child.tag == tag_tbl and format_tables_flag:
+            table(Table(child, parent), reference_styles=reference_styles)
+    
+    return format_child
+
+
+def apply_single_pass_formatting(doc: Document, format_tables_flag: bool = True,
+                                 reference_styles: bool = False, timings=None):
+    """Apply all formatting in one walk over the top-level ``w:body`` children.
+    
+    Dispatches each table to the streaming :func:`format_table` and each
+    paragraph to the per-paragraph formatters in the legacy order (center,
+    heading, code, spacing), so the resulting XML is identical to the
+    five-pass engine (merged table cells aside, see :func:`format_table`).
+    With ``reference_styles`` headings, code and spacing are already styled
+    by the reference doc, so paragraphs only get image centering.
+    With ``timings`` each formatter's calls add up into one span named after
+    its legacy pass.
     """
-    lines = content.split('\n')
-    result = []
+    timings = timings or Timings(enabled=False)
+    format_child = body_child_formatter(doc.styles, format_tables_flag, reference_styles, timings)
+    parent = doc._body
+    for child in doc.element.body.iterchildren():
+        format_child(child, parent)
+    timings.flush()
+
+
+def apply_all_formatting(doc: Document, format_tables_flag: bool = True,
+                         engine: str = 'single-pass', reference_styles: bool = False,
+                         timings=None):
+    """Apply all formatting improvements to the document.
+    
+    ``engine='legacy'`` runs the original one-traversal-per-formatter passes;
+    both engines produce identical XML for tables without merged cells
+    (``'streaming'`` formats a loaded document like ``'single-pass'``).
+    ``reference_styles`` (pandoc ran with the :func:`build_reference_docx`
+    template) leaves only per-instance fixups, which always run single-pass.
+    ``timings`` (a :class:`Timings`) receives one span per formatter.
+    """
+    ensure_docx()
+    if engine != 'legacy' or reference_styles:
+        apply_single_pass_formatting(doc, format_tables_flag, reference_styles, timings)
+        return
+    timings = timings or Timings(enabled=False)
+    passes = [format_tables] if format_tables_flag else []
+    for formatter in passes + [center_images, format_headings, format_code_blocks, fix_paragraph_spacing]:
+        with timings.span(formatter.__name__):
+            formatter(doc)
+
+
+@lru_cache(maxsize=None)
+def get_pandoc_version() -> str:
+    """The installed pandoc's version line ('unknown' if pandoc can't be run)."""
+    def probe():
+        output = probe_output('pandoc', ['--version'])
+        return output.splitlines()[0].strip() if output else None
+    
+    return toolchain.probe('pandoc --version', resolve_tool('pandoc'), probe) or 'unknown'
+
+
+def build_reference_docx() -> bytes:
+    """pandoc's default reference.docx with this script's formatting as styles.
+    
+    Heading 1-4 colors, spacing and keep-with-next, widow control (on Normal,
+    inherited by every paragraph style), list spacing, the Source Code
+    paragraph style (Consolas 9pt, shading, borders) plus Verbatim Char, and
+    the Table style (borders, unsplittable rows, blue bold header row,
+    alternating row shading). Word applies these natively, so Phase 5 no
+    longer touches each paragraph and run. The 'Normal' spacing rule of
+    :func:`fix_spacing` stays per-paragraph only: as a style it would cascade
+    into every derived style, and pandoc doesn't emit Normal body paragraphs.
+    """
+    ensure_docx()
+    result = run_tool('pandoc', ['--print-default-data-file', 'reference.docx'],
+                      timeout=TOOL_TIMEOUTS['probe'], stdout_limit=None)
+    if result.returncode != 0:
+        raise ConversionError(f"pandoc failed: {result.stderr.decode('utf-8', 'replace')}")
+    doc = Document(io.BytesIO(result.stdout))
+    styles = doc.styles
+    
+    # Enable widow/orphan control (prevents single lines at page top/bottom)
+    styles['Normal'].paragraph_format.widow_control = True
+    
+    for name, color in HEADING_COLORS.items():
+        style = styles[name]
+        style.font.color.rgb = RGBColor(*color)
+        pf = style.paragraph_format
+        pf.keep_with_next = True
+        pf.keep_together = True
+        before, after = HEADING_SPACING[name]
+        pf.space_before = Pt(before)
+        pf.space_after = Pt(after)
+    
+    for style in styles:
+        if style.type == WD_STYLE_TYPE.PARAGRAPH and 'List' in style.name:
+            style.paragraph_format.space_before = Pt(2)
+            style.paragraph_format.space_after = Pt(2)
+    
+    # Code blocks (pandoc runs with --no-highlight, so every code run is Verbatim Char)
+    try:
+        code = styles['Source Code']
+    except KeyError:
+        code = styles.add_style('Source Code', WD_STYLE_TYPE.PARAGRAPH)
+        code.base_style = styles['Normal']
+    pPr = code.element.get_or_add_pPr()
+    pPr.append(fragment(CODE_BLOCK_BORDERS))  # schema order: pBdr, shd, then spacing
+    pPr.append(fragment(CODE_BLOCK_SHADING))
+    code.paragraph_format.space_before = Pt(3)
+    code.paragraph_format.space_after = Pt(3)
+    code.paragraph_format.keep_together = True  # Don't split code blocks
+    for style in (code, styles['Verbatim Char']):
+        style.font.name = 'Consolas'
+        style.font.size = Pt(9)
+        style.font.color.rgb = RGBColor(0x1E, 0x1E, 0x1E)  # Dark gray text
+    
+    # Tables: pandoc marks the first row as header and leaves row banding on
+    table_style = styles['Table'].element
+    tblPr = table_style.find(qn('w:tblPr'))
+    if tblPr is None:
+        tblPr = fragment(f'<w:tblPr {nsdecls("w")}/>')
+        table_style.append(tblPr)
+    cell_margins = tblPr.find(qn('w:tblCellMar'))
+    if cell_margins is not None:
+        cell_margins.addprevious(fragment(TABLE_BORDERS))
+    else:
+        tblPr.append(fragment(TABLE_BORDERS))
+    tblPr.addprevious(fragment(TABLE_DATA_RPR))
+    tblPr.addnext(fragment(f'<w:trPr {nsdecls("w")}><w:cantSplit/></w:trPr>'))
+    for existing in table_style.findall(qn('w:tblStylePr')):
+        if existing.get(qn('w:type')) == 'firstRow':
+            table_style.remove(existing)
+    table_style.append(fragment(
+        f'<w:tblStylePr {nsdecls("w")} w:type="firstRow">{TABLE_HEADER_RPR}'
+        '<w:tcPr><w:tcBorders><w:bottom w:val="single"/></w:tcBorders>'
+        '<w:shd w:val="clear" w:color="auto" w:fill="0078D4"/>'  # Microsoft blue
+        '<w:vAlign w:val="bottom"/></w:tcPr></w:tblStylePr>'
+    ))
+    table_style.append(fragment(
+        f'<w:tblStylePr {nsdecls("w")} w:type="band2Horz">'
+        '<w:tcPr><w:shd w:val="clear" w:color="auto" w:fill="F0F0F0"/></w:tcPr></w:tblStylePr>'
+    ))
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def get_reference_docx(cache_dir: Path) -> Path:
+    """The generated reference.docx, built once per converter/pandoc version and cached."""
+    digest = hashlib.sha256(repr((
+        VERSION, get_pandoc_version(), HEADING_COLORS, HEADING_SPACING,
+        TABLE_BORDERS, TABLE_HEADER_RPR, TABLE_DATA_RPR, CODE_BLOCK_SHADING, CODE_BLOCK_BORDERS,
+    )).encode('utf-8')).hexdigest()
+    path = Path(cache_dir) / f'reference-{digest[:16]}.docx'
+    if not path.exists():
+        write_atomic(path, build_reference_docx())
+    return path
+
+
+# Markdown preprocessing patterns (compiled once)
+LIST_ITEM_RE = re.compile(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*\[[ xX]\]')
+CONVERTED_LIST_ITEM_RE = re.compile(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*[☐☑]')  # after checkbox conversion
+UNCHECKED_BOX_RE = re.compile(r'^([-*+])\s*\[ \]')
+CHECKED_BOX_RE = re.compile(r'^([-*+])\s*\[[xX]\]')
+CODE_FENCE_RE = re.compile(r'^(`{3,}|~{3,})')
+LIST_MARKERS = '-*+0123456789'
+
+
+def iter_preprocessed_lines(lines):
+    """Stream the preprocessed form of ``lines`` (without newlines), one line at a time.
+    
+    Single pass, O(n): blank lines are inserted before and after lists and
+    after headings, and checkbox items become ☐/☑ bullets. Fenced code blocks
+    (``` or ~~~) are passed through untouched.
+    """
+    started = False           # anything emitted yet
+    prev_was_heading = False  # previous input line
     prev_was_list = False
     prev_was_blank = False
+    last_was_empty = False    # last emitted line is ''
+    last_was_list = False     # last emitted line reads as a (converted) list item
+    fence = None              # open fence marker, e.g. '```'
     
-    for i, line in enumerate(lines):
+    for line in lines:
         stripped = line.strip()
+        first = stripped[:1]
+        
+        if fence:
+            # Inside a code block: copy verbatim until the matching closing fence
+            if first == fence[0] and len(stripped) >= len(fence) and not stripped.strip(first):
+                fence = None
+            yield line
+            last_was_empty, last_was_list = line == '', False
+            prev_was_heading = prev_was_list = prev_was_blank = False
+            continue
         
         # Detect list items (-, *, numbered, checkbox)
-        is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*\[[ xX]\]', stripped))
         is_blank = not stripped
-        is_heading = stripped.startswith('#')
-        is_blockquote = stripped.startswith('>')
-        is_table_row = '|' in stripped and stripped.startswith('|')
-        is_code_fence = stripped.startswith('```')
+        maybe_list = not is_blank and first in LIST_MARKERS
+        is_list = maybe_list and LIST_ITEM_RE.match(stripped) is not None
         
         # Add blank line before lists if previous line was not blank/list
-        if is_list and not prev_was_list and not prev_was_blank and result:
-            result.append('')
+        if is_list and not prev_was_list and not prev_was_blank and started:
+            yield ''
+            last_was_empty, last_was_list = True, False
         
-        # Add blank line after heading if next line is not blank
-        if i > 0 and result:
-            prev_line = lines[i-1].strip()
-            if prev_line.startswith('#') and not is_blank:
-                # Check if we didn't already add a blank
-                if result[-1] != '':
-                    result.append('')
+        # Add blank line after heading if this line is not blank
+        if prev_was_heading and not is_blank and not last_was_empty:
+            yield ''
+            last_was_empty, last_was_list = True, False
         
         # Convert checkbox markers for pandoc compatibility
         # - [ ] item -> - ☐ item
         # - [x] item -> - ☑ item
-        if re.match(r'^[-*+]\s*\[[ ]\]', stripped):
-            line = re.sub(r'^([-*+])\s*\[ \]', r'\1 ☐', line)
-        elif re.match(r'^[-*+]\s*\[[xX]\]', stripped):
-            line = re.sub(r'^([-*+])\s*\[[xX]\]', r'\1 ☑', line)
-        
-        result.append(line)
-        prev_was_list = is_list
-        prev_was_blank = is_blank
-    
-    # Add blank line after lists before non-list content
-    final = []
-    for i, line in enumerate(result):
-        final.append(line)
-        stripped = line.strip()
-        is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*[☐☑]', stripped))
+        converted = 0
+        if is_list and line[:1] in '-*+':
+            line, converted = UNCHECKED_BOX_RE.subn(r'\1 ☐', line, count=1)
+            if not converted:
+                line, converted = CHECKED_BOX_RE.subn(r'\1 ☑', line, count=1)
+        is_item = bool(converted) or (maybe_list and CONVERTED_LIST_ITEM_RE.match(stripped) is not None)
         
-        if is_list and i + 1 < len(result):
-            next_stripped = result[i + 1].strip()
-            next_is_list = bool(re.match(r'^[-*+]\s|^\d+\.\s|^[-*+]\s*[☐☑]', next_stripped))
-            next_is_blank = not next_stripped
-            
-            # If next line is not a list item and not blank, add blank
-            if not next_is_list and not next_is_blank:
-                final.append('')
+        # Add blank line after lists before non-list content
+        if last_was_list and not is_item and not is_blank:
+            yield ''
+        yield line
+        started = True
+        last_was_empty, last_was_list = line == '', is_item
+        
+        if first in '`~' and not is_blank:
+            fence_match = CODE_FENCE_RE.match(stripped)
+            if fence_match:
+                fence = fence_match.group(1)
+        prev_was_heading, prev_was_list, prev_was_blank = first == '#', is_list, is_blank
+
+
+def preprocess_markdown(content: str) -> str:
+    """
+    Fix common markdown issues before pandoc conversion.
+    
+    Issues addressed:
+    - Bullet lists running together (need blank lines)
+    - Inconsistent list markers
+    - Missing blank lines after headings
+    - Checkbox lists
+    - Blockquote formatting
     
-    return '\n'.join(final)
+    Fenced code blocks are left exactly as written.
+    """
+    return '\n'.join(iter_preprocessed_lines(content.split('\n')))
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Convert Markdown with Mermaid diagrams to Word document'
-    )
-    parser.add_argument('source', help='Source Markdown file')
-    parser.add_argument('output', nargs='?', help='Output Word file (default: source.docx)')
-    parser.add_argument('--images-dir', default='images', help='Directory for generated images')
-    parser.add_argument('--no-format-tables', action='store_true', help='Skip table formatting')
-    parser.add_argument('--keep-temp', action='store_true', help='Keep temporary files')
+def file_sha256(path: Path) -> str | None:
+    """SHA-256 of a file's bytes, or None if it can't be read."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def find_image_references(content: str) -> list[str]:
+    """Local image paths referenced with ``![alt](path)`` (URLs skipped), unique, in order."""
+    refs = re.findall(r'!\[[^\]]*\]\(([^)\s]+)', content)
+    return list(dict.fromkeys(ref for ref in refs if '://' not in ref))
+
+
+def build_fingerprint(source_path: Path, content: str, options: dict) -> dict:
+    """Everything a conversion's output depends on, as content hashes.
     
-    args = parser.parse_args()
+    Covers the source text, every locally referenced image (missing ones are
+    recorded as None so their later appearance triggers a rebuild), the
+    diagram render keys (which include the mermaid-cli version), the
+    formatting options and the converter version.
+    """
+    images = {ref: file_sha256(source_path.parent / ref) for ref in find_image_references(content)}
+    mermaid_blocks = find_mermaid_blocks(content)
+    return {
+        'tool': VERSION,
+        'options': options,
+        'source': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+        'images': images,
+        'diagrams': [diagram_cache_key(mmd) for _, mmd in mermaid_blocks],
+    }
+
+
+class BuildManifest:
+    """Incremental build manifest: output path → fingerprint + output hash.
     
-    source_path = Path(args.source)
-    if not source_path.exists():
-        print(f"ERROR: Source file not found: {source_path}")
-        sys.exit(1)
+    A conversion is skipped when its fingerprint matches the recorded one and
+    the output file still has the recorded hash. Only fully successful
+    conversions are recorded, so failed diagrams are retried next run.
+    """
     
-    output_path = Path(args.output) if args.output else source_path.with_suffix('.docx')
-    images_dir = source_path.parent / args.images_dir
-    images_dir.mkdir(exist_ok=True)
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            self._entries = json.loads(self.path.read_text(encoding='utf-8')).get('outputs', {})
+        except (OSError, ValueError, AttributeError):
+            self._entries = {}
     
-    print(f"📄 Converting {source_path} → {output_path}")
+    def is_current(self, output_path: Path, fingerprint: dict) -> bool:
+        with self._lock:
+            entry = self._entries.get(str(Path(output_path).resolve()))
+        return (
+            entry is not None
+            and entry.get('fingerprint') == fingerprint
+            and entry.get('output') == file_sha256(output_path)
+        )
     
-    # Read source
-    content = source_path.read_text(encoding='utf-8')
+    def record(self, output_path: Path, fingerprint: dict):
+        entry = {'fingerprint': fingerprint, 'output': file_sha256(output_path)}
+        with self._lock:
+            self._entries[str(Path(output_path).resolve())] = entry
+            self._dirty = True
+    
+    def save(self):
+        """Persist the manifest (atomically) if anything changed; a failed write only warns."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                write_atomic(self.path, json.dumps({'version': 1, 'outputs': self._entries}, indent=1).encode('utf-8'))
+            except OSError as e:
+                print(f"⚠️  Could not save the build manifest: {e}")
+                return
+            self._dirty = False
+
+
+class ConversionError(Exception):
+    """A document could not be converted (missing source, pandoc failure, ...)."""
+
+
+class Timings:
+    """Wall-clock spans for every stage and diagram render (--timings / --timings-json).
+    
+    Spans are kept as Chrome trace events ("X" complete events, microseconds
+    since the run started, one ``tid`` per thread) so ``write_trace()`` output
+    loads directly in chrome://tracing or Perfetto. Disabled instances record
+    nothing and ``accumulate()`` returns the function unchanged, so the
+    instrumentation costs nothing unless asked for. Thread-safe.
+    """
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.events: list[dict] = []
+        self._origin = time.perf_counter()
+        self._totals: dict[str, list] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, name: str, start: float, duration: float, category: str = 'stage', **args):
+        """Record a span that started at ``start`` (perf_counter) and lasted ``duration`` seconds."""
+        if not self.enabled:
+            return
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': round((start - self._origin) * 1e6, 1), 'dur': round(duration * 1e6, 1),
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+    
+    @contextmanager
+    def span(self, name: str, category: str = 'stage', **args):
+        """Time the ``with`` block as one span (recorded even if it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter() - start, category, **args)
+    
+    def accumulate(self, name: str, func, **args):
+        """Wrap ``func`` so its calls add up into one span, recorded by :meth:`flush`.
+        
+        For formatters called once per paragraph, where a span per call would
+        cost more than the call itself.
+        """
+        if not self.enabled:
+            return func
+        
+        def timed(*call_args, **call_kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*call_args, **call_kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    total = self._totals.setdefault(name, [start, 0.0, 0, args])
+                    total[1] += elapsed
+                    total[2] += 1
+        return timed
+    
+    def flush(self, category: str = 'stage'):
+        """Record accumulated totals as spans (starting at their first call)."""
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        for name, (start, duration, calls, args) in totals.items():
+            self.add(name, start, duration, category, calls=calls, **args)
+    
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self._totals = {}
+    
+    def summary(self) -> list[tuple[str, int, float, float]]:
+        """(name, spans, total seconds, max seconds) per span name, in first-seen order."""
+        rows: dict[str, list] = {}
+        with self._lock:
+            events = list(self.events)
+        for event in sorted(events, key=lambda e: e['ts']):
+            row = rows.setdefault(event['name'], [0, 0.0, 0.0])
+            duration = event['dur'] / 1e6
+            row[0] += 1
+            row[1] += duration
+            row[2] = max(row[2], duration)
+        return [(name, count, total, longest) for name, (count, total, longest) in rows.items()]
+    
+    def print_summary(self):
+        print("\n⏱️  Timings")
+        print(f"   {'Stage':<24} {'Count':>6} {'Total':>10} {'Max':>10}")
+        for name, count, total, longest in self.summary():
+            print(f"   {name:<24} {count:>6} {total * 1000:>8.1f}ms {longest * 1000:>8.1f}ms")
+    
+    def write_trace(self, path: Path):
+        """Write the spans as a Chrome trace-event JSON file."""
+        with self._lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms',
+                     'otherData': {'tool': f'md-to-word {VERSION}'}}
+        write_atomic(Path(path), json.dumps(trace, indent=1).encode('utf-8'))
+
+
+class RenderPipeline:
+    """Diagram/SVG rendering resources shared by every conversion in a run.
+    
+    One render cache, one Mermaid worker, one bounded thread pool and (with
+    ``pandoc_server``) one warm pandoc server serve all documents. A batch
+    therefore pays the cache index load, the browser launch, the mermaid-cli
+    version probe and pandoc's startup once.
+    
+    Every stage reports spans to ``timings``.
+    
+    SVG conversions are de-duplicated by target PNG, so documents sharing a
+    banner convert it once. The pipeline also remembers which diagram it
+    last wrote to each PNG, so rebuilding a document (watch mode) touches
+    only diagrams whose source changed.
+    
+    With ``image_dpi`` every rendered PNG goes through :func:`optimize_png`
+    before pandoc sees it. With ``vector`` diagrams are rendered as SVG
+    (``diagram_suffix``) and SVG references are left for pandoc to embed;
+    their PNGs only serve as fallback images. With ``shards`` > 1 large
+    documents are converted in pieces by a pool of that many worker
+    processes (see :meth:`convert_shards`).
+    """
+    
+    def __init__(self, jobs: int = 1, use_cache: bool = True, cache_dir: Path | None = None,
+                 cache_max_mb: int = CACHE_MAX_MB, batch_render: bool = True,
+                 pandoc_server: str | None = None, timings: Timings | None = None,
+                 image_dpi: int | None = None, vector: bool = False, shards: int = 1):
+        self.jobs = jobs
+        self.image_dpi = image_dpi
+        self.vector = vector
+        self.shards = shards
+        self._shard_pool = None
+        self.svg_width = round(SVG_DISPLAY_WIDTH * image_dpi) if image_dpi else SVG_EXPORT_WIDTH
+        self.timings = timings or Timings(enabled=False)
+        self._use_cache = use_cache
+        self._cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self._cache_max_bytes = cache_max_mb * 1024 * 1024
+        self._cache = None
+        self.renderer = MermaidBatchRenderer(concurrency=jobs) if batch_render else None
+        self.pandoc_server = None
+        if pandoc_server:
+            self.pandoc_server = PandocServer(None if pandoc_server == 'auto' else pandoc_server)
+        self._pool = ThreadPoolExecutor(max_workers=jobs)
+        self._svg_futures: dict[tuple[Path, int], Future] = {}
+        self._written: dict[Path, tuple[str, tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def diagram_suffix(self) -> str:
+        return '.svg' if self.vector else '.png'
+    
+    @property
+    def cache(self) -> RenderCache | None:
+        """The render cache, created on first use (None when disabled)."""
+        with self._lock:
+            if self._cache is None and self._use_cache:
+                self._cache = RenderCache(self._cache_dir, max_bytes=self._cache_max_bytes)
+            return self._cache
+    
+    def render_diagram(self, mmd_content: str, png_path: Path) -> Future:
+        """Schedule one diagram; the future yields (ok, (width, height), cached, (bytes before, after)).
+        
+        (width, height) are the rendered pixels, before any DPI normalization,
+        so image sizing doesn't depend on ``image_dpi``.
+        """
+        with self._lock:
+            written = self._written.get(png_path)
+        if written and written[0] == mmd_content and png_path.exists():
+            # Already on disk from an earlier build in this session
+            future = Future()
+            future.set_result((True, written[1], True, (0, 0)))
+            return future
+        
+        render = self.renderer.render if self.renderer else convert_mermaid_to_png
+        cache = self.cache
+        
+        def task():
+            start = time.perf_counter()
+            result = render_mermaid_diagram(mmd_content, png_path, render, cache)
+            ok, dimensions, cached = result
+            self.timings.add('mermaid', start, time.perf_counter() - start, 'render',
+                             diagram=str(png_path), ok=ok, cached=cached)
+            sizes = (0, 0)
+            if ok:
+                sizes = self._optimize(png_path, fit_to_page(*dimensions))
+                with self._lock:
+                    self._written[png_path] = (mmd_content, dimensions)
+            return ok, dimensions, cached, sizes
+        
+        return self._pool.submit(task)
+    
+    def convert_svg(self, svg_path: Path, png_path: Path) -> Future:
+        """Schedule an SVG → PNG conversion unless this version of the SVG is already queued.
+        
+        The future yields (ok, (bytes before, after)).
+        """
+        key = (png_path, svg_path.stat().st_mtime_ns)
+        with self._lock:
+            future = self._svg_futures.get(key)
+            if future is None:
+                future = self._pool.submit(self._convert_svg, svg_path, png_path)
+                self._svg_futures[key] = future
+            return future
+    
+    def _convert_svg(self, svg_path: Path, png_path: Path) -> tuple[bool, tuple[int, int]]:
+        with self.timings.span('svgexport', 'render', svg=str(svg_path)):
+            ok = convert_svg_to_png(svg_path, png_path, self.svg_width)
+        if not ok:
+            return False, (0, 0)
+        width, height = get_png_dimensions(png_path)
+        return True, self._optimize(png_path, (SVG_DISPLAY_WIDTH, SVG_DISPLAY_WIDTH * height / max(width, 1)))
+    
+    def _optimize(self, png_path: Path, display_size: tuple[float, float]) -> tuple[int, int]:
+        """Run :func:`optimize_png` when ``image_dpi`` is set; returns (bytes before, after)."""
+        if not self.image_dpi or png_path.suffix != '.png':
+            return 0, 0
+        with self.timings.span('optimize_image', 'render', image=str(png_path)):
+            return optimize_png(png_path, display_size, self.image_dpi)
+    
+    def convert_markdown(self, markdown: str, resource_path: Path,
+                         reference_doc: Path | None = None) -> bytes:
+        """Markdown → docx bytes: through the warm pandoc server if configured, else the pandoc CLI."""
+        if self.pandoc_server:
+            with self.timings.span('pandoc-server'):
+                docx_bytes = self.pandoc_server.convert(markdown, resource_path, reference_doc)
+            if docx_bytes is not None:
+                return docx_bytes
+        with self.timings.span('pandoc'):
+            return run_pandoc(markdown, resource_path, reference_doc)
+    
+    def convert_shards(self, pieces: list[str], resource_path: Path, reference_doc: Path | None,
+                       format_tables: bool, format_engine: str, compression: int | None,
+                       svg_pngs: dict[str, bytes] | None = None) -> list[bytes]:
+        """Phases 4-5 of each Markdown piece in parallel worker processes; docx bytes in order.
+        
+        Workers run the pandoc CLI (not the pandoc server) and the post-formatting,
+        so both the conversion and the Python formatting use one core per shard.
+        They are started fresh (forkserver, or spawn), never forked from this
+        process and its threads. A worker finds :func:`convert_shard` by this
+        module's name: run as a script, or loaded by path with importlib and
+        registered in ``sys.modules`` at import time (as the bench does).
+        Loaded any other way, the pieces are converted here one by one.
+        """
+        if getattr(sys.modules.get(__name__), 'convert_shard', None) is not convert_shard:
+            return [convert_shard(piece, resource_path, reference_doc, format_tables, format_engine,
+                                  self.vector, compression, svg_pngs) for piece in pieces]
+        with self._lock:
+            if self._shard_pool is None:
+                # Imported here: only sharded conversions need multiprocessing
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._shard_pool = ProcessPoolExecutor(max_workers=self.shards,
+                                                       mp_context=multiprocessing.get_context(method))
+        with self.timings.span('shards', count=len(pieces)):
+            futures = [self._shard_pool.submit(convert_shard, piece, resource_path, reference_doc,
+                                               format_tables, format_engine, self.vector, compression,
+                                               svg_pngs)
+                       for piece in pieces]
+            return [future.result() for future in futures]
+    
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self._shard_pool:
+            self._shard_pool.shutdown(wait=True)
+        if self.renderer:
+            self.renderer.close()
+        if self.pandoc_server:
+            self.pandoc_server.close()
+        if self._cache:
+            self._cache.save()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_pandoc(markdown: str, resource_path: Path, reference_doc: Path | None = None) -> bytes:
+    """Convert markdown to docx with pandoc entirely through pipes; returns the docx bytes.
+    
+    With ``reference_doc`` its styles are used, and code is left unhighlighted
+    so code blocks take the template's Source Code look.
+    """
+    result = run_tool('pandoc', pandoc_args(resource_path, reference_doc), input=markdown.encode('utf-8'),
+                      timeout=TOOL_TIMEOUTS['pandoc'], stdout_limit=None)
+    if result.returncode != 0:
+        raise ConversionError(f"pandoc failed: {result.stderr.decode('utf-8', 'replace')}")
+    return result.stdout
+
+
+PANDOC_SERVER_STARTUP = 10   # seconds to wait for a launched server to answer
+PANDOC_SERVER_TIMEOUT = 120  # seconds per conversion request
+
+
+class PandocServer:
+    """Convert through one long-lived ``pandoc server`` over HTTP on localhost.
+    
+    Spawning pandoc costs its runtime startup (and data file loading) on every
+    document; the server pays it once. With ``url=None`` a server is launched
+    on a free local port on first use (``pandoc-server`` if installed, else
+    ``pandoc server``); otherwise the server at ``url`` is used. The server
+    has no access to the file system, so every local image the markdown
+    references is sent along base64-encoded. ``convert()`` returns None
+    whenever the server can't produce the document, and the caller falls
+    back to :func:`run_pandoc`.
+    """
+    
+    def __init__(self, url: str | None = None):
+        self.url = url.rstrip('/') if url else None
+        self._proc = None
+        self._lock = threading.Lock()
+        self.available = None  # None = not started yet
+    
+    def start(self) -> bool:
+        """Launch (or probe) the server; return True once it answers."""
+        with self._lock:
+            if self.available is None:
+                self.available = self._launch()
+                if not self.available:
+                    print("⚠️  pandoc server unavailable, using the pandoc CLI")
+            return self.available
+    
+    def _launch(self) -> bool:
+        if self.url is None:
+            if shutil.which('pandoc-server'):
+                command = ['pandoc-server']
+            elif shutil.which('pandoc'):
+                command = ['pandoc', 'server']
+            else:
+                return False
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            try:
+                self._proc = subprocess.Popen(
+                    command + ['--port', str(port)],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+            except OSError:
+                return False
+            self.url = f'http://127.0.0.1:{port}'
+        
+        deadline = time.monotonic() + PANDOC_SERVER_STARTUP
+        while True:
+            try:
+                with urllib.request.urlopen(f'{self.url}/version', timeout=2) as response:
+                    response.read()
+                return True
+            except OSError:
+                if (self._proc is not None and self._proc.poll() is not None) or time.monotonic() > deadline:
+                    self._shutdown()
+                    return False
+                time.sleep(0.05)
+    
+    def convert(self, markdown: str, resource_path: Path,
+                reference_doc: Path | None = None) -> bytes | None:
+        """Markdown → docx bytes, or None if the server is unavailable or the conversion failed."""
+        if not self.start():
+            return None
+        
+        files = {}
+        for ref in find_image_references(markdown):
+            try:
+                files[ref] = base64.b64encode((resource_path / ref).read_bytes()).decode('ascii')
+            except OSError:
+                pass  # missing image: pandoc reports it the same way the CLI would
+        options = {'text': markdown, 'from': 'markdown', 'to': 'docx', 'files': files}
+        if reference_doc:
+            # Same as the CLI's --reference-doc ... --no-highlight
+            files['reference.docx'] = base64.b64encode(Path(reference_doc).read_bytes()).decode('ascii')
+            options.update({'reference-doc': 'reference.docx', 'highlight-style': None})
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(options).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Accept': 'application/octet-stream'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=PANDOC_SERVER_TIMEOUT) as response:
+                return response.read()
+        except urllib.error.HTTPError:
+            return None  # conversion error: let the CLI run report it
+        except OSError:
+            with self._lock:
+                self.available = False  # server gone: CLI from now on
+            return None
+    
+    def close(self):
+        """Stop the server if this instance launched it."""
+        with self._lock:
+            self._shutdown()
+    
+    def _shutdown(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+            self._proc = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write ``data`` to ``path`` via a temp file in the same directory and os.replace(),
+    so readers never see a partial document and concurrent writers don't interleave."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates 0600 files; keep the target's mode (or a normal 0644)
+        os.chmod(temp_name, path.stat().st_mode & 0o777 if path.exists() else 0o644)
+        os.replace(temp_name, path)
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+        raise
+
+
+class AssetPlan:
+    """The image work of one (preprocessed) Markdown text, and the text with its images referenced.
+    
+    ``diagrams`` maps each distinct diagram output (below ``base_dir /
+    images_rel``) to its Mermaid source. ``svg_jobs`` maps each PNG that is
+    missing or out of date to the SVG to convert, once per distinct SVG
+    content. With --vector, diagrams and SVG references stay SVG, and
+    ``fallbacks`` maps each SVG to the PNG (also among those jobs) that
+    older readers show instead. The caller runs the jobs its own way
+    (pipeline threads or service coroutines), then fills in the references
+    with :meth:`set_diagram` and :meth:`set_svgs` and hands :meth:`text` to pandoc.
+    """
+    
+    def __init__(self, content: str, base_dir: Path, pipeline: RenderPipeline,
+                 images_dir: str = 'images', images_rel: str | None = None):
+        self.pipeline = pipeline
+        self.images_dir = images_dir
+        self.images_rel = images_rel or images_dir
+        self.parts, self.diagram_slots, self.svg_slots = scan_assets(content)
+        images_path = base_dir / self.images_rel
+        self.diagram_paths = [images_path / name
+                              for name in diagram_names(self.diagram_slots, pipeline.diagram_suffix)]
+        self.diagrams = dict(zip(self.diagram_paths, (mmd_content for _, mmd_content in self.diagram_slots)))
+        if self.diagrams:
+            images_path.mkdir(parents=True, exist_ok=True)
+        self.fallbacks: dict[Path, Path] = {}
+        if pipeline.vector:
+            for svg_path, mmd_content in list(self.diagrams.items()):
+                self.fallbacks[svg_path] = svg_path.with_suffix('.png')
+                self.diagrams[svg_path.with_suffix('.png')] = mmd_content
+        
+        # SVG path as written → (SVG file, PNG or None to embed the SVG), None if missing
+        self.svg_targets: dict[str, tuple[Path, Path | None] | None] = {}
+        self.svg_jobs: dict[Path, Path] = {}
+        svg_pngs = {}  # SVG content hash → PNG of the first file with it
+        for _, _, svg_rel_path in self.svg_slots:
+            if svg_rel_path in self.svg_targets:
+                continue
+            svg_path = base_dir / svg_rel_path
+            if not svg_path.exists():
+                self.svg_targets[svg_rel_path] = None
+                continue
+            digest = file_sha256(svg_path)
+            png_path = svg_pngs.get(digest)
+            if png_path is None:
+                png_path = svg_pngs[digest] = base_dir / images_dir / (svg_path.stem + '.png')
+                if is_stale(png_path, svg_path) or (
+                        pipeline.image_dpi and get_png_dimensions(png_path)[0] != pipeline.svg_width):
+                    png_path.parent.mkdir(exist_ok=True)
+                    self.svg_jobs[png_path] = svg_path
+            if pipeline.vector:
+                # Embedded as-is (Word draws SVG natively); the PNG is only the fallback
+                self.svg_targets[svg_rel_path] = (svg_path, None)
+                self.fallbacks[svg_path] = png_path
+            else:
+                self.svg_targets[svg_rel_path] = (svg_path, png_path)
+    
+    def set_diagram(self, idx: int, ok: bool, dimensions: tuple[int, int]) -> str:
+        """Reference diagram ``idx``'s image, sized from ``dimensions`` if it rendered; returns the size."""
+        (slot, mmd_content), png_path = self.diagram_slots[idx], self.diagram_paths[idx]
+        size = calculate_optimal_size(png_path, mmd_content, dimensions,
+                                      both_dimensions=self.pipeline.vector) if ok else ''
+        self.parts[slot] = f'![Diagram {idx + 1}]({self.images_rel}/{png_path.name}){size}'
+        return size
+    
+    def set_svgs(self):
+        """Reference each found SVG as its PNG (90% max width = 5.8in), or as itself with --vector."""
+        for slot, alt_text, svg_rel_path in self.svg_slots:
+            target = self.svg_targets[svg_rel_path]
+            if target is None:
+                continue
+            svg_path, png_path = target
+            if png_path is not None:
+                self.parts[slot] = f'![{alt_text}]({self.images_dir}/{png_path.name}){{width={SVG_DISPLAY_WIDTH}in}}'
+                continue
+            width, height = get_svg_dimensions(svg_path)
+            size = f'width={SVG_DISPLAY_WIDTH}in'
+            if width and height:
+                size += f' height={SVG_DISPLAY_WIDTH * height / width:.2f}in'
+            self.parts[slot] = f'![{alt_text}]({svg_rel_path}){{{size}}}'
+    
+    def text(self) -> str:
+        return ''.join(self.parts)
+    
+    def svg_pngs(self, failed: set[Path]) -> tuple[dict[str, bytes], list[Path]]:
+        """The ``fallbacks`` that rendered, keyed by their SVG's SHA-256, and the SVGs left without one.
+        
+        ``failed`` holds the PNG paths whose job failed (an older PNG may still be on disk).
+        """
+        pngs = {}
+        missing = []
+        for svg_path, png_path in self.fallbacks.items():
+            digest = file_sha256(svg_path)
+            if digest is None:
+                continue  # the SVG itself failed to render
+            try:
+                if png_path in failed:
+                    raise OSError
+                pngs[digest] = png_path.read_bytes()
+            except OSError:
+                missing.append(svg_path)
+        return pngs, missing
+
+
+def render_docx(content: str, base_dir: Path, pipeline: RenderPipeline,
+                images_dir: str = 'images', image_subdir: str = '',
+                format_tables: bool = True, format_engine: str = 'single-pass',
+                reference_doc: Path | None = None, temp_md: Path | None = None,
+                compression: int | None = None, log=print) -> tuple[bytes, dict]:
+    """Markdown text → formatted docx bytes (Phases 0-5 of a conversion).
+    
+    Relative image paths resolve against ``base_dir``, and rendered diagrams
+    and SVG conversions are written below ``base_dir / images_dir``. With
+    ``temp_md`` the markdown handed to pandoc is also written there.
+    ``compression`` is the streaming engine's deflate level.
+    Returns (docx bytes, {'diagrams': n, 'failures': n}).
+    """
+    timings = pipeline.timings
+    
+    images_rel = f'{images_dir}/{image_subdir}' if image_subdir else images_dir
+    (base_dir / images_dir).mkdir(exist_ok=True)
+    failures = 0
+    image_bytes = [0, 0, 0]  # images optimized, bytes before, bytes after
+    
+    def count_optimized(sizes: tuple[int, int]):
+        if sizes[0]:
+            image_bytes[0] += 1
+            image_bytes[1] += sizes[0]
+            image_bytes[2] += sizes[1]
     
     # Phase 0: Preprocess markdown to fix formatting issues
-    print(f"🔧 Preprocessing markdown...")
-    content = preprocess_markdown(content)
+    log(f"🔧 Preprocessing markdown...")
+    with timings.span('preprocess'):
+        content = preprocess_markdown(content)
     
-    # Phase 1: Find and convert Mermaid diagrams
-    mermaid_blocks = find_mermaid_blocks(content)
-    print(f"📊 Found {len(mermaid_blocks)} Mermaid diagrams")
-    
-    replacements = []
-    for idx, mmd_content in mermaid_blocks:
-        png_name = f'diagram-{idx + 1}.png'
-        png_path = images_dir / png_name
-        
-        print(f"   Converting diagram {idx + 1}...", end=' ')
-        if convert_mermaid_to_png(mmd_content, png_path):
-            # Calculate optimal size from actual PNG dimensions
-            size = calculate_optimal_size(png_path, mmd_content)
-            replacements.append(f'![Diagram {idx + 1}]({args.images_dir}/{png_name}){size}')
-            print(f"✓ {size}")
+    # Phase 1: Find Mermaid diagrams and SVG references (one scan)
+    with timings.span('scan_assets'):
+        plan = AssetPlan(content, base_dir, pipeline, images_dir, images_rel)
+    unique = len(set(plan.diagram_paths))
+    log(f"📊 Found {len(plan.diagram_paths)} Mermaid diagrams" +
+        (f" ({unique} unique)" if unique < len(plan.diagram_paths) else ""))
+    
+    # Mermaid and SVG assets render concurrently in the pipeline; results are
+    # consumed in submission order so file names, replacements and progress
+    # stay deterministic
+    svg_futures = {png_path: pipeline.convert_svg(svg_path, png_path)
+                   for png_path, svg_path in plan.svg_jobs.items()}
+    diagram_futures = {png_path: pipeline.render_diagram(mmd_content, png_path)
+                       for png_path, mmd_content in plan.diagrams.items()}
+    
+    # Phase 3: Replace mermaid blocks with image references
+    first_use = {}
+    for idx, png_path in enumerate(plan.diagram_paths):
+        repeat_of = first_use.setdefault(png_path, idx + 1)
+        
+        log(f"   Converting diagram {idx + 1}...", end=' ', flush=True)
+        with timings.span('wait_diagram'):
+            ok, dimensions, cached, sizes = diagram_futures[png_path].result()
+        if repeat_of == idx + 1:
+            count_optimized(sizes)
+        size = plan.set_diagram(idx, ok, dimensions)
+        if not ok:
+            log("✗ (failed)")
+            failures += 1
+        elif repeat_of != idx + 1:
+            log(f"✓ {size} (same as diagram {repeat_of})")
         else:
-            print("✗ (failed)")
-            replacements.append(f'![Diagram {idx + 1}]({args.images_dir}/{png_name})')
+            log(f"✓ {size}" + (" (cached)" if cached else ""))
     
     # Phase 2: Convert SVG references to PNG
-    svg_pattern = r'!\[([^\]]*)\]\(([^)]+\.svg)\)'
-    for match in re.finditer(svg_pattern, content):
-        alt_text, svg_rel_path = match.groups()
-        svg_path = source_path.parent / svg_rel_path
-        
-        if svg_path.exists():
-            png_name = svg_path.stem + '.png'
-            png_path = images_dir / png_name
+    for png_path, future in svg_futures.items():
+        log(f"🖼️  Converting SVG: {plan.svg_jobs[png_path].name}...", end=' ', flush=True)
+        with timings.span('wait_svg'):
+            svg_ok, sizes = future.result()
+        count_optimized(sizes)
+        if svg_ok:
+            log("✓")
+        else:
+            log("✗")
+            if not pipeline.vector:  # with --vector only the PNG fallback is missing
+                failures += 1
+    plan.set_svgs()
+    
+    svg_pngs = None
+    if plan.fallbacks:
+        failed = set()
+        for png_path in plan.fallbacks.values():
+            future = diagram_futures.get(png_path) or svg_futures.get(png_path)
+            if future is not None and not future.result()[0]:
+                failed.add(png_path)
+        svg_pngs, missing = plan.svg_pngs(failed)
+        for svg_path in missing:
+            log(f"⚠️  No PNG fallback for {svg_path.name}: Word 2013 and older will show a blank image")
+    
+    if image_bytes[0]:
+        count, before, after = image_bytes
+        saved = 100 * (before - after) / before if before else 0
+        log(f"🗜️  Images: {count} optimized, {before / 1024:.0f} KB → {after / 1024:.0f} KB (saved {saved:.0f}%)")
+    
+    content = plan.text()
+    
+    # Debug copy of the markdown handed to pandoc
+    if temp_md is not None:
+        temp_md.write_text(content, encoding='utf-8')
+    
+    # Phase 4: Convert to Word with pandoc (markdown on stdin, docx on stdout)
+    # Use --resource-path so pandoc resolves relative image paths from base_dir
+    log(f"📝 Generating Word document...")
+    pieces = [content]
+    if pipeline.shards > 1:
+        with timings.span('shard_split'):
+            pieces = split_markdown(content, pipeline.shards)
+    if len(pieces) > 1:
+        # Phases 4-5 per piece in worker processes, then one package again
+        log(f"🧩 Converting and formatting {len(pieces)} shards in parallel...")
+        shard_docs = pipeline.convert_shards(pieces, base_dir.resolve(), reference_doc,
+                                             format_tables, format_engine, compression, svg_pngs)
+        with timings.span('shard_merge'):
+            docx_bytes = merge_docx_shards(shard_docs, compression)
+        return docx_bytes, {'diagrams': len(plan.diagram_paths), 'failures': failures}
+    docx_bytes = pipeline.convert_markdown(content, base_dir.resolve(), reference_doc)
+    
+    # Phase 5: Apply all formatting (tables, images, headings, spacing) in memory
+    log(f"🎨 Applying formatting...")
+    docx_bytes = format_docx(docx_bytes, format_tables, format_engine, reference_doc is not None,
+                             pipeline.vector, timings, compression, svg_pngs)
+    return docx_bytes, {'diagrams': len(plan.diagram_paths), 'failures': failures}
+
+
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP_END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP_UTF8_NAMES = 0x800  # general purpose flag: file name is UTF-8
+ZIP_MAX = 0xFFFFFFFF    # largest size/offset without ZIP64
+DEFAULT_COMPRESSION = 6  # zlib's default deflate level
+DOCUMENT_PART = 'word/document.xml'
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n"  # as python-docx saves parts
+XMLNS_RE = re.compile(rb' xmlns(?::[\w.-]+)?="[^"]*"')
+START_TAG_XMLNS_RE = re.compile(rb'<[\w.:-]+((?: xmlns(?::[\w.-]+)?="[^"]*")*)')
+STREAM_CHUNK = 1024 * 1024  # bytes of document.xml fed to the parser at a time
+
+
+def zip_dos_time(date_time: tuple) -> tuple[int, int]:
+    """(time, date) fields of a ZIP header for a ZipInfo ``date_time``."""
+    year, month, day, hour, minute, second = date_time
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+
+class ZipWriter:
+    """Minimal ZIP writer that can copy entries out of another archive as stored.
+    
+    ``copy`` writes an entry's compressed bytes straight from the source
+    archive (no inflate/deflate round trip for media), ``stream`` deflates
+    data as it is produced and patches CRC and sizes into the local header
+    afterwards, so ``fp`` must be seekable. There is no ZIP64 support; a
+    package beyond 4 GB raises ConversionError.
+    """
+    
+    def __init__(self, fp):
+        self.fp = fp
+        self._entries = []  # [name, flags, method, time, date, crc, compressed, size, offset]
+    
+    def _begin(self, name: str, method: int, date_time: tuple, crc: int = 0,
+               compressed: int = 0, size: int = 0) -> list:
+        offset = self.fp.tell()
+        if offset > ZIP_MAX:
+            raise ConversionError("docx larger than 4 GB: use --format-engine single-pass")
+        encoded = name.encode('utf-8')
+        flags = 0 if name.isascii() else ZIP_UTF8_NAMES
+        time_, date = zip_dos_time(date_time)
+        entry = [encoded, flags, method, time_, date, crc, compressed, size, offset]
+        self.fp.write(ZIP_LOCAL_HEADER.pack(0x04034B50, 20, flags, method, time_, date,
+                                            crc, compressed, size, len(encoded), 0))
+        self.fp.write(encoded)
+        self._entries.append(entry)
+        return entry
+    
+    def copy(self, source: memoryview, info: zipfile.ZipInfo, name: str | None = None):
+        """Copy ``info``'s entry of the archive bytes ``source`` (as ``name``) without recompressing it."""
+        self._begin(name or info.filename, info.compress_type, info.date_time, info.CRC,
+                    info.compress_size, info.file_size)
+        self.fp.write(stored_bytes(source, info))
+    
+    def stream(self, name: str, chunks, level: int, date_time: tuple):
+        """Write an entry from an iterable of byte chunks, deflated at ``level`` (0 = stored)."""
+        entry = self._begin(name, zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED, date_time)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if level else None
+        crc = size = compressed = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            compressed += len(chunk)
+            self.fp.write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compressed += len(chunk)
+            self.fp.write(chunk)
+        if max(size, compressed) > ZIP_MAX:
+            raise ConversionError(f"{name} larger than 4 GB: use --format-engine single-pass")
+        entry[5:8] = crc, compressed, size
+        end = self.fp.tell()
+        self.fp.seek(entry[8] + 14)  # CRC-32, compressed size, size in the local header
+        self.fp.write(struct.pack('<III', crc, compressed, size))
+        self.fp.seek(end)
+    
+    def close(self):
+        """Write the central directory."""
+        start = self.fp.tell()
+        for name, flags, method, time_, date, crc, compressed, size, offset in self._entries:
+            self.fp.write(ZIP_CENTRAL_HEADER.pack(0x02014B50, 20, 20, flags, method, time_, date, crc,
+                                                  compressed, size, len(name), 0, 0, 0, 0, 0, offset))
+            self.fp.write(name)
+        end = self.fp.tell()
+        if end > ZIP_MAX or len(self._entries) > 0xFFFF:
+            raise ConversionError("docx too large for a ZIP without ZIP64: use --format-engine single-pass")
+        count = len(self._entries)
+        self.fp.write(ZIP_END_RECORD.pack(0x06054B50, 0, 0, count, count, end - start, start, 0))
+
+
+def duplicate_media(package: zipfile.ZipFile, source: memoryview) -> dict[str, str]:
+    """Media entries whose bytes repeat an earlier entry's: {duplicate name: first name}.
+    
+    Candidates share extension, CRC and size (from the central directory);
+    they are confirmed by comparing the stored bytes, inflating only when
+    the two entries were compressed differently.
+    """
+    first_by_key = {}
+    duplicates = {}
+    for info in package.infolist():
+        if not info.filename.startswith('word/media/') or info.is_dir():
+            continue
+        key = (posixpath.splitext(info.filename)[1].lower(), info.CRC, info.file_size)
+        for first in first_by_key.setdefault(key, []):
+            if (first.compress_type == info.compress_type and first.compress_size == info.compress_size and
+                    stored_bytes(source, first) == stored_bytes(source, info)) or \
+                    package.read(first) == package.read(info):
+                duplicates[info.filename] = first.filename
+                break
+        else:
+            first_by_key[key].append(info)
+    return duplicates
+
+
+def stored_bytes(source: memoryview, info: zipfile.ZipInfo) -> memoryview:
+    """An entry's data as stored in the archive (compressed), without copying it."""
+    fields = ZIP_LOCAL_HEADER.unpack_from(source, info.header_offset)
+    start = info.header_offset + ZIP_LOCAL_HEADER.size + fields[9] + fields[10]
+    return source[start:start + info.compress_size]
+
+
+def relink_relationships(rels_xml: bytes, part_dir: str, duplicates: dict[str, str],
+                         merge: bool) -> tuple[bytes | None, dict[str, str]]:
+    """Point a .rels file's relationships to ``duplicates`` at the kept part.
+    
+    With ``merge`` a relationship that now repeats another one (same type
+    and target) is removed, and the returned {removed Id: kept Id} says how
+    to rewrite the references in the source part. The XML is None when no
+    relationship changed.
+    """
+    root = etree.fromstring(rels_xml)
+    kept = {}
+    remap = {}
+    changed = False
+    for rel in list(root):
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = posixpath.normpath(posixpath.join(part_dir, rel.get('Target', ''))).lstrip('/')
+        first = duplicates.get(target, target)
+        key = (rel.get('Type'), first)
+        if merge and key in kept:
+            remap[rel.get('Id')] = kept[key]
+            root.remove(rel)
+            changed = True
+            continue
+        kept.setdefault(key, rel.get('Id'))
+        if first != target:
+            rel.set('Target', posixpath.relpath(first, part_dir))
+            changed = True
+    if not changed:
+        return None, remap
+    return etree.tostring(root, encoding='UTF-8', standalone=True), remap
+
+
+def add_relationship(rels_xml: bytes, reltype: str, target: str) -> tuple[bytes, str]:
+    """Append a relationship to a .rels file; returns the new XML and its Id.
+    
+    The Id is the lowest free ``rIdN``, as python-docx picks it.
+    """
+    root = etree.fromstring(rels_xml)
+    used = {rel.get('Id') for rel in root}
+    rId = next(f'rId{n}' for n in range(1, len(used) + 2) if f'rId{n}' not in used)
+    etree.SubElement(root, f'{{{root.nsmap[None]}}}Relationship', Id=rId, Type=reltype, Target=target)
+    return etree.tostring(root, encoding='UTF-8', standalone=True), rId
+
+
+def add_default_content_type(types_xml: bytes, extension: str, content_type: str) -> bytes:
+    """Declare ``extension`` in [Content_Types].xml unless it already is."""
+    root = etree.fromstring(types_xml)
+    namespace = root.nsmap[None]
+    if any(default.get('Extension', '').lower() == extension for default in root.iter(f'{{{namespace}}}Default')):
+        return types_xml
+    root.insert(0, etree.Element(f'{{{namespace}}}Default', Extension=extension, ContentType=content_type))
+    return etree.tostring(root, encoding='UTF-8', standalone=True)
+
+
+def svg_fallbacks_needed(stream) -> list[str]:
+    """SVG relationship ids of the pictures in a document.xml stream that need a raster fallback.
+    
+    In order of first use, each once (constant memory).
+    """
+    rIds = {}
+    for _, blip in etree.iterparse(stream, tag=qn('a:blip')):
+        if needs_svg_fallback(blip):
+            rIds.setdefault(svg_blip_rId(blip), None)
+        blip.clear()
+    return list(rIds)
+
+
+def iter_formatted_document(stream, format_child, relink=None):
+    """Parse document.xml from ``stream`` and yield it back formatted, one body child at a time.
+    
+    An ``XMLPullParser`` with python-docx's element classes builds the tree
+    incrementally; each top-level ``w:body`` child is handed to
+    ``format_child(child, None)`` and ``relink(child)`` as soon as it is
+    complete, serialized, and removed, so the body is never held whole.
+    The output is the same XML python-docx would save for the same edits.
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'), remove_blank_text=True, resolve_entities=False)
+    parser.set_element_class_lookup(element_class_lookup)
+    depth = 0
+    body = None
+    declared = set()
+    tail = b''
+    while chunk := stream.read(STREAM_CHUNK):
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag == qn('w:body'):
+                    body = element
+                    head, tail = document_shell(element)
+                    declared = set(XMLNS_RE.findall(head))
+                    yield XML_DECLARATION + head
+                continue
+            depth -= 1
+            if depth == 2 and body is not None and element.getparent() is body:
+                format_child(element, None)
+                if relink:
+                    relink(element)
+                xml = etree.tostring(element, encoding='UTF-8', xml_declaration=False)
+                # tostring() repeats the in-scope namespace declarations the root already makes
+                match = START_TAG_XMLNS_RE.match(xml)
+                if match and match.group(1):
+                    own = b''.join(decl for decl in XMLNS_RE.findall(match.group(1)) if decl not in declared)
+                    xml = xml[:match.start(1)] + own + xml[match.end(1):]
+                yield xml
+                body.remove(element)
+    parser.close()
+    if body is None:
+        raise ConversionError("word/document.xml has no w:body")
+    yield tail
+
+
+def document_shell(body) -> tuple[bytes, bytes]:
+    """Serialized document.xml around the body's children: (root and body start tags, end tags)."""
+    root = body.getparent()
+    shell = etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+    for sibling in reversed(list(body.itersiblings(preceding=True))):
+        shell.append(copy.deepcopy(sibling))
+    etree.SubElement(shell, body.tag, dict(body.attrib))
+    xml = etree.tostring(shell, encoding='UTF-8', xml_declaration=False)
+    split = xml.rindex(b'/>')  # the empty body closes itself: <w:body/></w:document>
+    body_name = xml[xml.rindex(b'<', 0, split) + 1:split].split()[0]
+    return xml[:split] + b'>', b'</' + body_name + b'>' + xml[split + 2:]
+
+
+def stream_format_docx(docx_bytes: bytes, format_tables: bool = True, reference_styles: bool = False,
+                       vector: bool = False, compression: int | None = None,
+                       timings: Timings | None = None, svg_pngs: dict[str, bytes] | None = None) -> bytes:
+    """Phase 5 without loading the package: rewrite document.xml as a stream, copy everything else.
+    
+    The ``streaming`` format engine. Media and every part that needs no
+    change are copied as stored, without inflating them; only
+    document.xml (and the small .rels/[Content_Types].xml files when media
+    is deduplicated or an SVG fallback is added) is written anew, deflated
+    at ``compression`` (0-9, default 6). Formatting is the single-pass
+    engine's, applied per body child by :func:`iter_formatted_document`,
+    so peak memory is the input and output bytes plus one table or
+    paragraph rather than the whole parsed package. ``svg_pngs`` are the
+    rendered SVG fallbacks, as for :func:`add_svg_fallbacks`.
+    """
+    ensure_docx()
+    timings = timings or Timings(enabled=False)
+    level = DEFAULT_COMPRESSION if compression is None else compression
+    source = memoryview(docx_bytes)
+    package = zipfile.ZipFile(io.BytesIO(docx_bytes))
+    names = set(package.namelist())
+    document_rels = 'word/_rels/document.xml.rels'
+    if not {DOCUMENT_PART, document_rels, 'word/styles.xml', '[Content_Types].xml'} <= names:
+        # Not laid out like pandoc's output: let python-docx find the parts
+        return format_docx(docx_bytes, format_tables, 'single-pass', reference_styles, vector, timings,
+                           svg_pngs=svg_pngs)
+    
+    rewritten = {}  # entry name → new bytes
+    with timings.span('dedupe_media'):
+        duplicates = duplicate_media(package, source)
+        remap = {}
+        if duplicates:
+            for name in names:
+                if not name.endswith('.rels'):
+                    continue
+                part_dir = posixpath.dirname(posixpath.dirname(name))  # word/_rels/x.xml.rels is word/x.xml's
+                rels, ids = relink_relationships(package.read(name), part_dir, duplicates,
+                                                 merge=name == document_rels)
+                if rels is not None:
+                    rewritten[name] = rels
+                if name == document_rels:
+                    remap = ids
+    
+    fallback_rIds = {}  # SVG relationship id → its fallback PNG's
+    fallbacks = {}      # new media entry → PNG bytes
+    if vector:
+        with timings.span('svg_fallbacks'):
+            with package.open(DOCUMENT_PART) as stream:
+                needed = svg_fallbacks_needed(stream)
+            if needed:
+                rels_xml = rewritten.get(document_rels) or package.read(document_rels)
+                targets = {rel.get('Id'): rel.get('Target') for rel in etree.fromstring(package.read(document_rels))}
+                png_rIds = {}  # PNG bytes → relationship id
+                for svg_rId in needed:
+                    svg = package.read(posixpath.normpath(posixpath.join('word', targets[svg_rId])))
+                    png = svg_fallback_for(svg, svg_pngs)
+                    if png not in png_rIds:
+                        # named like python-docx's image parts, so both engines write the same package
+                        fallback = next(f'word/media/image{n}.png' for n in itertools.count(1)
+                                        if f'word/media/image{n}.png' not in names | fallbacks.keys())
+                        fallbacks[fallback] = png
+                        rels_xml, png_rIds[png] = add_relationship(rels_xml, RT.IMAGE,
+                                                                   posixpath.relpath(fallback, 'word'))
+                    fallback_rIds[svg_rId] = png_rIds[png]
+                rewritten[document_rels] = rels_xml
+                rewritten['[Content_Types].xml'] = add_default_content_type(
+                    package.read('[Content_Types].xml'), 'png', 'image/png')
+    
+    attrs = [qn(attr) for attr in RELATIONSHIP_ATTRS]
+    a_blip = qn('a:blip')
+    
+    def relink(child):
+        for element in child.iter():
+            if fallback_rIds and element.tag == a_blip and needs_svg_fallback(element):
+                # before its svgBlip child is remapped: fallbacks are keyed by the original ids
+                element.set(qn('r:embed'), fallback_rIds[svg_blip_rId(element)])
+            if remap:
+                for attr in attrs:
+                    if element.get(attr) in remap:
+                        element.set(attr, remap[element.get(attr)])
+    
+    styles = Styles(parse_xml(package.read('word/styles.xml')))
+    format_child = body_child_formatter(styles, format_tables, reference_styles, timings)
+    output = io.BytesIO()
+    writer = ZipWriter(output)
+    for info in package.infolist():
+        name = info.filename
+        if name in duplicates:
+            continue
+        if name == DOCUMENT_PART:
+            with timings.span('format'), package.open(info) as stream:
+                writer.stream(name, iter_formatted_document(stream, format_child,
+                                                            relink if remap or fallback_rIds else None),
+                              level, info.date_time)
+            timings.flush()
+        elif name in rewritten:
+            writer.stream(name, [rewritten[name]], level, info.date_time)
+        else:
+            writer.copy(source, info)
+    for fallback, png in fallbacks.items():
+        writer.stream(fallback, [png], 0, package.getinfo(DOCUMENT_PART).date_time)
+    with timings.span('docx_save'):
+        writer.close()
+    return output.getvalue()
+
+
+def format_docx(docx_bytes: bytes, format_tables: bool = True, format_engine: str = 'single-pass',
+                reference_styles: bool = False, vector: bool = False,
+                timings: Timings | None = None, compression: int | None = None,
+                svg_pngs: dict[str, bytes] | None = None) -> bytes:
+    """Phase 5: load pandoc's docx, apply the post-formatting and return the saved bytes.
+    
+    The ``streaming`` engine goes through :func:`stream_format_docx` instead
+    (``compression`` is its deflate level). With ``vector``, SVG pictures get
+    their PNG from ``svg_pngs`` as raster fallback (see :func:`add_svg_fallbacks`).
+    """
+    if format_engine == 'streaming':
+        return stream_format_docx(docx_bytes, format_tables, reference_styles, vector, compression, timings,
+                                  svg_pngs)
+    timings = timings or Timings(enabled=False)
+    with timings.span('docx_load'):
+        ensure_docx()
+        doc = Document(io.BytesIO(docx_bytes))
+    if vector:
+        with timings.span('svg_fallbacks'):
+            add_svg_fallbacks(doc, svg_pngs)
+    with timings.span('dedupe_media'):
+        dedupe_media(doc)
+    with timings.span('format'):
+        apply_all_formatting(doc, format_tables_flag=format_tables, engine=format_engine,
+                             reference_styles=reference_styles, timings=timings)
+    with timings.span('docx_save'):
+        buffer = io.BytesIO()
+        doc.save(buffer)
+    return buffer.getvalue()
+
+
+ATX_HEADING_RE = re.compile(r' {0,3}(#{1,6})(?:[ \t]|$)')
+DEFINITION_RE = re.compile(r' {0,3}\[(\^?)[^\]]+\]:')  # [label]: url and [^note]: text
+
+
+def split_markdown(content: str, shards: int) -> list[str]:
+    """Cut Markdown into at most ``shards`` pieces of similar size at top-level headings.
+    
+    "Top-level" is the shallowest ATX heading level used more than once (a
+    lone title above the chapters doesn't count), and shallower headings cut
+    too; headings inside fenced code are ignored. Each piece also gets the link
+    reference and footnote definitions of the other pieces appended, so
+    references resolve as they would in one pandoc run (pandoc ignores the
+    definitions a piece doesn't use). Returns ``[content]`` when there is
+    nothing to split.
+    """
+    lines = content.split('\n')
+    headings = []     # (line index, level)
+    definitions = []  # (first line, end line)
+    fence = None
+    index = 0
+    while index < len(lines):
+        stripped = lines[index].strip()
+        first = stripped[:1]
+        if fence:
+            if first == fence[0] and len(stripped) >= len(fence) and not stripped.strip(first):
+                fence = None
+        elif first in '`~' and stripped and CODE_FENCE_RE.match(stripped):
+            fence = CODE_FENCE_RE.match(stripped).group(1)
+        elif heading := ATX_HEADING_RE.match(lines[index]):
+            headings.append((index, len(heading.group(1))))
+        elif definition := DEFINITION_RE.match(lines[index]):
+            end = index + 1
+            if definition.group(1):
+                # A footnote continues over indented lines (and blank lines between them)
+                # and, lazily, over any text right below its text up to the next footnote
+                while end < len(lines) and (lines[end][:1] in ('', ' ', '\t') or (
+                        lines[end].strip() and lines[end - 1].strip()
+                        and not lines[end].lstrip().startswith('[^'))):
+                    end += 1
+                while end > index + 1 and not lines[end - 1].strip():
+                    end -= 1
+            definitions.append((index, end))
+            index = end
+            continue
+        index += 1
+    
+    levels = [level for _, level in headings]
+    top = min((level for level in levels if levels.count(level) > 1), default=0)
+    starts = [0] + [line for line, level in headings if level <= top and line > 0]
+    if shards < 2 or len(starts) < 2:
+        return [content]
+    
+    # Greedily close a piece once it passes its share of the characters
+    sizes = [sum(len(line) + 1 for line in lines[start:end])
+             for start, end in zip(starts, starts[1:] + [len(lines)])]
+    target = sum(sizes) / shards
+    cuts = [0]
+    total = 0
+    for start, size in zip(starts, sizes):
+        if total >= target * len(cuts) and start > cuts[-1]:
+            cuts.append(start)
+        total += size
+    bounds = list(zip(cuts, cuts[1:] + [len(lines)]))
+    
+    pieces = []
+    for start, end in bounds:
+        others = ['\n'.join(lines[first:last]) for first, last in definitions if not start <= first < end]
+        piece = '\n'.join(lines[start:end])
+        pieces.append(piece + '\n\n' + '\n\n'.join(others) + '\n' if others else piece)
+    return pieces
+
+
+def convert_shard(markdown: str, resource_path: Path, reference_doc: Path | None, format_tables: bool,
+                  format_engine: str, vector: bool, compression: int | None,
+                  svg_pngs: dict[str, bytes] | None = None) -> bytes:
+    """Phases 4-5 for one piece of a sharded conversion (runs in a worker process)."""
+    docx_bytes = run_pandoc(markdown, resource_path, reference_doc)
+    return format_docx(docx_bytes, format_tables, format_engine, reference_doc is not None,
+                       vector, None, compression, svg_pngs)
+
+
+SHARD_STORY_PARTS = ('word/document.xml', 'word/footnotes.xml', 'word/comments.xml')
+SHARD_COUNTER_IDS = (  # (element, attribute) numbered from pandoc's per-document id counter
+    ('w:bookmarkStart', 'w:id'), ('w:bookmarkEnd', 'w:id'),
+    ('w:footnote', 'w:id'), ('w:footnoteReference', 'w:id'),
+    ('w:comment', 'w:id'), ('w:commentRangeStart', 'w:id'), ('w:commentRangeEnd', 'w:id'),
+    ('w:commentReference', 'w:id'), ('wp:docPr', 'id'), ('pic:cNvPr', 'id'),
+)
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+SHARD_RELATIONSHIP_XPATH = '//*[' + ' or '.join(f'@{attr}' for attr in RELATIONSHIP_ATTRS) + ']'
+RELATIONSHIPS_XML = (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                     b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>')
+DUPLICATE_ID_RE = re.compile(r'(.+)-\d+')
+
+
+def rels_name(part: str) -> str:
+    """The .rels entry describing ``part`` (word/x.xml → word/_rels/x.xml.rels)."""
+    directory, name = posixpath.split(part)
+    return posixpath.join(directory, '_rels', name + '.rels')
+
+
+def xml_part(root) -> bytes:
+    return etree.tostring(root, encoding='UTF-8', xml_declaration=True, standalone=True)
+
+
+class ShardMerger:
+    """Join the docx packages of consecutive shards of one document into one package.
+    
+    The first shard is the base: its parts are kept and the later shards'
+    body, footnotes and comments are appended to them. What pandoc numbers
+    per run is renumbered so the result reads like one conversion:
+    
+    - ids from pandoc's counter (relationships of images and links,
+      bookmarks, notes, comments, drawing ids) are shifted past the ids
+      already used, keeping their order;
+    - every list (``w:num``) a shard uses gets a new numId after the
+      existing ones, so each list restarts as it would; abstract list
+      definitions and unused nums are shared when identical;
+    - media with the same bytes become one part (as :func:`dedupe_media`),
+      new media are copied without recompressing;
+    - styles pandoc only adds when used are merged by styleId, and content
+      types by extension and part name;
+    - a heading bookmark whose name is already taken gets pandoc's next
+      ``-N`` suffix, so links to a repeated heading name still go to the
+      first one.
+    """
+    
+    def __init__(self, base: bytes):
+        ensure_docx()
+        self._base_bytes = base
+        self._base = zipfile.ZipFile(io.BytesIO(base))
+        self._parts = {}  # parsed base parts, by entry name
+        self._media = {}  # sha256 → media entry name
+        self._extra = []  # (source bytes, ZipInfo, new name) of media copied from later shards
+        self._names = set(self._base.namelist())
+        self._next_id = 0
+        self._last_sect_pr = None
+        roots = self._load(self._base)
+        for info in self._base.infolist():
+            if info.filename.startswith('word/media/'):
+                self._media.setdefault(hashlib.sha256(self._base.read(info)).hexdigest(), info.filename)
+        self._next_id = max(self._counter_ids(self._base, roots), default=0) + 1
+        self._bookmarks = {start.get(qn('w:name')) for start in roots['word/document.xml'].iter(qn('w:bookmarkStart'))}
+        self._parts.update(roots)
+        for part in SHARD_STORY_PARTS:
+            if part in roots:
+                self._parts[rels_name(part)] = etree.fromstring(self._read(self._base, rels_name(part)))
+        for name in ('word/numbering.xml', 'word/styles.xml', '[Content_Types].xml'):
+            if name in self._names:
+                self._parts[name] = etree.fromstring(self._base.read(name))
+        body = roots['word/document.xml'].find(qn('w:body'))
+        self._body = body
+        sect_pr = body.find(qn('w:sectPr'))
+        if sect_pr is not None:
+            body.remove(sect_pr)
+            self._last_sect_pr = sect_pr
+    
+    @staticmethod
+    def _read(package: zipfile.ZipFile, name: str) -> bytes:
+        try:
+            return package.read(name)
+        except KeyError:
+            return RELATIONSHIPS_XML
+    
+    @staticmethod
+    def _load(package: zipfile.ZipFile) -> dict:
+        """Parsed story parts of a shard package."""
+        names = set(package.namelist())
+        return {part: etree.fromstring(package.read(part)) for part in SHARD_STORY_PARTS if part in names}
+    
+    @staticmethod
+    def _counter_ids(package: zipfile.ZipFile, roots: dict) -> list[int]:
+        """Every positive id from pandoc's counter in a shard: relationship numbers and element ids."""
+        ids = []
+        for part, root in roots.items():
+            for tag, attr in SHARD_COUNTER_IDS:
+                for element in root.iter(qn(tag)):
+                    value = element.get(qn(attr) if ':' in attr else attr, '')
+                    if value.isdigit() and int(value) > 0:
+                        ids.append(int(value))
+            for rel in etree.fromstring(ShardMerger._read(package, rels_name(part))):
+                if rel.get('Id', '')[3:].isdigit() and (rel.get('TargetMode') == 'External' or
+                                                       'media/' in rel.get('Target', '')):
+                    ids.append(int(rel.get('Id')[3:]))
+        return ids
+    
+    def add(self, shard: bytes):
+        """Append the next shard."""
+        package = zipfile.ZipFile(io.BytesIO(shard))
+        source = memoryview(shard)
+        roots = self._load(package)
+        ids = self._counter_ids(package, roots)
+        shift = self._next_id - min(ids) if ids else 0
+        if ids:
+            self._next_id = max(ids) + shift + 1
+        num_ids = self._merge_numbering(package, roots)
+        self._merge_styles(package)
+        self._merge_content_types(package)
+        
+        for part, root in roots.items():
+            rel_ids = self._merge_rels(package, source, part, shift)
+            self._renumber(root, shift, rel_ids, num_ids)
+            if part == 'word/document.xml':
+                self._rename_bookmarks(root)
+                body = root.find(qn('w:body'))
+                for child in list(body):
+                    if child.tag == qn('w:sectPr'):
+                        self._last_sect_pr = child
+                    else:
+                        self._body.append(child)
+            elif part in self._parts:
+                base = self._parts[part]
+                for child in list(root):
+                    if child.get(qn('w:type')) is None:  # separators are the base's
+                        base.append(child)
+    
+    def _renumber(self, root, shift: int, rel_ids: dict, num_ids: dict):
+        # Each kind is looked up by tag (or XPath) rather than testing every element
+        if shift:
+            for tag, attr in SHARD_COUNTER_IDS:
+                attr = qn(attr) if ':' in attr else attr
+                for element in root.iter(qn(tag)):
+                    value = element.get(attr, '')
+                    if value.isdigit() and int(value) > 0:
+                        element.set(attr, str(int(value) + shift))
+        val = qn('w:val')
+        for element in root.iter(qn('w:numId')):
+            if element.get(val) in num_ids:
+                element.set(val, num_ids[element.get(val)])
+        if rel_ids:
+            attrs = [qn(attr) for attr in RELATIONSHIP_ATTRS]
+            for element in root.xpath(SHARD_RELATIONSHIP_XPATH, namespaces={'r': RELATIONSHIPS_NS}):
+                for attr in attrs:
+                    if element.get(attr) in rel_ids:
+                        element.set(attr, rel_ids[element.get(attr)])
+    
+    def _rename_bookmarks(self, root):
+        seen = set()  # this shard's names so far
+        for start in root.iter(qn('w:bookmarkStart')):
+            name = start.get(qn('w:name'))
+            original = name
+            if name in self._bookmarks:
+                # pandoc names the second "details" heading details-1, the third details-2, ...
+                match = DUPLICATE_ID_RE.fullmatch(name)
+                base = match.group(1) if match and match.group(1) in seen else name
+                name = base
+                suffix = 0
+                while name in self._bookmarks:
+                    suffix += 1
+                    name = f'{base}-{suffix}'
+                start.set(qn('w:name'), name)
+            seen.add(original)
+            self._bookmarks.add(name)
+    
+    def _merge_rels(self, package: zipfile.ZipFile, source: memoryview, part: str, shift: int) -> dict:
+        """Add a shard part's relationships to the base part's; returns {shard Id: merged Id}."""
+        name = rels_name(part)
+        base = self._parts.setdefault(name, etree.fromstring(RELATIONSHIPS_XML))
+        part_dir = posixpath.dirname(part)
+        existing = {(rel.get('Type'), rel.get('Target')): rel.get('Id') for rel in base}
+        rel_ids = {}
+        for rel in etree.fromstring(self._read(package, name)):
+            rId, reltype, target = rel.get('Id'), rel.get('Type'), rel.get('Target', '')
+            if rel.get('TargetMode') != 'External':
+                path = posixpath.normpath(posixpath.join(part_dir, target)).lstrip('/')
+                if not path.startswith('word/media/'):
+                    if (reltype, target) in existing:
+                        rel_ids[rId] = existing[(reltype, target)]
+                    continue
+                info = package.getinfo(path)
+                digest = hashlib.sha256(package.read(info)).hexdigest()
+                if digest not in self._media:
+                    stem, ext = posixpath.splitext(path)
+                    new = f'word/media/rId{int(rId[3:]) + shift}{ext}' if rId[3:].isdigit() else path
+                    suffixes = itertools.count(1)
+                    while new in self._names:
+                        new = f'{stem}-{next(suffixes)}{ext}'
+                    self._names.add(new)
+                    self._media[digest] = new
+                    self._extra.append((source, info, new))
+                target = posixpath.relpath(self._media[digest], part_dir)
+                if (reltype, target) in existing:
+                    rel_ids[rId] = existing[(reltype, target)]
+                    continue
+            new_id = f'rId{int(rId[3:]) + shift}' if rId[3:].isdigit() else rId
+            copy_rel = copy.deepcopy(rel)
+            copy_rel.set('Id', new_id)
+            copy_rel.set('Target', target)
+            base.append(copy_rel)
+            existing[(reltype, target)] = new_id
+            rel_ids[rId] = new_id
+        return rel_ids
+    
+    def _merge_numbering(self, package: zipfile.ZipFile, roots: dict) -> dict:
+        """Add a shard's lists to the base numbering; returns {shard numId: merged numId}."""
+        base = self._parts.get('word/numbering.xml')
+        if base is None or 'word/numbering.xml' not in package.namelist():
+            return {}
+        shard = etree.fromstring(package.read('word/numbering.xml'))
+        tag_abstract, tag_num = qn('w:abstractNum'), qn('w:num')
+        attr_abstract, attr_num, val = qn('w:abstractNumId'), qn('w:numId'), qn('w:val')
+        abstracts = {element.get(attr_abstract): element for element in base.iter(tag_abstract)}
+        nums = {element.get(attr_num): element for element in base.iter(tag_num)}
+        used = {element.get(val) for root in roots.values() for element in root.iter(qn('w:numId'))}
+        
+        abstract_ids = {}
+        for element in shard.iter(tag_abstract):
+            aid = element.get(attr_abstract)
+            if aid in abstracts and etree.tostring(abstracts[aid]) == etree.tostring(element):
+                continue
+            new = aid
+            if aid in abstracts:
+                new = str(max(int(key) for key in abstracts) + 1)
+                element.set(attr_abstract, new)
+                abstract_ids[aid] = new
+            # abstract definitions come before the nums
+            position = len(abstracts) and base.index(list(abstracts.values())[-1]) + 1
+            base.insert(position, element)
+            abstracts[new] = element
+        
+        num_ids = {}
+        for element in list(shard.iter(tag_num)):
+            nid = element.get(attr_num)
+            link = element.find(qn('w:abstractNumId'))
+            if link is not None and link.get(val) in abstract_ids:
+                link.set(val, abstract_ids[link.get(val)])
+            if nid not in used and nid in nums and etree.tostring(nums[nid]) == etree.tostring(element):
+                continue
+            new = str(max((int(key) for key in nums), default=0) + 1)
+            element.set(attr_num, new)
+            base.append(element)
+            nums[new] = element
+            num_ids[nid] = new
+        return num_ids
+    
+    def _merge_styles(self, package: zipfile.ZipFile):
+        base = self._parts.get('word/styles.xml')
+        if base is None or 'word/styles.xml' not in package.namelist():
+            return
+        attr = qn('w:styleId')
+        known = {style.get(attr) for style in base.iter(qn('w:style'))}
+        for style in etree.fromstring(package.read('word/styles.xml')).iter(qn('w:style')):
+            if style.get(attr) not in known:
+                base.append(style)
+                known.add(style.get(attr))
+    
+    def _merge_content_types(self, package: zipfile.ZipFile):
+        base = self._parts['[Content_Types].xml']
+        keys = {(element.tag, element.get('Extension', '').lower(), element.get('PartName')) for element in base}
+        for element in etree.fromstring(package.read('[Content_Types].xml')):
+            if element.get('PartName', '').startswith('/word/media/'):
+                continue  # media are renamed; their extensions' defaults still apply
+            key = (element.tag, element.get('Extension', '').lower(), element.get('PartName'))
+            if key not in keys:
+                base.append(element)
+                keys.add(key)
+    
+    def finish(self, compression: int | None = None) -> bytes:
+        """The merged package."""
+        if self._last_sect_pr is not None:
+            self._body.append(self._last_sect_pr)
+        level = DEFAULT_COMPRESSION if compression is None else compression
+        output = io.BytesIO()
+        writer = ZipWriter(output)
+        source = memoryview(self._base_bytes)
+        date_time = self._base.getinfo('word/document.xml').date_time
+        for info in self._base.infolist():
+            if info.filename in self._parts:
+                writer.stream(info.filename, [xml_part(self._parts.pop(info.filename))], level, info.date_time)
+            else:
+                writer.copy(source, info)
+        for name, root in self._parts.items():  # .rels the base shard didn't have
+            if len(root):
+                writer.stream(name, [xml_part(root)], level, date_time)
+        for shard_source, info, name in self._extra:
+            writer.copy(shard_source, info, name)
+        writer.close()
+        return output.getvalue()
+
+
+def merge_docx_shards(shards: list[bytes], compression: int | None = None) -> bytes:
+    """One docx from the docx packages of consecutive shards (see :class:`ShardMerger`)."""
+    merger = ShardMerger(shards[0])
+    for shard in shards[1:]:
+        merger.add(shard)
+    return merger.finish(compression)
+
+
+def convert_file(source_path: Path, output_path: Path, pipeline: RenderPipeline,
+                 images_dir: str = 'images', image_subdir: str = '',
+                 format_tables: bool = True, keep_temp: bool = False,
+                 manifest: BuildManifest | None = None, format_engine: str = 'single-pass',
+                 reference_doc: Path | None = None, compression: int | None = None, log=print) -> dict:
+    """Convert one Markdown file to ``output_path``.
+    
+    ``image_subdir`` namespaces generated diagrams (batch mode uses the source
+    stem so documents sharing a folder don't overwrite each other's diagrams);
+    SVG conversions depend only on the SVG and stay shared in ``images_dir``.
+    With a ``manifest``, an unchanged document (see :func:`build_fingerprint`)
+    is reported up to date without doing any work. With a ``reference_doc``
+    pandoc applies its styles and Phase 5 only does per-instance fixups.
+    Progress goes through ``log`` (a print-compatible callable); stage
+    timings go to ``pipeline.timings``.
+    Returns {'diagrams': n, 'failures': n, 'up_to_date': bool};
+    raises ConversionError on failure.
+    """
+    if not source_path.exists():
+        raise ConversionError(f"Source file not found: {source_path}")
+    
+    timings = pipeline.timings
+    
+    # Read source
+    with timings.span('read'):
+        content = source_path.read_text(encoding='utf-8')
+    
+    fingerprint = None
+    if manifest is not None:
+        options = {'images_dir': images_dir, 'image_subdir': image_subdir,
+                   'format_tables': format_tables, 'mmdc': MMDC_OPTIONS}
+        if reference_doc:
+            options['reference_doc'] = file_sha256(reference_doc)
+        if pipeline.image_dpi:
+            options['image_dpi'] = pipeline.image_dpi
+        if pipeline.vector:
+            options['vector'] = True
+        if compression is not None:
+            options['compression'] = compression
+        if pipeline.shards > 1:
+            options['shards'] = pipeline.shards
+        with timings.span('fingerprint'):
+            fingerprint = build_fingerprint(source_path, content, options)
+            current = manifest.is_current(output_path, fingerprint)
+        if current:
+            log(f"✅ Up to date: {output_path}")
+            return {'diagrams': len(fingerprint['diagrams']), 'failures': 0, 'up_to_date': True}
+    
+    log(f"📄 Converting {source_path} → {output_path}")
+    
+    # Debug copy of the markdown handed to pandoc (named per source so batch runs don't collide)
+    temp_md = source_path.parent / f'_temp_word_{source_path.stem}.md' if keep_temp else None
+    docx_bytes, stats = render_docx(
+        content, source_path.parent, pipeline,
+        images_dir=images_dir,
+        image_subdir=image_subdir,
+        format_tables=format_tables,
+        format_engine=format_engine,
+        reference_doc=reference_doc,
+        temp_md=temp_md,
+        compression=compression,
+        log=log,
+    )
+    with timings.span('write'):
+        write_atomic(output_path, docx_bytes)
+    
+    if manifest is not None and stats['failures'] == 0:
+        manifest.record(output_path, fingerprint)
+    
+    log(f"✅ Done! Output: {output_path}")
+    log(f"   Size: {output_path.stat().st_size / 1024:.1f} KB")
+    return {**stats, 'up_to_date': False}
+
+
+def resolve_reference_doc(reference_doc: str | Path | None, cache_dir: Path | None = None) -> Path | None:
+    """``'auto'`` → the generated reference.docx (cached in ``cache_dir``), a path → that file.
+    
+    Raises ConversionError if the template can't be generated or found.
+    """
+    if reference_doc is None:
+        return None
+    if reference_doc == 'auto':
+        try:
+            return get_reference_docx(Path(cache_dir) if cache_dir else default_cache_dir())
+        except (ConversionError, OSError, ImportError) as e:
+            raise ConversionError(f"Could not generate reference.docx: {e}") from e
+    reference_doc = Path(reference_doc)
+    if not reference_doc.is_file():
+        raise ConversionError(f"Reference document not found: {reference_doc}")
+    return reference_doc
+
+
+def quiet(*args, **kwargs):
+    """A ``log`` that discards progress output (the library default)."""
+
+
+class Converter:
+    """Importable Markdown → Word converter that stays warm between calls.
+    
+    The CLI is a thin wrapper over this class; services can embed it instead
+    of spawning a process per document::
+    
+        md_to_word = importlib.import_module('md-to-word')
+        with md_to_word.Converter(reference_doc='auto', jobs=4) as converter:
+            docx_bytes = converter.convert(Path('docs/spec.md'))
+    
+    A Converter owns one :class:`RenderPipeline` (render cache, Mermaid
+    worker, optional pandoc server, thread pool) and the resolved reference
+    document, so only the first call pays their startup; pre-parsed OOXML
+    fragments are cached for the whole process. Failures raise
+    ConversionError (invalid options ValueError) - nothing exits the
+    interpreter. Calls may come from several threads at once. Progress goes
+    to ``log`` (silent by default).
+    """
+    
+    def __init__(self, images_dir: str = 'images', format_tables: bool = True,
+                 format_engine: str = 'single-pass', reference_doc: str | Path | None = None,
+                 image_dpi: int | None = None, vector: bool = False, jobs: int = 1,
+                 use_cache: bool = True, cache_dir: Path | None = None,
+                 cache_max_mb: int = CACHE_MAX_MB, batch_render: bool = True,
+                 pandoc_server: str | None = None, compression: int | None = None,
+                 shards: int = 1, timings: Timings | None = None, log=quiet):
+        if jobs < 1:
+            raise ValueError(f"jobs must be at least 1, got {jobs}")
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, got {shards}")
+        if image_dpi is not None and image_dpi <= 0:
+            raise ValueError(f"image_dpi must be positive, got {image_dpi}")
+        if format_engine not in FORMAT_ENGINES:
+            raise ValueError(f"Unknown format engine {format_engine!r} (choose from {', '.join(FORMAT_ENGINES)})")
+        if compression is not None:
+            if format_engine != 'streaming':
+                raise ValueError("compression needs format_engine='streaming'")
+            if not 0 <= compression <= 9:
+                raise ValueError(f"compression must be 0-9, got {compression}")
+        self.images_dir = images_dir
+        self.format_tables = format_tables
+        self.format_engine = format_engine
+        self.compression = compression
+        self.reference_doc = resolve_reference_doc(reference_doc, cache_dir)
+        self.log = log
+        self.pipeline = RenderPipeline(
+            jobs=jobs,
+            use_cache=use_cache,
+            cache_dir=cache_dir,
+            cache_max_mb=cache_max_mb,
+            batch_render=batch_render,
+            pandoc_server=pandoc_server,
+            timings=timings,
+            image_dpi=image_dpi,
+            vector=vector,
+            shards=shards,
+        )
+    
+    @property
+    def timings(self) -> Timings:
+        return self.pipeline.timings
+    
+    def convert(self, markdown: str | Path, base_dir: str | Path | None = None,
+                image_subdir: str | None = None) -> bytes:
+        """Convert Markdown text, or the Markdown file at a Path, to docx bytes.
+        
+        Relative images resolve against ``base_dir`` and rendered diagrams are
+        written below it (default: the file's folder, or the current directory
+        for text). Diagrams of text input go to an ``image_subdir`` named after
+        the text's hash unless one is given, so concurrent calls sharing a
+        ``base_dir`` don't overwrite each other's diagrams.
+        """
+        if isinstance(markdown, Path):
+            if not markdown.is_file():
+                raise ConversionError(f"Source file not found: {markdown}")
+            with self.timings.span('read'):
+                content = markdown.read_text(encoding='utf-8')
+            base_dir = base_dir or markdown.parent
+        else:
+            content = markdown
+            if image_subdir is None:
+                image_subdir = 'md-' + hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+        docx_bytes, _ = render_docx(
+            content, Path(base_dir or Path.cwd()), self.pipeline,
+            images_dir=self.images_dir,
+            image_subdir=image_subdir or '',
+            format_tables=self.format_tables,
+            format_engine=self.format_engine,
+            reference_doc=self.reference_doc,
+            compression=self.compression,
+            log=self.log,
+        )
+        return docx_bytes
+    
+    def convert_file(self, source_path: Path, output_path: Path, image_subdir: str = '',
+                     keep_temp: bool = False, manifest: BuildManifest | None = None,
+                     log=None) -> dict:
+        """:func:`convert_file` with this converter's options and warm pipeline."""
+        return convert_file(
+            Path(source_path), Path(output_path), self.pipeline,
+            images_dir=self.images_dir,
+            image_subdir=image_subdir,
+            format_tables=self.format_tables,
+            keep_temp=keep_temp,
+            manifest=manifest,
+            format_engine=self.format_engine,
+            reference_doc=self.reference_doc,
+            compression=self.compression,
+            log=log or self.log,
+        )
+    
+    def close(self):
+        """Stop the Mermaid worker and pandoc server and save the render cache index."""
+        self.pipeline.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+SERVICE_QUEUE_SIZE = 32   # requests waiting for a worker before new ones are turned away
+SERVICE_TOOL_LIMITS = {   # concurrent processes per external tool (browser-based ones are memory-heavy)
+    'mermaid': 2,
+    'svgexport': 2,
+    'pandoc': os.cpu_count() or 4,
+}
+
+
+async def run_subprocess(program: str, args: list, input: bytes | None = None,
+                         timeout: float | None = None,
+                         stdout_limit: int | None = TOOL_OUTPUT_LIMIT) -> tuple[int, bytes, bytes]:
+    """:func:`run_tool` without blocking the event loop; returns (returncode, stdout, stderr)."""
+    argv = [*resolve_tool(program), *map(str, args)]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **TOOL_PROCESS_GROUP
+        )
+    except OSError as e:
+        return 127, b'', str(e).encode('utf-8')
+    
+    async def read(stream, limit: int | None) -> bytes:
+        chunks, kept = [], 0
+        while data := await stream.read(65536):
+            if limit is None or kept < limit:
+                chunks.append(data if limit is None else data[:limit - kept])
+                kept += len(chunks[-1])
+        return b''.join(chunks)
+    
+    async def write():
+        if input is None:
+            return
+        try:
+            proc.stdin.write(input)
+            await proc.stdin.drain()
+            proc.stdin.close()
+        except OSError:
+            pass  # tool exited without reading everything; its returncode tells
+    
+    async def communicate():
+        stdout, stderr, _ = await asyncio.gather(read(proc.stdout, stdout_limit),
+                                                 read(proc.stderr, TOOL_OUTPUT_LIMIT), write())
+        return await proc.wait(), stdout, stderr
+    
+    try:
+        return await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc.pid)
+        await proc.wait()
+        return TOOL_TIMED_OUT, b'', f'{program} timed out after {timeout}s'.encode('utf-8')
+
+
+class ServiceBusy(Exception):
+    """The service's request queue is full; retry later."""
+
+
+class ServiceMetrics:
+    """Request counters, latency and per-tool activity for :class:`ConversionService`."""
+    
+    WINDOW = 60  # seconds covered by the recent throughput figure
+    
+    def __init__(self, tool_limits: dict[str, int]):
+        self.started = time.time()
+        self.counts = dict.fromkeys(('submitted', 'completed', 'failed', 'deduplicated', 'rejected'), 0)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.asset_failures = 0
+        self.tools = {tool: {'limit': limit, 'active': 0, 'runs': 0, 'seconds': 0.0}
+                      for tool, limit in tool_limits.items()}
+        self._recent = deque()  # completion times inside WINDOW
+    
+    def finished(self, latency: float, ok: bool):
+        now = time.time()
+        self.counts['completed' if ok else 'failed'] += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - self.WINDOW:
+            self._recent.popleft()
+    
+    def snapshot(self, queue_depth: int, queue_size: int, in_flight: int) -> dict:
+        now = time.time()
+        while self._recent and self._recent[0] < now - self.WINDOW:
+            self._recent.popleft()
+        uptime = now - self.started
+        done = self.counts['completed'] + self.counts['failed']
+        return {
+            'uptime_s': round(uptime, 1),
+            'queue_depth': queue_depth,
+            'queue_size': queue_size,
+            'in_flight': in_flight,
+            **self.counts,
+            'asset_failures': self.asset_failures,
+            'throughput_per_s': round(self.counts['completed'] / uptime, 3) if uptime else 0.0,
+            'recent_throughput_per_s': round(len(self._recent) / min(uptime or 1, self.WINDOW), 3),
+            'latency_ms': {'avg': round(1000 * self.latency_total / done, 1) if done else 0.0,
+                           'max': round(1000 * self.latency_max, 1)},
+            'tools': {tool: {**stats, 'seconds': round(stats['seconds'], 3)}
+                      for tool, stats in self.tools.items()},
+        }
+
+
+class ConversionService:
+    """Asyncio conversion service: a bounded request queue served by ``workers`` coroutines.
+    
+    External tools run through :func:`run_subprocess` (asyncio subprocesses
+    with ``TOOL_TIMEOUTS``), each behind its own semaphore (``tool_limits``), so a burst of requests
+    can't start more browsers than the machine holds; the python-docx
+    post-formatting runs in the default executor. Identical requests
+    (same Markdown and base directory) that arrive while one is queued or
+    running share its result. A full queue rejects new requests with
+    ServiceBusy (``block=False``) or makes the caller wait (``block=True``).
+    Options, the reference document and the render cache come from
+    ``converter``; its Mermaid worker is not used (each render is one mmdc
+    process under the 'mermaid' limit). ``root`` confines request base
+    directories.
+    """
+    
+    def __init__(self, converter: Converter, workers: int = 1, queue_size: int = SERVICE_QUEUE_SIZE,
+                 tool_limits: dict[str, int] | None = None, root: Path | None = None):
+        self.converter = converter
+        self.workers = max(1, workers)
+        self.root = Path(root or Path.cwd()).resolve()
+        limits = {**SERVICE_TOOL_LIMITS, **(tool_limits or {})}
+        self.metrics = ServiceMetrics(limits)
+        self._limits = {tool: asyncio.Semaphore(limit) for tool, limit in limits.items()}
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._pending: dict[str, asyncio.Future] = {}
+        self._mermaid_version: asyncio.Future | None = None
+        self._outputs: dict[Path, asyncio.Future] = {}  # image path → the job writing it
+        self._tasks = []
+    
+    async def start(self):
+        """Start the workers."""
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def base_dir(self, base_dir: str | None) -> Path:
+        """Resolve a request's base directory inside ``root``; raises ConversionError outside it."""
+        path = (self.root / (base_dir or '.')).resolve()
+        if path != self.root and self.root not in path.parents:
+            raise ConversionError(f"base_dir must be inside {self.root}: {base_dir}")
+        if not path.is_dir():
+            raise ConversionError(f"base_dir not found: {base_dir}")
+        return path
+    
+    async def enqueue(self, markdown: str, base_dir: Path, block: bool = True) -> asyncio.Future:
+        """Queue a conversion and return the future of its docx bytes.
+        
+        Joins an identical pending request instead of queueing a duplicate.
+        Raises ServiceBusy if the queue is full and ``block`` is False.
+        """
+        key = hashlib.sha256(f'{base_dir}\0{markdown}'.encode('utf-8')).hexdigest()
+        future = self._pending.get(key)
+        if future is not None:
+            self.metrics.counts['deduplicated'] += 1
+            return future
+        if not block and self._queue.full():
+            self.metrics.counts['rejected'] += 1
+            raise ServiceBusy(f"queue full ({self._queue.maxsize} requests waiting)")
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        self.metrics.counts['submitted'] += 1
+        try:
+            await self._queue.put((key, markdown, base_dir, time.perf_counter()))
+        except BaseException:
+            del self._pending[key]
+            raise
+        return future
+    
+    async def convert(self, markdown: str, base_dir: Path, block: bool = True) -> bytes:
+        """Queue a conversion and wait for its docx bytes."""
+        return await asyncio.shield(await self.enqueue(markdown, base_dir, block))
+    
+    def snapshot(self) -> dict:
+        """Throughput, latency, queue depth and per-tool activity as a JSON-ready dict."""
+        return self.metrics.snapshot(self._queue.qsize(), self._queue.maxsize, len(self._pending))
+    
+    async def _worker(self):
+        while True:
+            key, markdown, base_dir, queued = await self._queue.get()
+            future = self._pending[key]
+            try:
+                docx_bytes = await self._convert(markdown, base_dir)
+            except Exception as e:
+                self.metrics.finished(time.perf_counter() - queued, ok=False)
+                future.set_exception(e)
+            else:
+                self.metrics.finished(time.perf_counter() - queued, ok=True)
+                future.set_result(docx_bytes)
+            finally:
+                del self._pending[key]
+                self._queue.task_done()
+    
+    async def _tool(self, tool: str, program: str, args: list, input: bytes | None = None,
+                    stdout_limit: int | None = TOOL_OUTPUT_LIMIT) -> tuple[int, bytes, bytes]:
+        """Run one external tool under its concurrency limit and timeout."""
+        stats = self.metrics.tools[tool]
+        async with self._limits[tool]:
+            stats['active'] += 1
+            start = time.perf_counter()
+            try:
+                return await run_subprocess(program, args, input, TOOL_TIMEOUTS[tool], stdout_limit)
+            finally:
+                stats['active'] -= 1
+                stats['runs'] += 1
+                stats['seconds'] += time.perf_counter() - start
+    
+    async def _mermaid_cli_version(self) -> str:
+        """The mermaid-cli version for render cache keys, probed off the loop on first use.
+        
+        The probe can take a while (npx), so it waits for the first diagram
+        instead of delaying startup; concurrent requests share the one probe.
+        A version already in the toolchain cache answers without running mmdc.
+        """
+        if self._mermaid_version is None:
+            self._mermaid_version = asyncio.get_running_loop().run_in_executor(None, get_mermaid_cli_version)
+        return await asyncio.shield(self._mermaid_version)
+    
+    async def _once(self, path: Path, job, *args):
+        """Run ``job(*args)``, which writes ``path``, unless a concurrent request
+        is already writing it; then wait for that run's result instead.
+        """
+        future = self._outputs.get(path)
+        if future is None:
+            future = self._outputs[path] = asyncio.ensure_future(job(*args))
+            future.add_done_callback(lambda _: self._outputs.pop(path, None))
+        return await asyncio.shield(future)
+    
+    async def _render_diagram(self, mmd_content: str, png_path: Path) -> tuple[bool, tuple[int, int]]:
+        """Async :func:`render_mermaid_diagram` (plus the pipeline's --image-dpi step)."""
+        pipeline = self.converter.pipeline
+        cache = pipeline.cache
+        if cache:
+            await self._mermaid_cli_version()
+        key = render_cache_key(mmd_content, png_path) if cache else None
+        dimensions = cache.get(key, png_path) if cache else None
+        if not dimensions:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False, encoding='utf-8') as f:
+                f.write(mmd_content)
+            try:
+                returncode, _, _ = await self._tool('mermaid', 'mmdc', mmdc_args(Path(f.name), png_path))
+            finally:
+                os.unlink(f.name)
+            dimensions = get_image_dimensions(png_path) if returncode == 0 else (0, 0)
+            if dimensions == (0, 0):
+                return False, dimensions
+            if cache:
+                cache.put(key, png_path, dimensions)
+        await asyncio.get_running_loop().run_in_executor(
+            None, pipeline._optimize, png_path, fit_to_page(*dimensions))
+        return True, dimensions
+    
+    async def _convert_svg(self, svg_path: Path, png_path: Path) -> bool:
+        pipeline = self.converter.pipeline
+        returncode, _, _ = await self._tool('svgexport', 'svgexport', svgexport_args(svg_path, png_path, pipeline.svg_width))
+        if returncode != 0:
+            return False
+        width, height = get_png_dimensions(png_path)
+        await asyncio.get_running_loop().run_in_executor(
+            None, pipeline._optimize, png_path, (SVG_DISPLAY_WIDTH, SVG_DISPLAY_WIDTH * height / max(width, 1)))
+        return True
+    
+    async def _convert(self, markdown: str, base_dir: Path) -> bytes:
+        """The phases of :func:`render_docx`, with tools awaited instead of waited on."""
+        converter, pipeline = self.converter, self.converter.pipeline
+        loop = asyncio.get_running_loop()
+        images_rel = f"{converter.images_dir}/md-{hashlib.sha256(markdown.encode('utf-8')).hexdigest()[:12]}"
+        
+        plan = AssetPlan(preprocess_markdown(markdown), base_dir, pipeline, converter.images_dir, images_rel)
+        # An up-to-date PNG may still be in the middle of another request's conversion
+        svg_pngs = {target[1] for target in plan.svg_targets.values() if target and target[1]}
+        in_flight = [self._outputs[png_path] for png_path in svg_pngs - plan.svg_jobs.keys()
+                     if png_path in self._outputs]
+        rendered, svg_results, _ = await asyncio.gather(
+            asyncio.gather(*(self._once(png_path, self._render_diagram, mmd_content, png_path)
+                             for png_path, mmd_content in plan.diagrams.items())),
+            asyncio.gather(*(self._once(png_path, self._convert_svg, svg_path, png_path)
+                             for png_path, svg_path in plan.svg_jobs.items())),
+            asyncio.gather(*map(asyncio.shield, in_flight)))
+        renders = dict(zip(plan.diagrams, rendered))
+        failed = {png_path for png_path, (ok, _) in renders.items() if not ok}
+        failed |= {png_path for png_path, ok in zip(plan.svg_jobs, svg_results) if not ok}
+        self.metrics.asset_failures += sum(not ok for ok, _ in rendered) + sum(not ok for ok in svg_results)
+        for idx, png_path in enumerate(plan.diagram_paths):
+            plan.set_diagram(idx, *renders[png_path])
+        plan.set_svgs()
+        content = plan.text()
+        svg_pngs, _ = plan.svg_pngs(failed)
+        
+        docx_bytes = None
+        if pipeline.pandoc_server:
+            docx_bytes = await loop.run_in_executor(
+                None, pipeline.pandoc_server.convert, content, base_dir, converter.reference_doc)
+        if docx_bytes is None:
+            returncode, docx_bytes, stderr = await self._tool(
+                'pandoc', 'pandoc', pandoc_args(base_dir, converter.reference_doc), content.encode('utf-8'),
+                stdout_limit=None)
+            if returncode != 0:
+                raise ConversionError(f"pandoc failed: {stderr.decode('utf-8', 'replace')}")
+        return await loop.run_in_executor(
+            None, format_docx, docx_bytes, converter.format_tables, converter.format_engine,
+            converter.reference_doc is not None, pipeline.vector, None, converter.compression, svg_pngs)
+
+
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+SERVICE_MAX_REQUEST = 32 * 1024 * 1024  # bytes of Markdown/JSON accepted per request
+
+
+def conversion_request(request) -> tuple[str, str | None]:
+    """(markdown, base_dir) of a decoded request; KeyError/TypeError if they are missing or not strings."""
+    if not isinstance(request, dict):
+        raise TypeError(f"expected an object, got {type(request).__name__}")
+    markdown, base_dir = request['markdown'], request.get('base_dir')
+    if not isinstance(markdown, str):
+        raise TypeError(f"markdown must be a string, got {type(markdown).__name__}")
+    if base_dir is not None and not isinstance(base_dir, str):
+        raise TypeError(f"base_dir must be a string, got {type(base_dir).__name__}")
+    return markdown, base_dir
+
+
+async def serve_http(service: ConversionService, host: str, port: int):
+    """Serve ``POST /convert`` and ``GET /metrics`` over HTTP/1.1 (one request per connection).
+    
+    ``/convert`` takes JSON ``{"markdown": ..., "base_dir": ...}`` (base_dir
+    relative to the service root) and answers with the .docx; a full queue
+    answers 503 with Retry-After so callers back off.
+    """
+    async def respond(writer, status: int, body: bytes, content_type: str = 'application/json',
+                      headers: dict | None = None):
+        head = [f'HTTP/1.1 {status} {HTTP_REASONS[status]}', f'Content-Type: {content_type}',
+                f'Content-Length: {len(body)}', 'Connection: close']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+    
+    def error(message: str) -> bytes:
+        return json.dumps({'error': message}).encode('utf-8')
+    
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, target = request_line[0], request_line[1].split('?')[0]
+            if method == 'GET' and target == '/metrics':
+                await respond(writer, 200, json.dumps(service.snapshot()).encode('utf-8'))
+                return
+            if method != 'POST' or target != '/convert':
+                await respond(writer, 404, error(f'no route for {method} {target}'))
+                return
+            length = headers.get('content-length') or '0'
+            if not length.isascii() or not length.isdigit():
+                await respond(writer, 400, error(f'invalid Content-Length: {length!r}'))
+                return
+            length = int(length)
+            if length > SERVICE_MAX_REQUEST:
+                await respond(writer, 413, error(f'request larger than {SERVICE_MAX_REQUEST} bytes'))
+                return
+            try:
+                markdown, base_dir = conversion_request(json.loads(await reader.readexactly(length)))
+                base_dir = service.base_dir(base_dir)
+            except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError) as e:
+                await respond(writer, 400, error(f'expected JSON {{"markdown": ..., "base_dir": ...}}: {e}'))
+                return
+            except ConversionError as e:
+                await respond(writer, 400, error(str(e)))
+                return
+            try:
+                docx_bytes = await service.convert(markdown, base_dir, block=False)
+            except ServiceBusy as e:
+                await respond(writer, 503, error(str(e)), headers={'Retry-After': '1'})
+            except ConversionError as e:
+                await respond(writer, 422, error(str(e)))
+            except Exception as e:
+                await respond(writer, 500, error(str(e)))
+            else:
+                await respond(writer, 200, docx_bytes, DOCX_MEDIA_TYPE)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    server = await asyncio.start_server(handle, host, port)
+    print(f"🌐 Serving on http://{host}:{port} (POST /convert, GET /metrics)", file=sys.stderr, flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_stdio(service: ConversionService, out=None):
+    """Serve JSON lines on stdin and ``out`` (default: stdout).
+    
+    Requests: ``{"id": ..., "markdown": ..., "base_dir": ...}`` or
+    ``{"id": ..., "op": "metrics"}``. Replies (in completion order):
+    ``{"id": ..., "ok": true, "docx": <base64>}``, ``{"id": ..., "ok": true,
+    "metrics": {...}}`` or ``{"id": ..., "ok": false, "error": ...}``. Input
+    is not read while the queue is full, so a fast producer is throttled
+    instead of buffered.
+    """
+    loop = asyncio.get_running_loop()
+    replies = set()
+    out = out or sys.stdout
+    
+    def reply(message: dict):
+        out.write(json.dumps(message) + '\n')
+        out.flush()
+    
+    async def finish(request_id, future: asyncio.Future):
+        try:
+            docx_bytes = await asyncio.shield(future)
+        except Exception as e:
+            reply({'id': request_id, 'ok': False, 'error': str(e)})
+        else:
+            reply({'id': request_id, 'ok': True, 'docx': base64.b64encode(docx_bytes).decode('ascii')})
+    
+    while line := await loop.run_in_executor(None, sys.stdin.readline):
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('op') == 'metrics':
+                reply({'id': request_id, 'ok': True, 'metrics': service.snapshot()})
+                continue
+            markdown, base_dir = conversion_request(request)
+            future = await service.enqueue(markdown, service.base_dir(base_dir))
+        except (ValueError, KeyError, TypeError, AttributeError, ConversionError) as e:
+            reply({'id': request_id, 'ok': False, 'error': f'bad request: {e}'})
+            continue
+        task = asyncio.create_task(finish(request_id, future))
+        replies.add(task)
+        task.add_done_callback(replies.discard)
+    await asyncio.gather(*replies)
+
+
+def parse_tool_values(values: list[str], tools) -> dict[str, int]:
+    """``['mermaid=1', 'pandoc=8']`` → {'mermaid': 1, 'pandoc': 8}; raises ValueError on bad input."""
+    parsed = {}
+    for value in values:
+        tool, _, number = value.partition('=')
+        if tool not in tools or not number.isdigit() or int(number) < 1:
+            raise ValueError(f"expected TOOL=N with TOOL in {', '.join(tools)}: {value}")
+        parsed[tool] = int(number)
+    return parsed
+
+
+async def run_service(converter: Converter, address: str, workers: int, queue_size: int,
+                      tool_limits: dict[str, int]):
+    """Run the conversion service on ``address`` ('stdio' or HOST:PORT) until interrupted.
+    
+    Diagnostics printed while serving (tool fallbacks, cache warnings) go to
+    stderr, so stdout carries nothing but stdio protocol replies.
+    """
+    service = ConversionService(converter, workers=workers, queue_size=queue_size, tool_limits=tool_limits)
+    replies = sys.stdout
+    with redirect_stdout(sys.stderr):
+        await service.start()
+        try:
+            if address == 'stdio':
+                await serve_stdio(service, replies)
+            else:
+                host, _, port = address.rpartition(':')
+                await serve_http(service, host or '127.0.0.1', int(port))
+        finally:
+            await service.stop()
+
+
+def is_stale(target: Path, source: Path) -> bool:
+    """True if ``target`` is missing or older than ``source``."""
+    return not target.exists() or target.stat().st_mtime_ns < source.stat().st_mtime_ns
+
+
+def watched_files(source_path: Path) -> list[Path]:
+    """A Markdown source plus every local image it references."""
+    try:
+        content = source_path.read_text(encoding='utf-8')
+    except (OSError, UnicodeDecodeError):
+        return [source_path]
+    return [source_path] + [source_path.parent / ref for ref in find_image_references(content)]
+
+
+def snapshot_mtimes(paths: list[Path]) -> dict[Path, int | None]:
+    """Modification times (ns) of ``paths``; None for missing files."""
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = path.stat().st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def watch_sources(sources: list[tuple[Path, Path]], rebuild, interval: float = 0.2,
+                  debounce: float = 0.3):
+    """Call ``rebuild(source, rel)`` whenever a source or its images change, until Ctrl+C.
+    
+    Files are polled (no extra dependency). Rebuilds are debounced: they start
+    once the changed document's files have been quiet for ``debounce`` seconds,
+    so an editor's burst of saves triggers a single conversion.
+    """
+    watched = {source: watched_files(source) for source, _ in sources}
+    mtimes = {source: snapshot_mtimes(files) for source, files in watched.items()}
+    count = len({path for files in watched.values() for path in files})
+    print(f"\n👀 Watching {count} files for changes (Ctrl+C to stop)...")
+    try:
+        while True:
+            time.sleep(interval)
+            changed = [(source, rel) for source, rel in sources
+                       if snapshot_mtimes(watched[source]) != mtimes[source]]
+            if not changed:
+                continue
             
-            if not png_path.exists():
-                print(f"🖼️  Converting SVG: {svg_path.name}...", end=' ')
-                if convert_svg_to_png(svg_path, png_path):
-                    print("✓")
-                else:
-                    print("✗")
+            # Debounce: wait for the burst of saves to settle
+            settled = None
+            while True:
+                current = [snapshot_mtimes(watched[source]) for source, _ in changed]
+                if current == settled:
+                    break
+                settled = current
+                time.sleep(debounce)
             
-            # Update content to use PNG (90% max width = 5.8in)
-            new_ref = f'![{alt_text}]({args.images_dir}/{png_name}){{width=5.8in}}'
-            content = content.replace(match.group(0), new_ref)
+            for source, rel in changed:
+                print()
+                rebuild(source, rel)
+                # References may have changed - re-resolve what to watch
+                watched[source] = watched_files(source)
+                mtimes[source] = snapshot_mtimes(watched[source])
+    except KeyboardInterrupt:
+        print("\n👋 Stopped watching")
+
+
+GLOB_MAGIC_RE = re.compile(r'[*?[]')
+
+
+def glob_base(pattern: str) -> Path:
+    """The folder a glob pattern starts in: its leading components without wildcards."""
+    fixed = list(itertools.takewhile(lambda part: not GLOB_MAGIC_RE.search(part), Path(pattern).parts))
+    return Path(*fixed) if fixed else Path('.')
+
+
+def expand_sources(patterns: list[str]) -> tuple[list[tuple[Path, Path]], list[str]]:
+    """Expand files, globs and directories into (source, relative-name) pairs.
     
-    # Phase 3: Replace mermaid blocks with image references
-    pattern = r'```mermaid\r?\n.*?```'
-    for replacement in replacements:
-        content = re.sub(pattern, replacement, content, count=1, flags=re.DOTALL)
-    
-    # Write temporary markdown
-    temp_md = source_path.parent / '_temp_word.md'
-    temp_md.write_text(content, encoding='utf-8')
-    
-    # Phase 4: Convert to Word with pandoc
-    # Use --resource-path so pandoc resolves relative image paths from source dir 
-    print(f"📝 Generating Word document...")
-    resource_path = source_path.parent.resolve()
-    result = subprocess.run(
-        f'pandoc "{temp_md}" -o "{output_path}" --from markdown --to docx --resource-path="{resource_path}"',
-        capture_output=True,
-        text=True,
-        shell=True
+    Directories contribute every ``*.md`` below them (relative to the
+    directory), glob matches are relative to the folder the pattern starts
+    in (``specs/**/*.md`` → ``a/README.md``), files are just their name.
+    Duplicates and the converter's own ``_temp_word_*`` files are skipped.
+    Also returns the patterns that matched no file.
+    """
+    found = {}
+    missing = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            pairs = [(p, p.relative_to(path)) for p in sorted(path.rglob('*.md'))]
+        elif path.exists():
+            pairs = [(path, Path(path.name))]
+        else:
+            base = glob_base(pattern)
+            pairs = [(Path(p), Path(p).relative_to(base))
+                     for p in sorted(glob.glob(pattern, recursive=True))]
+        pairs = [(source, rel) for source, rel in pairs
+                 if source.is_file() and not source.name.startswith('_temp_word_')]
+        if not pairs:
+            missing.append(pattern)
+        for source, rel in pairs:
+            found.setdefault(source.resolve(), (source, rel))
+    return list(found.values()), missing
+
+
+def print_summary(results: list[tuple[Path, str, dict | None, float]]):
+    """Print the end-of-run table: file, status, diagrams, failures, time."""
+    width = max([len(str(source)) for source, *_ in results] + [4])
+    print(f"\n📋 Summary ({len(results)} files)")
+    print(f"   {'File':<{width}}  {'Status':<12}  Diagrams  Failures    Time")
+    for source, error, stats, elapsed in results:
+        if error:
+            status = '✗ fail'
+        elif stats['up_to_date']:
+            status = '= up to date'
+        else:
+            status = '✓ ok'
+        diagrams = stats['diagrams'] if stats else '-'
+        failures = stats['failures'] if stats else '-'
+        print(f"   {str(source):<{width}}  {status:<12}  {diagrams:>8}  {failures:>8}  {elapsed:>5.1f}s")
+    failed = [(source, error) for source, error, _, _ in results if error]
+    for source, error in failed:
+        print(f"   ✗ {source}: {error}")
+    fresh = sum(1 for _, error, stats, _ in results if not error and stats['up_to_date'])
+    converted = len(results) - len(failed) - fresh
+    print(f"   {converted} converted, {fresh} up to date, {len(failed)} failed")
+
+
+def serve(args, parser):
+    """``--serve``: run :class:`ConversionService` with the CLI's conversion options."""
+    if args.queue_size < 1:
+        parser.error('--queue-size must be at least 1')
+    if args.serve != 'stdio' and not args.serve.rpartition(':')[2].isdigit():
+        parser.error('--serve takes HOST:PORT (or just :PORT) or stdio')
+    try:
+        tool_limits = parse_tool_values(args.tool_limit, SERVICE_TOOL_LIMITS)
+    except ValueError as e:
+        parser.error(f'--tool-limit: {e}')
+    try:
+        converter = Converter(
+            images_dir=args.images_dir,
+            format_tables=not args.no_format_tables,
+            format_engine=args.format_engine,
+            reference_doc=args.reference_doc,
+            image_dpi=args.image_dpi,
+            vector=args.vector,
+            use_cache=not args.no_cache,
+            cache_dir=args.cache_dir,
+            cache_max_mb=args.cache_max_mb,
+            batch_render=False,  # the service runs mmdc itself, under its 'mermaid' limit
+            pandoc_server=args.pandoc_server,
+            compression=args.compression,
+        )
+    except ConversionError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    with converter:
+        try:
+            asyncio.run(run_service(converter, args.serve, args.jobs, args.queue_size, tool_limits))
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert Markdown with Mermaid diagrams to Word document'
     )
+    parser.add_argument('sources', nargs='*', metavar='SOURCE',
+                        help='Source Markdown file(s), globs or directories '
+                             '(a single SOURCE may be followed by OUTPUT.docx)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Write .docx files here, mirroring input folders (default: next to each source)')
+    parser.add_argument('--images-dir', default='images', help='Directory for generated images')
+    parser.add_argument('--no-format-tables', action='store_true', help='Skip table formatting')
+    parser.add_argument('--keep-temp', action='store_true',
+                        help='Also write the markdown sent to pandoc to _temp_word_<name>.md (debugging)')
+    parser.add_argument('--format-engine', choices=FORMAT_ENGINES, default='single-pass',
+                        help='Post-formatting engine (default: single-pass); streaming rewrites the '
+                             'docx ZIP entry by entry instead of loading it')
+    parser.add_argument('--compression', type=int, choices=range(10), default=None, metavar='LEVEL',
+                        help='Only with --format-engine streaming (rejected otherwise): deflate level '
+                             '0-9 for the parts it rewrites (default: 6; 0 stores them)')
+    parser.add_argument('--reference-doc', nargs='?', const='auto', default=None, metavar='PATH',
+                        help='Style through a pandoc reference.docx: generated from the built-in '
+                             'formatting and cached (no PATH), or your own template')
+    parser.add_argument('--image-dpi', type=int, default=None, metavar='DPI',
+                        help='Downsample images to their printed size at DPI, recompress them '
+                             'losslessly and tag them with the DPI (default: leave as rendered)')
+    parser.add_argument('--vector', action='store_true',
+                        help='Embed Mermaid diagrams and SVG references as native SVG (Word 2016+); '
+                             'their PNG renders are kept as the fallback older readers show')
+    parser.add_argument('--no-cache', action='store_true', help='Always re-render Mermaid diagrams')
+    parser.add_argument('--cache-dir', default=None,
+                        help=f'Render cache directory (default: {default_cache_dir()})')
+    parser.add_argument('--cache-max-mb', type=int, default=CACHE_MAX_MB,
+                        help=f'Render cache size cap in MB (default: {CACHE_MAX_MB})')
+    parser.add_argument('--no-batch-render', action='store_true',
+                        help='Render each diagram with its own mmdc process')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Render up to N diagrams/SVGs (and convert N files) concurrently (default: 1)')
+    parser.add_argument('--pandoc-server', nargs='?', const='auto', default=None, metavar='URL',
+                        help='Convert through a warm pandoc server: launch one locally, or use '
+                             'the one at URL (falls back to the pandoc CLI)')
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+                        help='Split large documents at top-level headings into up to N pieces and '
+                             'convert and format them in N processes (pandoc CLI), then merge (default: 1)')
+    parser.add_argument('--serve', default=None, metavar='HOST:PORT|stdio',
+                        help='Run as a conversion service instead: HTTP on HOST:PORT '
+                             '(POST /convert, GET /metrics) or JSON lines on stdin/stdout; '
+                             '-j sets the number of concurrent conversions')
+    parser.add_argument('--queue-size', type=int, default=SERVICE_QUEUE_SIZE,
+                        help=f'Service: requests waiting before new ones get 503 / stdin stalls '
+                             f'(default: {SERVICE_QUEUE_SIZE})')
+    parser.add_argument('--tool-limit', action='append', default=[], metavar='TOOL=N',
+                        help='Service: at most N concurrent processes of TOOL (mermaid, svgexport, pandoc; '
+                             'defaults: ' + ', '.join(f'{tool}={limit}' for tool, limit in SERVICE_TOOL_LIMITS.items()) + ')')
+    parser.add_argument('--tool-timeout', action='append', default=[], metavar='TOOL=SECONDS',
+                        help='Kill TOOL (mermaid, svgexport, pandoc) and its children after SECONDS (defaults: '
+                             + ', '.join(f'{tool}={seconds}' for tool, seconds in TOOL_TIMEOUTS.items()
+                                         if tool != 'probe') + ')')
+    parser.add_argument('--toolchain', action='store_true',
+                        help=f'Print the pandoc/mmdc/svgexport commands and versions used, then exit '
+                             f'(probe results are cached in {TOOLCHAIN_NAME} in the cache dir)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print how long every stage and diagram render took')
+    parser.add_argument('--timings-json', default=None, metavar='PATH',
+                        help='Write stage/diagram timings as a Chrome trace (chrome://tracing, Perfetto)')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Skip documents whose inputs are unchanged since the last build')
+    parser.add_argument('--manifest', default=MANIFEST_NAME,
+                        help=f'Build manifest for --incremental (default: ./{MANIFEST_NAME})')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Rebuild whenever a source or its referenced images change')
+    parser.add_argument('--debounce', type=int, default=300,
+                        help='Watch mode: wait for N ms of quiet before rebuilding (default: 300)')
     
-    if result.returncode != 0:
-        print(f"ERROR: pandoc failed: {result.stderr}")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.image_dpi is not None and args.image_dpi <= 0:
+        parser.error('--image-dpi must be positive')
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    if args.compression is not None and args.format_engine != 'streaming':
+        parser.error('--compression needs --format-engine streaming (python-docx saves at its own level)')
+    try:
+        TOOL_TIMEOUTS.update(parse_tool_values(args.tool_timeout, ('mermaid', 'svgexport', 'pandoc')))
+    except ValueError as e:
+        parser.error(f'--tool-timeout: {e}')
+    if args.toolchain:
+        print(f"🔧 Toolchain (probes cached in {toolchain.path})")
+        for tool, version, command in toolchain.summary():
+            print(f"   {tool:<10} {version:<24} {command}")
+        return
+    if args.serve:
+        serve(args, parser)
+        return
+    if not args.sources:
+        parser.error('at least one SOURCE is required (or --serve)')
+    
+    # Legacy form: SOURCE.md OUTPUT.docx
+    explicit_output = None
+    if len(args.sources) == 2 and args.sources[1].lower().endswith('.docx'):
+        explicit_output = Path(args.sources.pop())
+    
+    sources, missing = expand_sources(args.sources)
+    if not sources:
+        print(f"ERROR: Source file not found: {' '.join(args.sources)}")
         sys.exit(1)
+    batch = len(sources) > 1
+    if batch and explicit_output:
+        parser.error('OUTPUT.docx can only be given for a single source (use --output-dir)')
     
-    # Phase 5: Apply all formatting (tables, images, headings, spacing)
-    print(f"🎨 Applying formatting...")
-    doc = Document(str(output_path))
-    apply_all_formatting(doc, format_tables_flag=not args.no_format_tables)
-    doc.save(str(output_path))
+    def output_for(source: Path, rel: Path) -> Path:
+        if explicit_output:
+            return explicit_output
+        if args.output_dir:
+            return Path(args.output_dir) / rel.with_suffix('.docx')
+        return source.with_suffix('.docx')
     
-    # Cleanup
-    if not args.keep_temp:
-        temp_md.unlink()
+    # Two sources writing one file would silently keep only the last
+    outputs = {}
+    for source, rel in sources:
+        outputs.setdefault(output_for(source, rel).resolve(), []).append(str(source))
+    clashes = [names for names in outputs.values() if len(names) > 1]
+    if clashes:
+        for names in clashes:
+            print(f"ERROR: {' and '.join(names)} would write the same output file")
+        sys.exit(1)
     
-    print(f"✅ Done! Output: {output_path}")
-    print(f"   Size: {output_path.stat().st_size / 1024:.1f} KB")
+    manifest = BuildManifest(args.manifest) if args.incremental else None
+    timings = Timings(enabled=bool(args.timings or args.timings_json))
+    
+    try:
+        converter = Converter(
+            images_dir=args.images_dir,
+            format_tables=not args.no_format_tables,
+            format_engine=args.format_engine,
+            reference_doc=args.reference_doc,
+            image_dpi=args.image_dpi,
+            vector=args.vector,
+            jobs=args.jobs,
+            use_cache=not args.no_cache,
+            cache_dir=args.cache_dir,
+            cache_max_mb=args.cache_max_mb,
+            batch_render=not args.no_batch_render,
+            pandoc_server=args.pandoc_server,
+            compression=args.compression,
+            shards=args.shards,
+            timings=timings,
+            log=print,
+        )
+    except ConversionError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    
+    def run(source: Path, rel: Path, log) -> tuple[str, dict | None, float]:
+        start = time.perf_counter()
+        try:
+            with timings.span('convert', 'document', file=str(source)):
+                stats = converter.convert_file(
+                    source, output_for(source, rel),
+                    image_subdir=source.stem if batch else '',
+                    keep_temp=args.keep_temp,
+                    manifest=manifest,
+                    log=log,
+                )
+            return '', stats, time.perf_counter() - start
+        except Exception as e:  # keep going: one bad file must not stop the batch
+            log(f"ERROR: {e}")
+            return str(e).strip().splitlines()[0], None, time.perf_counter() - start
+    
+    with converter:
+        if batch:
+            # Files convert in parallel; each buffers its progress and is
+            # printed as a block, in input order
+            results = []
+            with ThreadPoolExecutor(max_workers=args.jobs) as files_pool:
+                buffers = [io.StringIO() for _ in sources]
+                futures = [
+                    files_pool.submit(run, source, rel, partial(print, file=buffer))
+                    for (source, rel), buffer in zip(sources, buffers)
+                ]
+                for (source, _), buffer, future in zip(sources, buffers, futures):
+                    error, stats, elapsed = future.result()
+                    print(buffer.getvalue(), end='', flush=True)
+                    results.append((source, error, stats, elapsed))
+        else:
+            source, rel = sources[0]
+            error, stats, elapsed = run(source, rel, print)
+            results = [(source, error, stats, elapsed)]
+        results += [(Path(pattern), 'no such file, or no file matches', None, 0.0) for pattern in missing]
+        
+        if manifest:
+            manifest.save()
+        if batch or missing:
+            print_summary(results)
+        
+        def report_timings():
+            if args.timings:
+                timings.print_summary()
+            if args.timings_json:
+                timings.write_trace(Path(args.timings_json))
+                print(f"⏱️  Trace written to {args.timings_json}")
+        
+        report_timings()
+        
+        if args.watch:
+            # Keep the converter (cache, warm renderer, written diagrams) alive
+            # so each rebuild only redoes the stages its change affects
+            def rebuild(source: Path, rel: Path):
+                timings.reset()
+                error, _, elapsed = run(source, rel, print)
+                if manifest:
+                    manifest.save()
+                print(f"⏱️  {'Failed' if error else 'Rebuilt'} in {elapsed:.2f}s")
+                report_timings()
+            
+            watch_sources(sources, rebuild, debounce=args.debounce / 1000)
+            return
+    
+    if any(error for _, error, _, _ in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':